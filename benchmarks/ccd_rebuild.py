@@ -0,0 +1,97 @@
+"""Measure a full rebuild of the ccd directory from the database.
+
+Seeds clients with virtual addresses, every tenth one a gateway, then rebuilds
+an empty ccd directory and rebuilds it again with nothing changed.
+
+    python benchmarks/ccd_rebuild.py --clients 50000 --workers 16
+"""
+
+import argparse
+import asyncio
+import ipaddress
+import logging
+import os
+import tempfile
+import time
+
+from sqlmodel import Session, SQLModel, create_engine
+
+from sciaiot.ovpncp.data.server import Client, Server, VirtualAddress
+from sciaiot.ovpncp.dependencies import ThreadedSession
+from sciaiot.ovpncp.utils import ccd, openvpn
+
+
+def seed(engine, clients: int):
+    SQLModel.metadata.create_all(engine)
+    network = ipaddress.ip_network("10.0.0.0/8")
+    hosts = network.hosts()
+    next(hosts)
+    with Session(engine) as session:
+        server = Server(
+            port="1194",
+            proto="udp",
+            dev="tun",
+            ca="ca.crt",
+            cert="server.crt",
+            key="server.key",
+            dh="dh.pem",
+            data_ciphers_fallback="AES-256-CBC",
+            topology="subnet",
+            network_address=str(network.network_address),
+            subnet_mask=str(network.netmask),
+            ip="10.0.0.1",
+            ifconfig_pool_persist="ipp.txt",
+            client_config_dir="/etc/openvpn/ccd",
+            keepalive="10 120",
+            status="openvpn-status.log",
+            log="openvpn.log",
+            verb="3",
+            explicit_exit_notify="1",
+        )
+        session.add(server)
+        session.flush()
+        session.add_all(
+            Client(
+                name=f"client_{i}",
+                cidr=f"192.168.{i % 256}.0/24" if i % 10 == 0 else None,
+                virtual_address=VirtualAddress(ip=str(next(hosts)), server_id=server.id),
+            )
+            for i in range(clients)
+        )
+        session.commit()
+
+
+def rebuild(engine, workers: int):
+    with Session(engine) as session:
+        start = time.perf_counter()
+        result = asyncio.run(ccd.rebuild_ccd(ThreadedSession(session), workers=workers))
+        return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=50000)
+    parser.add_argument("--workers", type=int, default=ccd.CCD_REBUILD_WORKERS)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(
+            f"sqlite:///{os.path.join(directory, 'ovpncp.db')}",
+            connect_args={"check_same_thread": False},
+        )
+        seed(engine, args.clients)
+        openvpn.openvpn_dir = directory
+        os.makedirs(os.path.join(directory, "ccd"))
+
+        print(f"{'run':<10}{'seconds':>10}{'written':>10}{'unchanged':>10}")
+        for run in ("cold", "warm"):
+            elapsed, result = rebuild(engine, args.workers)
+            print(
+                f"{run:<10}{elapsed:>10.2f}{result.written:>10}{result.unchanged:>10}"
+            )
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Measure the connection analytics over a large connection history.
+
+Seeds a day of random sessions over the clients, a tenth of them still open,
+then aggregates the day with the numpy sweep and the pure Python one.
+
+    python benchmarks/connection_stats.py --connections 1000000
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from sqlmodel import Session, SQLModel, create_engine, insert
+
+from sciaiot.ovpncp.data.server import Client, Connection
+from sciaiot.ovpncp.dependencies import ThreadedSession
+from sciaiot.ovpncp.utils import stats
+
+end = datetime(2025, 1, 15)
+start = end - timedelta(days=1)
+
+
+def seed(engine, clients: int, connections: int):
+    SQLModel.metadata.create_all(engine)
+    random.seed(0)
+    with Session(engine) as session:
+        session.add_all(Client(name=f"client_{i}") for i in range(clients))
+        session.commit()
+
+        rows = []
+        for i in range(connections):
+            connected_time = start + timedelta(seconds=random.uniform(0, 86400))
+            duration = timedelta(seconds=random.expovariate(1 / 1800))
+            rows.append(
+                {
+                    "client_id": random.randint(1, clients),
+                    "remote_address": f"10.0.{i % 256}.{i % 250}:1194",
+                    "connected_time": connected_time,
+                    "disconnected_time": None
+                    if i % 10 == 0
+                    else connected_time + duration,
+                }
+            )
+        session.exec(insert(Connection), params=rows)  # type: ignore
+        session.commit()
+
+
+def aggregate(engine) -> float:
+    with Session(engine) as session:
+        begin = time.perf_counter()
+        asyncio.run(
+            stats.connection_stats(ThreadedSession(session), start, end, 300, 10)
+        )
+        return time.perf_counter() - begin
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=10000)
+    parser.add_argument("--connections", type=int, default=1000000)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(
+            f"sqlite:///{os.path.join(directory, 'ovpncp.db')}",
+            connect_args={"check_same_thread": False},
+        )
+        seed(engine, args.clients, args.connections)
+
+        print(f"{'sweep':<10}{'seconds':>10}")
+        if stats.np is not None:
+            print(f"{'numpy':<10}{aggregate(engine):>10.2f}")
+        with patch.object(stats, "np", None):
+            print(f"{'python':<10}{aggregate(engine):>10.2f}")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
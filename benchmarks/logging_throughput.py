@@ -0,0 +1,75 @@
+"""Measure the cost of a log call in the request path.
+
+Logs JSON records to a file, as configured by `log.yml`, with the handlers
+called by the logging thread, as before, and behind the queue handler, whose
+listener thread formats & writes them in batches. The records are logged in
+bursts, as by a request, with a pause in between, as while the request awaits
+the database. Only the time spent in the calls is counted.
+
+    python benchmarks/logging_throughput.py --records 20000 --burst 5
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+import time
+from unittest.mock import patch
+
+from sciaiot.ovpncp.utils import logging as log_utils
+from sciaiot.ovpncp.utils.logging import JSONFormatter
+
+
+def measure(
+    path: str, records: int, burst: int, pause: float, queued: bool
+) -> tuple[float, int]:
+    logger = logging.Logger("benchmark")  # noqa: LOG001 - detached, not propagated
+    handler = logging.handlers.TimedRotatingFileHandler(path, when="D")
+    handler.setFormatter(JSONFormatter())
+    logger.addHandler(handler)
+    if queued:
+        log_utils.queue_handlers(logger)
+
+    elapsed = 0.0
+    for i in range(0, records, burst):
+        start = time.perf_counter()
+        for j in range(i, i + burst):
+            logger.info(f"Connection of client_{j % 100} started.")
+        elapsed += time.perf_counter() - start
+        time.sleep(pause)
+
+    dropped = logger.handlers[0].dropped if queued else 0  # type: ignore
+    log_utils.unqueue_handlers(logger)
+    handler.close()
+    return elapsed, dropped
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--burst", type=int, default=5)
+    parser.add_argument("--pause", type=float, default=0.001)
+    args = parser.parse_args()
+
+    print(f"{'handlers':<12}{'encoder':<10}{'us/call':>10}{'dropped':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "ovpncp.log")
+        runs = (
+            ("direct", False, None),
+            ("queued", True, None),
+            ("queued", True, log_utils.orjson),
+        )
+        for name, queued, encoder in runs:
+            if name == "queued" and log_utils.orjson is None:
+                encoder = None
+            with patch.object(log_utils, "orjson", encoder):
+                elapsed, dropped = measure(
+                    path, args.records, args.burst, args.pause, queued
+                )
+            label = "orjson" if encoder is not None else "json"
+            per_call = elapsed / args.records * 1e6
+            print(f"{name:<12}{label:<10}{per_call:>10.1f}{dropped:>10}")
+
+
+if __name__ == "__main__":
+    main()
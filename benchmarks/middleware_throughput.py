@@ -0,0 +1,100 @@
+"""Measure the throughput of a no-op endpoint through the middleware stacks.
+
+Replays concurrent requests against a route doing nothing, so the numbers
+reflect the middlewares only: without any, as when neither Azure service is
+configured, with the former `app.middleware("http")` functions, wrapped in
+`BaseHTTPMiddleware`, and with the plain ASGI ones. The token validation is
+stubbed, its own cost is measured by `token_validation.py`.
+
+    python benchmarks/middleware_throughput.py --requests 5000 --workers 50
+"""
+
+import argparse
+import asyncio
+import logging
+import tempfile
+import time
+from unittest.mock import patch
+
+import httpx
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse
+
+from sciaiot.ovpncp.middlewares import azure_security
+from sciaiot.ovpncp.middlewares.azure_security import AzureSecurityMiddleware
+from sciaiot.ovpncp.middlewares.storage import StorageMiddleware
+from sciaiot.ovpncp.utils.storage import LocalStorage
+
+# as configured for the former storage middleware, matching every request
+STORAGE_CONNECTION_STRING = "AccountName=bench"
+
+
+async def http_security_middleware(request: Request, call_next):
+    # as registered before, minus the logging
+    try:
+        request.state.token_payload = await azure_security.validate_token(request)
+    except HTTPException as e:
+        return JSONResponse(status_code=e.status_code, content={"detail": e.detail})
+    return await call_next(request)
+
+
+async def http_storage_middleware(request: Request, call_next):
+    # as registered before, matching the path of every request
+    url_path = request.url.path
+    if STORAGE_CONNECTION_STRING and url_path.endswith(
+        ("/package-cert", "download-cert")
+    ):
+        raise NotImplementedError
+    return await call_next(request)
+
+
+def build(stack: str) -> FastAPI:
+    app = FastAPI()
+    if stack == "http":
+        app.middleware("http")(http_security_middleware)
+        app.middleware("http")(http_storage_middleware)
+    elif stack == "asgi":
+        app.add_middleware(AzureSecurityMiddleware)
+        app.add_middleware(StorageMiddleware, backend=LocalStorage(tempfile.mkdtemp()))
+
+    @app.post("/clients/{client_name}/connections")
+    async def noop(client_name: str):
+        return {}
+
+    return app
+
+
+async def replay(app: FastAPI, requests: int, workers: int) -> float:
+    transport = httpx.ASGITransport(app=app)
+
+    async def worker(http: httpx.AsyncClient, worker_id: int):
+        for _ in range(requests // workers):
+            response = await http.post(f"/clients/client_{worker_id}/connections")
+            assert response.status_code == 200
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://ovpncp") as http:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(http, i) for i in range(workers)))
+        return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=50)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    with patch.object(azure_security, "validate_token", return_value={"sub": "bench"}):
+        print(f"{'stack':<8}{'seconds':>10}{'req/s':>10}")
+        for stack in ("none", "http", "asgi"):
+            app = build(stack)
+            # one round to warm up the routing & the clients
+            asyncio.run(replay(app, args.workers, args.workers))
+            elapsed = asyncio.run(replay(app, args.requests, args.workers))
+            rate = args.requests / elapsed
+            print(f"{stack:<8}{elapsed:>10.2f}{rate:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
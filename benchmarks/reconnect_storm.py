@@ -0,0 +1,145 @@
+"""Replay a reconnect storm through the single and the batched event endpoints.
+
+After a server restart every device disconnects and connects again at once.
+Each device fires its two hooks concurrently with the others, either through
+PUT/POST /clients/{name}/connections or POST /connections/events, where the
+writer coalesces concurrent requests into one transaction. Requests failing on
+an exhausted pool or a locked database are counted, not retried. Keep the
+concurrency near the pool size on the sync engine: beyond it, single requests
+stall while holding a pooled connection until the pool times out.
+
+    python benchmarks/reconnect_storm.py --devices 10000 --concurrency 50
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+MODES = ("single", "batched")
+
+
+def seed(devices: int):
+    from sqlmodel import Session, SQLModel
+
+    from sciaiot.ovpncp.data.cache import CacheVersion  # noqa: F401
+    from sciaiot.ovpncp.data.server import Client, Connection
+    from sciaiot.ovpncp.dependencies import engine
+
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        clients = [Client(name=f"device_{i}") for i in range(devices)]
+        session.add_all(clients)
+        session.flush()
+        session.add_all(
+            Connection(
+                client_id=client.id,
+                remote_address=f"10.{i // 65536}.{i // 256 % 256}.{i % 256}:1194",
+                connected_time=datetime.now(),
+            )
+            for i, client in enumerate(clients)
+        )
+        session.commit()
+
+
+async def storm(mode: str, devices: int, concurrency: int) -> tuple[float, int]:
+    import httpx
+    from fastapi import FastAPI
+
+    from sciaiot.ovpncp.routes import client, connection
+
+    app = FastAPI()
+    app.include_router(client.router)
+    app.include_router(connection.router)
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = 0
+
+    def check(response: httpx.Response):
+        nonlocal failures
+        if response.is_error or (mode == "batched" and response.json()["rejected"]):
+            failures += 1
+
+    async def reconnect(http: httpx.AsyncClient, i: int):
+        name = f"device_{i}"
+        address = f"10.{i // 65536}.{i // 256 % 256}.{i % 256}:1194"
+        now = datetime.now().isoformat()
+        async with semaphore:
+            if mode == "single":
+                check(
+                    await http.put(
+                        f"/clients/{name}/connections",
+                        json={"remote_address": address, "disconnected_time": now},
+                    )
+                )
+                check(
+                    await http.post(
+                        f"/clients/{name}/connections",
+                        json={"remote_address": address, "connected_time": now},
+                    )
+                )
+            else:
+                event = {"client_name": name, "remote_address": address, "time": now}
+                for type in ("disconnect", "connect"):
+                    check(
+                        await http.post(
+                            "/connections/events", json=[{"type": type, **event}]
+                        )
+                    )
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+        start = time.perf_counter()
+        await asyncio.gather(*(reconnect(http, i) for i in range(devices)))
+        return time.perf_counter() - start, failures
+
+
+def run_mode(args):
+    logging.disable(logging.INFO)
+    seed(args.devices)
+    elapsed, failures = asyncio.run(storm(args.mode, args.devices, args.concurrency))
+    result = {"events": args.devices * 2, "seconds": elapsed, "failures": failures}
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--mode", choices=MODES)
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args)
+        return
+
+    print(f"{'mode':<10}{'events':>10}{'seconds':>10}{'events/s':>10}{'failed':>10}")
+    for mode in MODES:
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(os.environ)
+            path = os.path.join(directory, "ovpncp.db")
+            env["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{path}"
+            output = subprocess.run(
+                [sys.executable, __file__, "--mode", mode]
+                + ["--devices", str(args.devices)]
+                + ["--concurrency", str(args.concurrency)],
+                env=env,
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            result = json.loads(output.splitlines()[-1])
+            rate = result["events"] / result["seconds"]
+            print(
+                f"{mode:<10}{result['events']:>10}"
+                f"{result['seconds']:>10.2f}{rate:>10.0f}{result['failures']:>10}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Compare the sync and the asyncio database sessions under hook load.
+
+Every worker replays connect & disconnect hooks of random clients against the
+client routes, so the numbers reflect the session handling only: no middleware,
+no OpenVPN calls. Each mode runs in its own process because the engine is
+picked from SQLALCHEMY_DATABASE_URI at import time.
+
+    python benchmarks/session_throughput.py --clients 200 --workers 50
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+MODES = {
+    "sync": "sqlite:///{path}",
+    "async": "sqlite+aiosqlite:///{path}",
+}
+
+
+def seed(clients: int):
+    from sqlmodel import Session, SQLModel
+
+    from sciaiot.ovpncp.data.cache import CacheVersion  # noqa: F401
+    from sciaiot.ovpncp.data.server import Client
+    from sciaiot.ovpncp.dependencies import engine
+
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add_all(Client(name=f"client_{i}") for i in range(clients))
+        session.commit()
+
+
+async def replay(clients: int, workers: int, hooks: int) -> float:
+    import httpx
+    from fastapi import FastAPI
+
+    from sciaiot.ovpncp.routes import client
+
+    app = FastAPI()
+    app.include_router(client.router)
+    transport = httpx.ASGITransport(app=app)
+
+    async def worker(http: httpx.AsyncClient, worker_id: int):
+        for i in range(hooks):
+            name = f"client_{random.randrange(clients)}"
+            address = f"172.16.{worker_id % 256}.{i % 256}:{1024 + i}"
+            now = datetime.now().isoformat()
+            response = await http.post(
+                f"/clients/{name}/connections",
+                json={"remote_address": address, "connected_time": now},
+            )
+            response.raise_for_status()
+            response = await http.put(
+                f"/clients/{name}/connections",
+                json={"remote_address": address, "disconnected_time": now},
+            )
+            response.raise_for_status()
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(http, w) for w in range(workers)))
+        return time.perf_counter() - start
+
+
+def run_mode(args):
+    logging.disable(logging.INFO)
+    seed(args.clients)
+    elapsed = asyncio.run(replay(args.clients, args.workers, args.hooks))
+    requests = args.workers * args.hooks * 2
+    print(json.dumps({"mode": args.mode, "requests": requests, "seconds": elapsed}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=50)
+    parser.add_argument("--hooks", type=int, default=20)
+    parser.add_argument("--mode", choices=MODES.keys())
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args)
+        return
+
+    print(f"{'mode':<8}{'requests':>10}{'seconds':>10}{'req/s':>10}")
+    for mode, uri in MODES.items():
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(os.environ)
+            path = os.path.join(directory, "ovpncp.db")
+            env["SQLALCHEMY_DATABASE_URI"] = uri.format(path=path)
+            output = subprocess.run(
+                [sys.executable, __file__, "--mode", mode]
+                + ["--clients", str(args.clients)]
+                + ["--workers", str(args.workers), "--hooks", str(args.hooks)],
+                env=env,
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            result = json.loads(output.splitlines()[-1])
+            rate = result["requests"] / result["seconds"]
+            print(
+                f"{mode:<8}{result['requests']:>10}"
+                f"{result['seconds']:>10.2f}{rate:>10.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
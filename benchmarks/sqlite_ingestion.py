@@ -0,0 +1,100 @@
+"""Measure connection-hook ingestion on SQLite with and without tuning.
+
+Each worker thread replays connect & disconnect hooks the way the routes do:
+insert a connection, look it up again and close it, committing every step.
+The tuned profile is read from the SQLITE_* environment variables, so any
+setting can be tried before rolling it out.
+
+    SQLITE_SYNCHRONOUS=FULL python benchmarks/sqlite_ingestion.py --workers 32
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, SQLModel, create_engine, select
+
+from sciaiot.ovpncp.data.server import Client, Connection
+from sciaiot.ovpncp.dependencies import sqlite_pragmas, tune_sqlite
+
+
+def replay_hooks(engine, client_id: int, worker: int, hooks: int) -> int:
+    errors = 0
+    for i in range(hooks):
+        address = f"172.16.{worker % 256}.{i % 256}:{1024 + i}"
+        try:
+            with Session(engine) as session:
+                session.add(
+                    Connection(
+                        client_id=client_id,
+                        remote_address=address,
+                        connected_time=datetime.now(),
+                    )
+                )
+                session.commit()
+
+                statement = select(Connection).where(
+                    Connection.client_id == client_id,
+                    Connection.remote_address == address,
+                    Connection.disconnected_time == None,
+                )
+                connection = session.exec(statement).one()
+                connection.disconnected_time = datetime.now()
+                session.add(connection)
+                session.commit()
+        except OperationalError:
+            errors += 1
+    return errors
+
+
+def run_profile(name: str, tuned: bool, workers: int, hooks: int):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "ovpncp.db")
+        engine = create_engine(
+            f"sqlite:///{path}",
+            connect_args={"check_same_thread": False},
+            pool_size=workers,
+        )
+        if tuned:
+            tune_sqlite(engine, sqlite_pragmas())
+
+        SQLModel.metadata.create_all(engine)
+        with Session(engine) as session:
+            client = Client(name="client_1")
+            session.add(client)
+            session.commit()
+            client_id = client.id
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(replay_hooks, engine, client_id, w, hooks)
+                for w in range(workers)
+            ]
+            errors = sum(f.result() for f in futures)
+        elapsed = time.perf_counter() - start
+        engine.dispose()
+
+    rate = workers * hooks / elapsed
+    print(f"{name:<10}{elapsed:>10.2f}{rate:>12.0f}{errors:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--hooks", type=int, default=100)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    print(f"{'profile':<10}{'seconds':>10}{'hooks/s':>12}{'locked':>10}")
+    run_profile("default", False, args.workers, args.hooks)
+    run_profile("tuned", True, args.workers, args.hooks)
+
+
+if __name__ == "__main__":
+    main()
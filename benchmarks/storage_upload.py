@@ -0,0 +1,86 @@
+"""Measure the uploads of the cert bundles to the storage backend.
+
+Uploads bundles to a local directory standing in for the remote storage,
+with a delay per upload to mimic the round-trip, while a ticker measures how
+long the event loop is held: with the backend called on the loop, as the
+middleware did before, off the loop, and again with the bundles unchanged,
+which are skipped by their digest.
+
+    python benchmarks/storage_upload.py --bundles 50 --size 65536 --latency 0.02
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+from sciaiot.ovpncp.utils.storage import LocalStorage
+
+
+class RemoteStandIn(LocalStorage):
+    def __init__(self, directory: str, latency: float):
+        super().__init__(directory)
+        self.latency = latency
+
+    def write(self, name: str, file_path: str, digest: str):
+        time.sleep(self.latency)
+        super().write(name, file_path, digest)
+
+
+async def ticker(stopped: asyncio.Event, lags: list[float]):
+    while not stopped.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append(time.perf_counter() - start - 0.001)
+
+
+async def upload(backend: LocalStorage, bundles: list[str], blocking: bool):
+    stopped = asyncio.Event()
+    lags: list[float] = []
+    task = asyncio.create_task(ticker(stopped, lags))
+    await asyncio.sleep(0.01)
+    start = time.perf_counter()
+    for i, path in enumerate(bundles):
+        if blocking:
+            backend.put(f"client_{i}.zip", path)
+            # back to the loop between the requests
+            await asyncio.sleep(0)
+        else:
+            await backend.upload(f"client_{i}.zip", path)
+    elapsed = time.perf_counter() - start
+    stopped.set()
+    await task
+    return elapsed, max(lags, default=0.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bundles", type=int, default=50)
+    parser.add_argument("--size", type=int, default=65536)
+    parser.add_argument("--latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    with tempfile.TemporaryDirectory() as directory:
+        bundles = []
+        for i in range(args.bundles):
+            path = os.path.join(directory, f"bundle_{i}.zip")
+            with open(path, "wb") as f:
+                f.write(os.urandom(args.size))
+            bundles.append(path)
+
+        print(f"{'mode':<12}{'seconds':>10}{'max lag ms':>12}")
+        for name, blocking in (("blocking", True), ("threadpool", False)):
+            backend = RemoteStandIn(tempfile.mkdtemp(dir=directory), args.latency)
+            elapsed, lag = asyncio.run(upload(backend, bundles, blocking))
+            print(f"{name:<12}{elapsed:>10.2f}{lag * 1000:>12.1f}")
+
+        # the same bundles packaged again
+        elapsed, lag = asyncio.run(upload(backend, bundles, False))
+        print(f"{'unchanged':<12}{elapsed:>10.2f}{lag * 1000:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
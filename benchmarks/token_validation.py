@@ -0,0 +1,126 @@
+"""Measure the token validation with & without the caches.
+
+Serves the keys from a local stand-in of the JWKS endpoint, delayed to mimic
+the round-trip to the identity provider, then validates the same token with a
+fetch per request, as before the caches, with the signing keys cached and
+with the verified tokens cached too.
+
+    python benchmarks/token_validation.py --requests 200 --latency 0.15
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import MagicMock, patch
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fastapi import Request
+from jose import jwk, jwt
+
+from sciaiot.ovpncp.middlewares import azure_security
+from sciaiot.ovpncp.utils.jwks import JwksCache, VerifiedTokenCache
+
+TENANT_ID = "benchmark_tenant"
+APP_CLIENT_ID = "benchmark_app"
+APP_ROLE = "benchmark_role"
+
+
+def serve_keys(keys: list[dict], latency: float) -> ThreadingHTTPServer:
+    body = json.dumps({"keys": keys}).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+def issue_token() -> tuple[str, dict]:
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+    public = jwk.construct(pem, "RS256").public_key().to_dict()
+    public.update({"kid": "key_1", "use": "sig"})
+    claims = {
+        "aud": APP_CLIENT_ID,
+        "iss": f"https://login.microsoftonline.com/{TENANT_ID}/v2.0",
+        "exp": int(time.time()) + 3600,
+        "roles": [APP_ROLE],
+    }
+    token = jwt.encode(claims, pem, algorithm="RS256", headers={"kid": "key_1"})
+    return token, public
+
+
+def measure(token: str, requests: int, keys: bool, tokens: bool) -> list[float]:
+    request = MagicMock(spec=Request)
+    request.headers.get.return_value = f"Bearer {token}"
+    cache = JwksCache()
+    token_cache = VerifiedTokenCache(1024 if tokens else 0)
+    timings = []
+
+    async def run():
+        for _ in range(requests):
+            if not keys:
+                cache.keys, cache.attempted_at = {}, float("-inf")
+            start = time.perf_counter()
+            await azure_security.validate_token(request)
+            timings.append((time.perf_counter() - start) * 1000)
+
+    with (
+        patch.object(azure_security, "jwks_cache", cache),
+        patch.object(azure_security, "token_cache", token_cache),
+    ):
+        asyncio.run(run())
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.15)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    token, public = issue_token()
+    httpd = serve_keys([public], args.latency)
+    url = f"http://127.0.0.1:{httpd.server_port}/keys"
+    with (
+        patch.object(azure_security, "JWKS_URL", url),
+        patch.object(azure_security, "TENANT_ID", TENANT_ID),
+        patch.object(azure_security, "APP_CLIENT_ID", APP_CLIENT_ID),
+        patch.object(azure_security, "APP_ROLE", APP_ROLE),
+    ):
+        print(f"{'cached':<10}{'mean ms':>10}{'p95 ms':>10}")
+        runs = (
+            ("fetched", False, False),
+            ("keys", True, False),
+            ("tokens", True, True),
+        )
+        for name, keys, tokens in runs:
+            timings = measure(token, args.requests, keys, tokens)
+            p95 = statistics.quantiles(timings, n=20)[-1]
+            print(f"{name:<10}{statistics.mean(timings):>10.2f}{p95:>10.2f}")
+
+    httpd.shutdown()
+
+
+if __name__ == "__main__":
+    main()
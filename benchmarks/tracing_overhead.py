@@ -0,0 +1,58 @@
+"""Measure the overhead of the spans, out of a trace and within one.
+
+Calls a traced function, which opens a span around a command as the utils
+do, bare, out of a trace as when tracing is disabled, and within the trace
+of a request. The trace is ended per call, fast enough to be dropped by the
+tail sampling, so the exporter is never involved.
+
+    python benchmarks/tracing_overhead.py --number 100000
+"""
+
+import argparse
+import timeit
+
+from sciaiot.ovpncp.utils.tracing import SpanExporter, Tracer, span, traced
+
+
+def apply_rule():
+    return 0
+
+
+@traced()
+def traced_apply_rule():
+    with span("command iptables", attributes={"process.command": "iptables"}):
+        return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=100000)
+    args = parser.parse_args()
+
+    def per_call(statement) -> float:
+        timings = timeit.repeat(statement, number=args.number, repeat=3)
+        return min(timings) / args.number * 1e6
+
+    tracer = Tracer(SpanExporter(), slow_ms=float("inf"))
+
+    def in_trace():
+        root = tracer.start("POST /networks")
+        with root:
+            traced_apply_rule()
+        tracer.finish(root)
+
+    def empty_trace():
+        root = tracer.start("POST /networks")
+        with root:
+            apply_rule()
+        tracer.finish(root)
+
+    bare = per_call(apply_rule)
+    disabled = per_call(traced_apply_rule)
+    traced_call = per_call(in_trace) - per_call(empty_trace)
+    print(f"{'bare us':>10}{'disabled us':>14}{'traced us':>12}")
+    print(f"{bare:>10.3f}{disabled:>14.3f}{traced_call:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+from sqlmodel import Field, SQLModel
+
+
+class CacheVersion(SQLModel, table=True):
+    name: str = Field(primary_key=True)
+    version: int = 0
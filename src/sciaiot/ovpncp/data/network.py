@@ -7,7 +7,7 @@ BROADCAST_ADDRESS = "255.255.255.255"
 
 class RestrictedNetwork(SQLModel, table=True):
     id: int = Field(default=None, primary_key=True)
-    source_name: str
+    source_name: str = Field(index=True)
     source_virtual_address: str
     destination_name: str
     destination_virtual_address: str
@@ -1,7 +1,7 @@
-from datetime import datetime
-from typing import Optional
+from datetime import date, datetime
+from typing import Literal, Optional
 
-from sqlalchemy import Column, String
+from sqlalchemy import Column, Index, String, text
 from sqlmodel import Field, Relationship, SQLModel
 
 
@@ -45,7 +45,7 @@ class VirtualAddressBase(SQLModel):
 class VirtualAddress(VirtualAddressBase, table=True):
     id: int | None = Field(default=None, primary_key=True)
     ip: str = Field(sa_column=Column("ip", String, unique=True))
-    server_id: int = Field(default=None, foreign_key="server.id")
+    server_id: int = Field(default=None, foreign_key="server.id", index=True)
     server: Server = Relationship(back_populates="virtual_addresses")
     client: Optional["Client"] = Relationship(
         sa_relationship_kwargs={"uselist": False}, back_populates="virtual_address"
@@ -84,7 +84,7 @@ class CertBase(SQLModel):
 
 class Cert(CertBase, table=True):
     id: int = Field(default=None, primary_key=True)
-    client_id: int = Field(default=None, foreign_key="client.id")
+    client_id: int = Field(default=None, foreign_key="client.id", index=True)
     client: Client = Relationship(
         sa_relationship_kwargs={"uselist": False}, back_populates="cert"
     )
@@ -97,16 +97,113 @@ class ConnectionBase(SQLModel):
 
 
 class Connection(ConnectionBase, table=True):
+    __table_args__ = (
+        # open connections of a client, looked up by the disconnect hook
+        Index(
+            "ix_connection_open",
+            "client_id",
+            "remote_address",
+            "connected_time",
+            sqlite_where=text("disconnected_time IS NULL"),
+            postgresql_where=text("disconnected_time IS NULL"),
+        ),
+        # connection history of a client, paginated by id
+        Index("ix_connection_client_history", "client_id", "id"),
+        # closed connections past the retention, purged oldest first
+        Index("ix_connection_disconnected_time", "disconnected_time"),
+    )
+
     id: int = Field(default=None, primary_key=True)
     client_id: int = Field(default=None, foreign_key="client.id")
     client: Client = Relationship(back_populates="connections")
 
 
+class ConnectionRollupBase(SQLModel):
+    day: date
+    sessions: int = 0
+    seconds: float = 0
+
+
+class ConnectionRollup(ConnectionRollupBase, table=True):
+    """Daily sessions of a client, kept once its connections are purged."""
+
+    __table_args__ = (
+        Index("ix_connectionrollup_client_day", "client_id", "day", unique=True),
+    )
+
+    id: int = Field(default=None, primary_key=True)
+    client_id: int = Field(default=None, foreign_key="client.id")
+
+
 class ClientWithVirtualAddress(ClientBase):
     virtual_address: VirtualAddress | None
 
 
+class ClientSummary(ClientBase):
+    id: int
+    virtual_address: VirtualAddressBase | None = None
+    cert: CertBase | None = None
+
+
 class ClientDetails(ClientBase):
     virtual_address: VirtualAddressBase | None
     cert: CertBase
     connections: list[ConnectionBase] = []
+    connections_cursor: int | None = None
+
+
+class ConnectionEvent(SQLModel):
+    type: Literal["connect", "disconnect"]
+    client_name: str
+    remote_address: str
+    time: datetime
+
+
+class RejectedConnectionEvent(SQLModel):
+    index: int
+    detail: str
+
+
+class ConnectionEventsResult(SQLModel):
+    accepted: int = 0
+    rejected: list[RejectedConnectionEvent] = []
+
+
+class ReconcileResult(SQLModel):
+    closed: int = 0
+    opened: int = 0
+    unknown_clients: list[str] = []
+
+
+class CcdRebuildResult(SQLModel):
+    written: int = 0
+    unchanged: int = 0
+    removed: int = 0
+
+
+class ClientSessionCount(SQLModel):
+    client_name: str
+    sessions: int
+
+
+class ConcurrencyPoint(SQLModel):
+    time: datetime
+    connections: int
+
+
+class ConnectionStats(SQLModel):
+    start: datetime
+    end: datetime
+    active: int = 0
+    sessions: int = 0
+    peak: int = 0
+    # seconds of the sessions closed, keyed by p50, p95 & p99
+    durations: dict[str, float] = {}
+    clients: list[ClientSessionCount] = []
+    concurrency: list[ConcurrencyPoint] = []
+
+
+class RetentionResult(SQLModel):
+    rolled_up: int = 0
+    deleted: int = 0
+    dropped_partitions: list[str] = []
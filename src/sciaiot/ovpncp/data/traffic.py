@@ -0,0 +1,21 @@
+from datetime import datetime
+
+from sqlalchemy import Index
+from sqlmodel import Field, SQLModel
+
+
+class TrafficPoint(SQLModel):
+    time: datetime
+    bytes_received: int = 0
+    bytes_sent: int = 0
+
+
+class TrafficSample(TrafficPoint, table=True):
+    __table_args__ = (
+        # traffic of a client in one tier, ranged by time
+        Index("ix_trafficsample_client_step_time", "client_id", "step", "time"),
+    )
+
+    id: int = Field(default=None, primary_key=True)
+    client_id: int = Field(foreign_key="client.id")
+    step: int
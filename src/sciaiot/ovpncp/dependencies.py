@@ -5,21 +5,172 @@ import shutil
 import stat
 from pathlib import Path
 
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from sciaiot.ovpncp.utils import tracing
+from sciaiot.ovpncp.utils.cache import seed_versions
+from sciaiot.ovpncp.utils.context import time_queries
+from sciaiot.ovpncp.utils.metrics import instrument_engine
 
 logger = logging.getLogger(__name__)
 
 app_directory = "/opt/ovpncp"
 certs_directory = f"{app_directory}/certs"
 scripts_directory = f"{app_directory}/scripts"
+spool_directory = f"{app_directory}/spool"
 sqlite_uri = f"sqlite:///{app_directory}/ovpncp.db"
 
+SQLITE_JOURNAL_MODES = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+SQLITE_SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+# async drivers and the sync drivers used for DDL on the same database
+ASYNC_DRIVERS = {
+    "aiosqlite": "pysqlite",
+    "asyncpg": "psycopg2",
+    "aiomysql": "mysqlconnector",
+}
+
+
+def is_async_uri(uri: str) -> bool:
+    """Check whether the database URI selects an asyncio driver."""
+    return make_url(uri).get_driver_name() in ASYNC_DRIVERS
+
+
+def to_sync_uri(uri: str) -> str:
+    """Swap the asyncio driver of the database URI for its sync counterpart."""
+    url = make_url(uri)
+    driver = ASYNC_DRIVERS.get(url.get_driver_name())
+    if driver:
+        url = url.set(drivername=f"{url.get_backend_name()}+{driver}")
+    return url.render_as_string(hide_password=False)
+
+
+def sqlite_pragmas() -> dict[str, str]:
+    """Read the SQLite tuning profile from the environment."""
+    pragmas = {
+        "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL").upper(),
+        "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").upper(),
+        "busy_timeout": os.getenv("SQLITE_BUSY_TIMEOUT", "5000"),
+        "mmap_size": os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)),
+        # negative values are in KiB, i.e. 64 MiB of page cache
+        "cache_size": os.getenv("SQLITE_CACHE_SIZE", "-65536"),
+    }
+
+    if pragmas["journal_mode"] not in SQLITE_JOURNAL_MODES:
+        raise ValueError(f"Invalid SQLite journal mode '{pragmas['journal_mode']}'!")
+    if pragmas["synchronous"] not in SQLITE_SYNCHRONOUS_MODES:
+        raise ValueError(f"Invalid SQLite synchronous '{pragmas['synchronous']}'!")
+    for name in ("busy_timeout", "mmap_size", "cache_size"):
+        # validate as integer, the pragmas are formatted into the statement
+        pragmas[name] = str(int(pragmas[name]))
+
+    return pragmas
+
+
+def tune_sqlite(engine: Engine, pragmas: dict[str, str]):
+    """Apply the pragmas on every new connection of the SQLite engine."""
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+def observe_queries(engine: Engine, name: str):
+    """Time the queries per request & in the metrics, traced when enabled."""
+    time_queries(engine)
+    instrument_engine(engine, name)
+    if tracing.is_enabled():
+        tracing.trace_queries(engine)
+
+
+def engine_options(uri: str) -> dict:
+    """Build the engine arguments for the database of the URI."""
+    if make_url(uri).get_backend_name() == "sqlite":
+        if is_async_uri(uri):
+            return {}
+        return {"connect_args": {"check_same_thread": False}}
+
+    return {
+        "pool_size": int(os.getenv("SQLALCHEMY_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("SQLALCHEMY_MAX_OVERFLOW", "10")),
+        "pool_recycle": int(os.getenv("SQLALCHEMY_POOL_RECYCLE", "3600")),
+        "pool_pre_ping": True,
+    }
+
 
 database_uri = os.getenv("SQLALCHEMY_DATABASE_URI", sqlite_uri)
-connect_args = {}
-if database_uri.startswith("sqlite"):
-    connect_args["check_same_thread"] = False
-engine = create_engine(database_uri, echo=False, connect_args=connect_args)
+async_mode = is_async_uri(database_uri)
+sync_database_uri = to_sync_uri(database_uri)
+engine = create_engine(
+    sync_database_uri, echo=False, **engine_options(sync_database_uri)
+)
+
+async_engine = None
+if async_mode:
+    async_engine = create_async_engine(
+        database_uri, echo=False, **engine_options(database_uri)
+    )
+    logger.info("Using the asyncio database engine.")
+
+# the time in the queries, per request, in the metrics & the traces
+observe_queries(engine, "sync")
+if async_engine is not None:
+    observe_queries(async_engine.sync_engine, "async")
+
+if engine.dialect.name == "sqlite":
+    pragmas = sqlite_pragmas()
+    tune_sqlite(engine, pragmas)
+    if async_engine is not None:
+        tune_sqlite(async_engine.sync_engine, pragmas)
+
+
+class ThreadedSession:
+    """Awaitable facade over a sync session, running the I/O in the threadpool.
+
+    It mirrors the subset of AsyncSession used by the routes, so the same
+    handlers serve both the sync and the asyncio engine.
+    """
+
+    def __init__(self, session: Session):
+        self.sync_session = session
+
+    def add(self, instance):
+        self.sync_session.add(instance)
+
+    def add_all(self, instances):
+        self.sync_session.add_all(instances)
+
+    async def exec(self, statement):
+        return await run_in_threadpool(self.sync_session.exec, statement)
+
+    async def execute(self, statement, params=None):
+        return await run_in_threadpool(self.sync_session.execute, statement, params)
+
+    async def get(self, entity, ident):
+        return await run_in_threadpool(self.sync_session.get, entity, ident)
+
+    async def delete(self, instance):
+        await run_in_threadpool(self.sync_session.delete, instance)
+
+    async def flush(self):
+        await run_in_threadpool(self.sync_session.flush)
+
+    async def commit(self):
+        await run_in_threadpool(self.sync_session.commit)
+
+    async def rollback(self):
+        await run_in_threadpool(self.sync_session.rollback)
+
+    async def refresh(self, instance, attribute_names=None):
+        await run_in_threadpool(self.sync_session.refresh, instance, attribute_names)
 
 
 def create_app_directory():
@@ -28,26 +179,53 @@ def create_app_directory():
         os.makedirs(certs_directory)
         logger.info("Created the app directory & subdirectories.")
 
+    if not os.path.exists(spool_directory):
+        os.makedirs(spool_directory)
+        logger.info("Created the spool directory for connection events.")
+
 
 def create_tables():
     SQLModel.metadata.create_all(engine)
+    seed_versions(engine)
     logger.info("Created all tables, existing ones will be skipped.")
 
 
+def create_indexes():
+    """Create the indexes missing on tables created by an older release."""
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    logger.info("Created all indexes, existing ones will be skipped.")
+
+
 def get_session():
     with Session(engine) as session:
         yield session
 
 
+async def get_async_session():
+    """Yield an awaitable session on the asyncio or the sync engine."""
+    if async_engine is not None:
+        async with AsyncSession(async_engine, expire_on_commit=False) as session:
+            yield session
+    else:
+        session = Session(engine, expire_on_commit=False)
+        try:
+            yield ThreadedSession(session)
+        finally:
+            await run_in_threadpool(session.close)
+
+
 def init_scripts():
+    """Install the hook scripts, replacing the ones changed by an upgrade."""
     target_folder = Path(scripts_directory)
+    target_folder.mkdir(parents=True, exist_ok=True)
     with importlib.resources.path("sciaiot.ovpncp", "scripts") as source_path:
-        if target_folder.exists():
-            return
-
-        shutil.copytree(source_path, target_folder)
-        logger.info("Copied scripts to the app directory.")
+        for source in source_path.glob("*.sh"):
+            path = target_folder / source.name
+            if path.exists() and path.read_bytes() == source.read_bytes():
+                continue
 
-        for path in target_folder.rglob("*.sh"):
+            shutil.copyfile(source, path)
             path.chmod(path.stat().st_mode | stat.S_IEXEC)
-            logger.info(f"Made script {path} executable.")
+            logger.info(f"Installed script {path}.")
@@ -1,3 +1,5 @@
+import asyncio
+import atexit
 import importlib.resources
 import logging
 import logging.config
@@ -7,15 +9,31 @@ from contextlib import asynccontextmanager
 import uvicorn
 import yaml
 from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
 
 from sciaiot.ovpncp.dependencies import (
     create_app_directory,
+    create_indexes,
     create_tables,
     init_scripts,
 )
-from sciaiot.ovpncp.middlewares.azure_security import azure_security_middleware
-from sciaiot.ovpncp.middlewares.azure_storage import azure_storage_middleware
-from sciaiot.ovpncp.routes import client, network, server
+from sciaiot.ovpncp.middlewares import azure_security
+from sciaiot.ovpncp.middlewares.azure_security import AzureSecurityMiddleware
+from sciaiot.ovpncp.middlewares.request_context import RequestContextMiddleware
+from sciaiot.ovpncp.middlewares.storage import StorageMiddleware
+from sciaiot.ovpncp.middlewares.tracing import TracingMiddleware
+from sciaiot.ovpncp.routes import client, connection, metrics, network, server
+from sciaiot.ovpncp.utils import ccd
+from sciaiot.ovpncp.utils import metrics as prometheus_metrics
+from sciaiot.ovpncp.utils.context import install_record_factory
+from sciaiot.ovpncp.utils.jwks import jwks_cache
+from sciaiot.ovpncp.utils.logging import queue_handlers, unqueue_handlers
+from sciaiot.ovpncp.utils.reconcile import reconciler
+from sciaiot.ovpncp.utils.retention import retention_worker
+from sciaiot.ovpncp.utils.spool import spool_reader
+from sciaiot.ovpncp.utils.storage import StorageBackend, storage_backend
+from sciaiot.ovpncp.utils.tracing import Tracer, tracer
+from sciaiot.ovpncp.utils.traffic import traffic_sampler
 
 log_config_path = importlib.resources.files("sciaiot.ovpncp").joinpath("log.yml")
 
@@ -31,10 +49,16 @@ def setup_logging():
         for handler in config.get("handlers", {}).values():
             handler["formatter"] = log_format
 
+    install_record_factory()
+    root = logging.getLogger()
+    unqueue_handlers(root)
     logging.config.dictConfig(config)
+    # formatted & written by a thread, out of the request path
+    queue_handlers(root)
 
 
 setup_logging()
+atexit.register(unqueue_handlers, logging.getLogger())
 logger = logging.getLogger(__name__)
 
 
@@ -43,25 +67,81 @@ async def lifespan(app: FastAPI):
     # startup
     create_app_directory()
     create_tables()
+    create_indexes()
     init_scripts()
+    if azure_security.is_configured():
+        try:
+            await run_in_threadpool(jwks_cache.warm, azure_security.get_jwks_url())
+        except Exception as e:  # noqa: BLE001 - fetched again by the requests
+            logger.error(f"Failed to fetch the signing keys: {e}")
+    spool_task = asyncio.create_task(spool_reader.run())
+    reconcile_task = None
+    if reconciler.interval > 0:
+        reconcile_task = asyncio.create_task(reconciler.run())
+    retention_task = None
+    if retention_worker.days > 0:
+        retention_task = asyncio.create_task(retention_worker.run())
+    traffic_task = None
+    if traffic_sampler.interval > 0:
+        traffic_task = asyncio.create_task(traffic_sampler.run())
+    ccd_task = None
+    if ccd.is_dynamic():
+        ccd_task = asyncio.create_task(ccd.client_configs.run())
     logger.info("Startup events finished.")
 
     yield
 
     # shutdown
+    if ccd_task is not None:
+        ccd.client_configs.stop()
+        await ccd_task
+    spool_reader.stop()
+    await spool_task
+    if reconcile_task is not None:
+        reconciler.stop()
+        await reconcile_task
+    if retention_task is not None:
+        retention_worker.stop()
+        await retention_task
+    if traffic_task is not None:
+        traffic_sampler.stop()
+        await traffic_task
+    prometheus_metrics.mark_process_dead()
+    if tracer is not None:
+        await run_in_threadpool(tracer.exporter.close)
     logger.info("Shutdown events finished.")
 
 
-app = FastAPI(lifespan=lifespan)
+def add_middlewares(
+    app: FastAPI, storage_backend: StorageBackend | None, tracer: Tracer | None
+):
+    """Stack the middlewares, each one added wrapping the ones before it.
+
+    The optional ones are only in the stack when configured; the security
+    one fails closed unless disabled explicitly. It wraps the storage one,
+    which answers the cached downloads without going further.
+    """
+    if storage_backend is not None:
+        app.add_middleware(StorageMiddleware, backend=storage_backend)
+    if azure_security.is_enabled():
+        app.add_middleware(AzureSecurityMiddleware, paths=azure_security.SECURED_PATHS)
+    if tracer is not None:
+        app.add_middleware(TracingMiddleware, tracer=tracer)
+    # outermost, its context covers the other middlewares
+    app.add_middleware(RequestContextMiddleware)
 
-# optional middlewares
-app.middleware("http")(azure_security_middleware)
-app.middleware("http")(azure_storage_middleware)
 
-app.include_router(server.router, prefix="/server", tags=["server"])
-app.include_router(client.router, prefix="/clients", tags=["client"])
-app.include_router(network.router, prefix="/networks", tags=["server"])
+app = FastAPI(lifespan=lifespan)
+add_middlewares(app, storage_backend, tracer)
+
+app.include_router(server.router, tags=["server"])
+app.include_router(client.router, tags=["client"])
+app.include_router(network.router, tags=["server"])
+app.include_router(connection.router, tags=["connection"])
+if prometheus_metrics.is_enabled():
+    app.include_router(metrics.router, tags=["metrics"])
 
 
 def run():
-    uvicorn.run(app, host="127.0.0.1", port=8000, log_config=str(log_config_path))
+    # configured by setup_logging already, the uvicorn loggers propagate to it
+    uvicorn.run(app, host="127.0.0.1", port=8000, log_config=None)
@@ -1,21 +1,55 @@
-import json
 import logging
 import os
-from urllib.request import urlopen
+from collections.abc import Sequence
 
-from fastapi import HTTPException, Request, status
+from fastapi import HTTPException, Request, WebSocket, status
 from fastapi.responses import JSONResponse
 from jose import jwt
 from jose.exceptions import ExpiredSignatureError, JWTClaimsError
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from sciaiot.ovpncp.utils.context import timed
+from sciaiot.ovpncp.utils.jwks import jwks_cache, token_cache
 
 logger = logging.getLogger(__name__)
 
 TENANT_ID = os.environ.get("AZURE_IDENTITY_TENANT_ID")
 APP_CLIENT_ID = os.environ.get("AZURE_IDENTITY_APP_CLIENT_ID")
 APP_ROLE = os.environ.get("AZURE_IDENTITY_APP_ROLE")
+# the explicit opt-out, the requests failing closed while not configured
+DISABLED = os.environ.get("AZURE_SECURITY_DISABLED", "") == "1"
+# the signing keys of the tenant by default, or a stand-in of them
+JWKS_URL = os.environ.get("AZURE_IDENTITY_JWKS_URL")
+# comma separated path prefixes requiring a token, all of them by default
+SECURED_PATHS = tuple(
+    path.strip()
+    for path in os.environ.get("AZURE_IDENTITY_SECURED_PATHS", "/").split(",")
+    if path.strip()
+)
+
+
+def is_configured() -> bool:
+    return all([TENANT_ID, APP_CLIENT_ID, APP_ROLE])
+
+
+def is_enabled() -> bool:
+    # not configured is still enabled, failing the requests until fixed
+    return not DISABLED
+
+
+def is_secured(path: str) -> bool:
+    return is_enabled() and path.startswith(SECURED_PATHS)
+
+
+def get_jwks_url() -> str:
+    if JWKS_URL:
+        return JWKS_URL
+    if not TENANT_ID:
+        raise ValueError("AZURE_IDENTITY_TENANT_ID is required for the signing keys!")
+    return f"https://login.microsoftonline.com/{TENANT_ID}/discovery/v2.0/keys"
 
 
-def get_token(request: Request):
+def get_token(request: Request | WebSocket):
     auth = request.headers.get("Authorization", None)
     if not auth:
         logger.error("Authorization header is expected!")
@@ -57,8 +91,8 @@ def check_role(token: str):
     )
 
 
-def validate_token(request: Request):
-    if not all([TENANT_ID, APP_CLIENT_ID, APP_ROLE]):
+async def validate_token(request: Request | WebSocket):
+    if not is_configured():
         logger.error(
             "Azure Identity environment variables are not properly configured!"
         )
@@ -68,25 +102,20 @@ def validate_token(request: Request):
         )
 
     token = get_token(request)
+    # verified before & not expired yet, role included
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+
     check_role(token)
 
-    # verify headers & claims of token
-    keys = urlopen(f"https://login.microsoftonline.com/{TENANT_ID}/discovery/v2.0/keys")
-    jwks = json.loads(keys.read())
-    unverified_header = jwt.get_unverified_header(token)
-
-    rsa_key = {}
-    for key in jwks["keys"]:
-        if key["kid"] == unverified_header["kid"]:
-            rsa_key = {
-                "kty": key["kty"],
-                "kid": key["kid"],
-                "use": key["use"],
-                "n": key["n"],
-                "e": key["e"],
-            }
-
-    if rsa_key:
+    # verify headers & claims of token, with the cached key of its kid
+    kid = jwt.get_unverified_header(token).get("kid")
+    rsa_key = None
+    if kid is not None:
+        rsa_key = await jwks_cache.get_async(get_jwks_url(), kid)
+
+    if rsa_key is not None:
         try:
             payload = jwt.decode(
                 token,
@@ -95,6 +124,7 @@ def validate_token(request: Request):
                 audience=APP_CLIENT_ID,
                 issuer=f"https://login.microsoftonline.com/{TENANT_ID}/v2.0",
             )
+            token_cache.set(token, payload)
             return payload
         except ExpiredSignatureError:
             logger.error("Token is expired!")
@@ -109,11 +139,11 @@ def validate_token(request: Request):
         )
 
 
-async def azure_security_middleware(request: Request, call_next):
-    # Enforce security for all requests
+async def check_access(request: Request) -> JSONResponse | None:
+    """Validate the token of the request, the error response if it fails."""
     try:
         logger.info("Checking access token on Azure Entra ID...")
-        token_payload = validate_token(request)
+        token_payload = await validate_token(request)
         request.state.token_payload = token_payload
         logger.info("Security checking passed, continue to next step.")
     except HTTPException as e:
@@ -126,5 +156,27 @@ async def azure_security_middleware(request: Request, call_next):
             content={"detail": "An internal security error occurred."},
         )
 
-    response = await call_next(request)
-    return response
+    return None
+
+
+class AzureSecurityMiddleware:
+    """Checks the access token of the HTTP requests under the secured paths.
+
+    A plain ASGI middleware: requests outside of the paths, and the ones
+    passing the check, go to the app untouched, without the extra task and
+    the re-streamed body of `BaseHTTPMiddleware`.
+    """
+
+    def __init__(self, app: ASGIApp, paths: Sequence[str] = ("/",)):
+        self.app = app
+        self.paths = tuple(paths)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http" and scope["path"].startswith(self.paths):
+            with timed("auth"):
+                response = await check_access(Request(scope, receive))
+            if response is not None:
+                await response(scope, receive, send)
+                return
+
+        await self.app(scope, receive, send)
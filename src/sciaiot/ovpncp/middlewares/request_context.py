@@ -0,0 +1,72 @@
+import logging
+import re
+import uuid
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from sciaiot.ovpncp.utils import metrics
+from sciaiot.ovpncp.utils.context import RequestContext, request_context
+
+logger = logging.getLogger(__name__)
+
+REQUEST_ID_HEADER = "X-Request-ID"
+# ids of the callers kept as is, others replaced
+REQUEST_ID_PATTERN = re.compile(r"^[\w.-]{1,64}$")
+
+
+def get_request_id(scope: Scope) -> str:
+    for name, value in scope["headers"]:
+        if name == b"x-request-id":
+            request_id = value.decode("latin-1")
+            if REQUEST_ID_PATTERN.match(request_id):
+                return request_id
+            break
+    return uuid.uuid4().hex
+
+
+class RequestContextMiddleware:
+    """Sets the context of the HTTP requests & logs one access record each.
+
+    The records logged while serving a request carry its id, route, client
+    name & latency; its access record adds the status & the time spent per
+    phase, e.g. in the auth, the DB queries & the commands. The latency is
+    also observed in the metrics, by route template.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        context = RequestContext(get_request_id(scope), scope)
+        token = request_context.set(context)
+        status = 500
+
+        async def send_with_id(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = MutableHeaders(scope=message)
+                headers.append(REQUEST_ID_HEADER, context.request_id)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            metrics.request_duration.labels(
+                scope["method"], context.route or metrics.UNMATCHED_ROUTE, status
+            ).observe(context.latency_ms / 1000)
+            logger.info(
+                f"{scope['method']} {scope['path']} {status} "
+                f"in {context.latency_ms:.1f}ms",
+                extra={
+                    "method": scope["method"],
+                    "status": status,
+                    "phases": context.phases_ms(),
+                },
+            )
+            request_context.reset(token)
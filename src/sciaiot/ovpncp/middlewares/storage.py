@@ -0,0 +1,115 @@
+import json
+import logging
+import re
+from contextlib import asynccontextmanager
+
+from fastapi.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from sciaiot.ovpncp.dependencies import get_async_session
+from sciaiot.ovpncp.utils.logging import mask_sensitive
+from sciaiot.ovpncp.utils.storage import StorageBackend, download_urls
+
+logger = logging.getLogger(__name__)
+
+# the cert routes of the client router, the only ones handled
+CERT_ROUTE = re.compile(r"^/clients/(?P<client_name>[^/]+)/(?P<action>[\w-]+)$")
+CERT_ACTIONS = {("PUT", "package-cert"), ("GET", "download-cert")}
+
+
+class StorageMiddleware:
+    """Moves the packaged certs of the clients to the storage backend.
+
+    A plain ASGI middleware, scoped to the cert routes: a packaged cert is
+    uploaded & a download answered with a signed URL of the stored file, any
+    other request goes to the app untouched. The signed URLs are cached, a
+    download answered from the cache skips the route & its lookup.
+    """
+
+    def __init__(self, app: ASGIApp, backend: StorageBackend, sessions=None):
+        self.app = app
+        self.backend = backend
+        self.sessions = sessions or asynccontextmanager(get_async_session)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        match = None
+        if scope["type"] == "http":
+            match = CERT_ROUTE.match(scope["path"])
+        if match is None or (scope["method"], match["action"]) not in CERT_ACTIONS:
+            await self.app(scope, receive, send)
+            return
+
+        client_name = match["client_name"]
+        if match["action"] == "download-cert":
+            # renewed or revoked certs bump the version, on any worker; a
+            # session is only opened once the version is to be read again
+            if download_urls.is_check_due():
+                async with self.sessions() as session:
+                    await download_urls.sync_version(session)
+            url = download_urls.get(client_name)
+            if url is not None:
+                response = JSONResponse(content={"url": url}, status_code=200)
+                await response(scope, receive, send)
+                return
+
+        # hold the response of the route, passed on as is unless successful
+        messages: list[Message] = []
+
+        async def hold(message: Message):
+            # the file of a download is answered by its URL, not kept
+            if (
+                match["action"] == "download-cert"
+                and message["type"] == "http.response.body"
+                and messages[0]["status"] == 200
+            ):
+                return
+            messages.append(message)
+
+        await self.app(scope, receive, hold)
+        if not messages or messages[0]["status"] != 200:
+            for message in messages:
+                await send(message)
+            return
+
+        if match["action"] == "package-cert":
+            body = b"".join(m.get("body", b"") for m in messages[1:])
+            file_path = json.loads(body).get("file_path")
+            response = await upload_archive(self.backend, client_name, file_path)
+        else:
+            response = await sign_download(self.backend, client_name)
+        await response(scope, receive, send)
+
+
+async def upload_archive(
+    backend: StorageBackend, client_name: str, file_path: str
+) -> JSONResponse:
+    try:
+        location, uploaded = await backend.upload(f"{client_name}.zip", file_path)
+        if uploaded:
+            download_urls.invalidate(client_name)
+        logger.info(f"Cert stored on the {backend.kind} storage: {location}")
+        response = JSONResponse(content={"file_path": location}, status_code=200)
+    except Exception as e:  # noqa: BLE001 - any backend's error, answered with a 500
+        logger.error(f"Error uploading cert to the {backend.kind} storage: {e}")
+        response = JSONResponse(
+            content={"detail": f"Error uploading cert to the {backend.kind} storage"},
+            status_code=500,
+        )
+
+    return response
+
+
+async def sign_download(backend: StorageBackend, client_name: str) -> JSONResponse:
+    try:
+        url = await backend.download_url(f"{client_name}.zip")
+        logger.info(f"Generated download URL for cert: {mask_sensitive(url)}")
+        download_urls.set(client_name, url)
+        response = JSONResponse(content={"url": url}, status_code=200)
+    except Exception as e:  # noqa: BLE001 - any backend's error, answered with a 500
+        logger.error(f"Error generating download URL for cert: {e}")
+        response = JSONResponse(
+            content={"detail": "Error generating download URL for cert"},
+            status_code=500,
+        )
+
+    return response
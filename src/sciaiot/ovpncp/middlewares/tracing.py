@@ -0,0 +1,65 @@
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from sciaiot.ovpncp.utils.context import request_context, route_template
+from sciaiot.ovpncp.utils.tracing import Tracer
+
+TRACEPARENT_HEADER = "traceparent"
+
+
+def get_traceparent(scope: Scope) -> str | None:
+    for name, value in scope["headers"]:
+        if name == b"traceparent":
+            return value.decode("latin-1")
+    return None
+
+
+class TracingMiddleware:
+    """Traces the HTTP requests, each from a root span named by its route.
+
+    A `traceparent` header of the caller continues its trace; the one of the
+    response names the root span, to find the trace once exported.
+    """
+
+    def __init__(self, app: ASGIApp, tracer: Tracer):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        root = self.tracer.start(
+            f"{scope['method']} {scope['path']}",
+            get_traceparent(scope),
+            {"http.request.method": scope["method"], "url.path": scope["path"]},
+        )
+        status = 500
+
+        async def send_with_traceparent(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = MutableHeaders(scope=message)
+                headers.append(TRACEPARENT_HEADER, root.traceparent)
+            await send(message)
+
+        try:
+            with root:
+                await self.app(scope, receive, send_with_traceparent)
+        finally:
+            route = route_template(scope)
+            if route is not None:
+                root.name = f"{scope['method']} {route}"
+                root.set_attribute("http.route", route)
+            root.set_attribute("http.response.status_code", status)
+            root.set_attribute(
+                "client_name", scope.get("path_params", {}).get("client_name")
+            )
+            context = request_context.get()
+            if context is not None:
+                root.set_attribute("request_id", context.request_id)
+            if status >= 500 and root.error is None:
+                root.record_error(f"HTTP {status}")
+            self.tracer.finish(root)
@@ -1,13 +1,15 @@
 import ipaddress
 import logging
 import os
-from datetime import datetime
+from datetime import date, datetime
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
 from fastapi.responses import FileResponse
 from pydantic import BaseModel
-from sqlmodel import Session, select
+from sqlalchemy.orm import selectinload
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from sciaiot.ovpncp import dependencies
 from sciaiot.ovpncp.data.server import (
@@ -16,19 +18,31 @@ from sciaiot.ovpncp.data.server import (
     Client,
     ClientBase,
     ClientDetails,
+    ClientSummary,
     ClientWithVirtualAddress,
     Connection,
+    ConnectionEvent,
+    ConnectionRollup,
+    ConnectionRollupBase,
     VirtualAddress,
     VirtualAddressBase,
 )
-from sciaiot.ovpncp.dependencies import get_session
+from sciaiot.ovpncp.data.traffic import TrafficPoint
+from sciaiot.ovpncp.dependencies import get_async_session
 from sciaiot.ovpncp.routes.server import get_server
-from sciaiot.ovpncp.utils import openvpn
+from sciaiot.ovpncp.utils import ccd, openvpn, traffic
+from sciaiot.ovpncp.utils.broadcast import broadcaster
+from sciaiot.ovpncp.utils.cache import client_cache
 from sciaiot.ovpncp.utils.logging import mask_sensitive
+from sciaiot.ovpncp.utils.storage import download_urls
 
 logger = logging.getLogger(__name__)
-DBSession = Annotated[Session, Depends(get_session)]
-router = APIRouter()
+DBSession = Annotated[AsyncSession, Depends(get_async_session)]
+router = APIRouter(prefix="/clients")
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+CONNECTIONS_PAGE_SIZE = 20
 
 
 class ClientNetworkRequest(BaseModel):
@@ -59,33 +73,108 @@ async def create_client(request: ClientBase, session: DBSession):
 
     session.add(client)
     session.add(cert)
-    session.commit()
-    session.refresh(client)
+    await client_cache.bump(session)
+    await session.commit()
+    await session.refresh(client)
 
     logger.info("Client created successfully!")
     return client
 
 
-@router.get("")
-async def retrieve_clients(session: DBSession):
-    logger.info("Retrieving all clients...")
-    clients = session.exec(select(Client)).all()
+@router.get("", response_model=list[ClientSummary])
+async def retrieve_clients(
+    session: DBSession,
+    response: Response,
+    after: int | None = None,
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = PAGE_SIZE,
+    revoked: bool | None = None,
+    has_address: bool | None = None,
+    cert_expires_before: datetime | None = None,
+):
+    logger.info("Retrieving clients...")
+    statement = (
+        select(Client)
+        .options(selectinload(Client.virtual_address), selectinload(Client.cert))  # type: ignore
+        .order_by(col(Client.id))
+        .limit(limit)
+    )
+
+    # keyset pagination, the cursor is the last client id of the previous page
+    if after is not None:
+        statement = statement.where(Client.id > after)
+    if revoked is not None:
+        statement = statement.where(Client.revoked == revoked)
+    if has_address is not None:
+        address_id = col(Client.virtual_address_id)
+        statement = statement.where(
+            address_id.is_not(None) if has_address else address_id.is_(None)
+        )
+    if cert_expires_before is not None:
+        statement = statement.join(Cert).where(Cert.expires_on < cert_expires_before)
+
+    clients = (await session.exec(statement)).all()
+    if len(clients) == limit:
+        response.headers["X-Next-Cursor"] = str(clients[-1].id)
+
     logger.info(f"Found {len(clients)} clients.")
     return clients
 
 
 @router.get("/{client_name}", response_model=ClientDetails)
-async def retrieve_client(client_name: str, session: DBSession):
+async def retrieve_client(
+    client_name: str,
+    session: DBSession,
+    connections_before: int | None = None,
+    connections_limit: Annotated[
+        int, Query(ge=1, le=MAX_PAGE_SIZE)
+    ] = CONNECTIONS_PAGE_SIZE,
+):
     logger.info(f"Retrieving client {client_name}...")
-    client = get_client_by_name(client_name, session)
+    statement = (
+        select(Client)
+        .where(Client.name == client_name)
+        .options(selectinload(Client.virtual_address), selectinload(Client.cert))  # type: ignore
+    )
+    client = (await session.exec(statement)).one_or_none()
+
+    if not client:
+        logger.error(f'Client "{client_name}" not found!')
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f'Client "{client_name}" not found!',
+        )
+
+    # latest connections first, the cursor is the last connection id returned
+    connections_statement = (
+        select(Connection)
+        .where(Connection.client_id == client.id)
+        .order_by(col(Connection.id).desc())
+        .limit(connections_limit)
+    )
+    if connections_before is not None:
+        connections_statement = connections_statement.where(
+            Connection.id < connections_before
+        )
+    connections = (await session.exec(connections_statement)).all()
+
+    cursor = None
+    if len(connections) == connections_limit:
+        cursor = connections[-1].id
+
     logger.info("Found client.")
-    return client
+    return ClientDetails(
+        **client.model_dump(),
+        virtual_address=client.virtual_address,
+        cert=client.cert,
+        connections=connections,
+        connections_cursor=cursor,
+    )
 
 
 @router.put("/{client_name}/package-cert")
 async def package_client_cert(client_name: str, session: DBSession):
     logger.info(f"Packaging client certificate for {client_name}...")
-    client = get_client_by_name(client_name, session)
+    client = await get_client_by_name(client_name, session)
     archive = openvpn.package_client_cert(client.name, dependencies.certs_directory)
     logger.info("Client certificate packaged successfully!")
     return {"file_path": archive}
@@ -94,7 +183,7 @@ async def package_client_cert(client_name: str, session: DBSession):
 @router.get("/{client_name}/download-cert")
 async def download_client_cert(client_name: str, session: DBSession):
     logger.info(f"Downloading client certificate for {client_name}...")
-    client = get_client_by_name(client_name, session)
+    client = await get_client_by_name(client_name, session)
     file_name = f"{client.name}.zip"
     file_path = os.path.join(dependencies.certs_directory, file_name)
     logger.info("Client certificate ready to be downloaded.")
@@ -106,7 +195,11 @@ async def download_client_cert(client_name: str, session: DBSession):
 @router.put("/{client_name}/renew-cert", response_model=CertBase)
 async def renew_client_cert(client_name: str, session: DBSession):
     logger.info(f"Renewing client certificate for {client_name}...")
-    client = get_client_by_name(client_name, session)
+    client = await get_client_by_name(
+        client_name,
+        session,
+        selectinload(Client.cert),  # type: ignore
+    )
     cert = client.cert
 
     if cert is not None:
@@ -115,8 +208,9 @@ async def renew_client_cert(client_name: str, session: DBSession):
             setattr(cert, key, value)
 
         session.add(cert)
-        session.commit()
-        session.refresh(cert)
+        await download_urls.bump(session)
+        await session.commit()
+        await session.refresh(cert)
 
         logger.info("Client certificate renewed successfully!")
         return cert
@@ -125,15 +219,17 @@ async def renew_client_cert(client_name: str, session: DBSession):
 @router.put("/{client_name}/revoke", response_model=ClientBase)
 async def revoke_client(client_name: str, session: DBSession):
     logger.info(f"Revoking client certificate for {client_name}...")
-    client = get_client_by_name(client_name, session)
+    client = await get_client_by_name(client_name, session)
     client.revoked = True
 
     openvpn.revoke_client(client.name)
     openvpn.generate_crl()
 
     session.add(client)
-    session.commit()
-    session.refresh(client)
+    await client_cache.bump(session)
+    await download_urls.bump(session)
+    await session.commit()
+    await session.refresh(client)
 
     logger.info("Client certificate revoked successfully!")
     return client
@@ -145,7 +241,7 @@ async def assign_virtual_address(
 ):
     logger.info(f"Assigning virtual address {address.ip} to client {client_name}...")
     statement = select(VirtualAddress).where(VirtualAddress.ip == address.ip)
-    virtual_address = session.exec(statement).one_or_none()
+    virtual_address = (await session.exec(statement)).one_or_none()
 
     if not virtual_address:
         raise HTTPException(
@@ -154,18 +250,26 @@ async def assign_virtual_address(
         )
 
     server = await get_server(session)
-    client = get_client_by_name(client_name, session)
+    client = await get_client_by_name(
+        client_name,
+        session,
+        selectinload(Client.virtual_address),  # type: ignore
+    )
     client.virtual_address = virtual_address
-    openvpn.assign_client_ip(client.name, virtual_address.ip, server.subnet_mask)
+    if not ccd.is_dynamic():
+        openvpn.assign_client_ip(client.name, virtual_address.ip, server.subnet_mask)
 
-    if client.cidr:
-        network = ipaddress.ip_network(client.cidr, strict=False)
-        openvpn.add_iroute(client.name, f"{network.network_address} {network.netmask}")
-        logger.info(f"Added iroute on {network.network_address} {network.netmask}.")
+        if client.cidr:
+            network = ipaddress.ip_network(client.cidr, strict=False)
+            iroute = f"{network.network_address} {network.netmask}"
+            openvpn.add_iroute(client.name, iroute)
+            logger.info(f"Added iroute on {iroute}.")
 
     session.add(client)
-    session.commit()
-    session.refresh(client)
+    if ccd.is_dynamic():
+        await ccd.client_configs.invalidate(session)
+    await session.commit()
+    await session.refresh(client, ["virtual_address"])
 
     logger.info("Virtual address assigned successfully!")
     return client
@@ -174,7 +278,11 @@ async def assign_virtual_address(
 @router.delete("/{client_name}/unassign-ip", status_code=status.HTTP_204_NO_CONTENT)
 async def unassign_virtual_address(client_name: str, session: DBSession):
     logger.info(f"Unassigning virtual address from client {client_name}...")
-    client = get_client_by_name(client_name, session)
+    client = await get_client_by_name(
+        client_name,
+        session,
+        selectinload(Client.virtual_address),  # type: ignore
+    )
 
     if not client.virtual_address:
         raise HTTPException(
@@ -182,31 +290,100 @@ async def unassign_virtual_address(client_name: str, session: DBSession):
             detail=f'Client "{client_name}" has no virtual address assigned!',
         )
 
-    openvpn.unassign_client_ip(client.name)
+    if not ccd.is_dynamic():
+        openvpn.unassign_client_ip(client.name)
     client.virtual_address = None
 
     session.add(client)
-    session.commit()
-    session.refresh(client)
+    if ccd.is_dynamic():
+        await ccd.client_configs.invalidate(session)
+    await session.commit()
 
     logger.info("Virtual address unassigned successfully!")
 
 
+@router.get("/{client_name}/traffic", response_model=list[TrafficPoint])
+async def retrieve_client_traffic(
+    client_name: str,
+    session: DBSession,
+    start: Annotated[datetime, Query(alias="from")],
+    end: Annotated[datetime, Query(alias="to")],
+    step: Annotated[int, Query(ge=10)] = 60,
+):
+    logger.info(f"Retrieving traffic of client {client_name}...")
+    if step % traffic.TRAFFIC_TIERS[0][0]:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Step must be a multiple of {traffic.TRAFFIC_TIERS[0][0]} seconds!",
+        )
+
+    points = traffic.traffic_sampler.series(
+        client_name, start.timestamp(), end.timestamp(), step
+    )
+    if points is None:
+        # older than the buffers, read from the persisted tiers
+        if step % traffic.PERSISTED_STEPS[0]:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Step must be a multiple of {traffic.PERSISTED_STEPS[0]} seconds for this range!",
+            )
+
+        client_id = await get_client_id_by_name(client_name, session)
+        points = await traffic.load_series(session, client_id, start, end, step)
+
+    logger.info(f"Found {len(points)} traffic points.")
+    return points
+
+
+@router.get("/{client_name}/rollups", response_model=list[ConnectionRollupBase])
+async def retrieve_client_rollups(
+    client_name: str,
+    session: DBSession,
+    start: Annotated[date | None, Query(alias="from")] = None,
+    end: Annotated[date | None, Query(alias="to")] = None,
+):
+    logger.info(f"Retrieving daily connection rollups of client {client_name}...")
+    client_id = await get_client_id_by_name(client_name, session)
+    statement = (
+        select(ConnectionRollup)
+        .where(ConnectionRollup.client_id == client_id)
+        .order_by(col(ConnectionRollup.day))
+    )
+    if start is not None:
+        statement = statement.where(ConnectionRollup.day >= start)
+    if end is not None:
+        statement = statement.where(ConnectionRollup.day <= end)
+    rollups = (await session.exec(statement)).all()
+
+    logger.info(f"Found {len(rollups)} rollups.")
+    return rollups
+
+
 @router.post("/{client_name}/connections")
 async def start_connection(
     client_name: str, request: StartConnectionRequest, session: DBSession
 ):
     logger.info(f"Starting connection for client {client_name}...")
-    client = get_client_by_name(client_name, session)
+    client_id = await get_client_id_by_name(client_name, session)
     connection = Connection(
-        client=client,
+        client_id=client_id,
         remote_address=request.remote_address,
         connected_time=request.connected_time,
     )
 
     session.add(connection)
-    session.commit()
-    session.refresh(connection)
+    await session.commit()
+    await session.refresh(connection)
+    broadcaster.publish(
+        [
+            ConnectionEvent(
+                type="connect",
+                client_name=client_name,
+                remote_address=request.remote_address,
+                time=request.connected_time,
+            )
+        ]
+    )
 
     logger.info("Connection started successfully!")
     return connection
@@ -217,17 +394,17 @@ async def close_connection(
     client_name: str, request: CloseConnectionRequest, session: DBSession
 ):
     logger.info(f"Closing connection for client {client_name}...")
-    client = get_client_by_name(client_name, session)
+    client_id = await get_client_id_by_name(client_name, session)
     statement = (
         select(Connection)
         .where(
             Connection.remote_address == request.remote_address,
-            Connection.client_id == client.id,
-            Connection.disconnected_time == None,  # noqa: E711
+            Connection.client_id == client_id,
+            Connection.disconnected_time == None,
         )
         .order_by(Connection.connected_time.desc())  # type: ignore
     )
-    connection = session.exec(statement).first()
+    connection = (await session.exec(statement)).first()
 
     if not connection:
         logger.error("No active connection found for the given remote address!")
@@ -238,16 +415,28 @@ async def close_connection(
 
     connection.disconnected_time = request.disconnected_time
     session.add(connection)
-    session.commit()
-    session.refresh(connection)
+    await session.commit()
+    await session.refresh(connection)
+    broadcaster.publish(
+        [
+            ConnectionEvent(
+                type="disconnect",
+                client_name=client_name,
+                remote_address=request.remote_address,
+                time=request.disconnected_time,
+            )
+        ]
+    )
 
     logger.info("Connection closed successfully!")
     return connection
 
 
-def get_client_by_name(client_name: str, session: Session) -> Client:
-    statement = select(Client).where(Client.name == client_name)
-    client = session.exec(statement).one_or_none()
+async def get_client_by_name(
+    client_name: str, session: AsyncSession, *options
+) -> Client:
+    statement = select(Client).where(Client.name == client_name).options(*options)
+    client = (await session.exec(statement)).one_or_none()
 
     if not client:
         logger.error(f'Client "{client_name}" not found!')
@@ -257,3 +446,14 @@ def get_client_by_name(client_name: str, session: Session) -> Client:
         )
 
     return client
+
+
+async def get_client_id_by_name(client_name: str, session: AsyncSession) -> int:
+    await client_cache.sync_version(session)
+    client_id = client_cache.get(client_name)
+    if client_id is None:
+        client = await get_client_by_name(client_name, session)
+        client_id = client.id
+        client_cache.set(client_name, client_id)
+
+    return client_id
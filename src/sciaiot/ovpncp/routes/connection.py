@@ -0,0 +1,155 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Annotated
+
+from fastapi import (
+    APIRouter,
+    Depends,
+    HTTPException,
+    Query,
+    WebSocket,
+    WebSocketDisconnect,
+    status,
+)
+from fastapi.responses import StreamingResponse
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from sciaiot.ovpncp.data.server import (
+    ConnectionEvent,
+    ConnectionEventsResult,
+    ConnectionStats,
+    ReconcileResult,
+    RetentionResult,
+)
+from sciaiot.ovpncp.dependencies import get_async_session
+from sciaiot.ovpncp.middlewares import azure_security
+from sciaiot.ovpncp.utils.broadcast import STREAM_KEEPALIVE, Subscription, broadcaster
+from sciaiot.ovpncp.utils.ingestion import (
+    ConnectionEventWriter,
+    get_event_writer,
+    to_local,
+)
+from sciaiot.ovpncp.utils.reconcile import reconcile_connections
+from sciaiot.ovpncp.utils.retention import RETENTION_DAYS, apply_retention
+from sciaiot.ovpncp.utils.stats import connection_stats
+
+logger = logging.getLogger(__name__)
+DBSession = Annotated[AsyncSession, Depends(get_async_session)]
+EventWriter = Annotated[ConnectionEventWriter, Depends(get_event_writer)]
+router = APIRouter(prefix="/connections")
+
+STATS_RANGE = timedelta(days=1)
+
+
+@router.post("/events", response_model=ConnectionEventsResult)
+async def ingest_connection_events(events: list[ConnectionEvent], writer: EventWriter):
+    logger.info(f"Ingesting {len(events)} connection events...")
+    result = await writer.submit(events)
+    logger.info(
+        f"Ingested {result.accepted} connection events, rejected {len(result.rejected)}."
+    )
+    return result
+
+
+@router.post("/reconcile", response_model=ReconcileResult)
+async def reconcile(session: DBSession):
+    logger.info("Reconciling connections with the server status...")
+    result = await reconcile_connections(session)
+    logger.info("Connections reconciled successfully!")
+    return result
+
+
+@router.post("/purge", response_model=RetentionResult)
+async def purge(session: DBSession, days: float = RETENTION_DAYS):
+    if days <= 0:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="The retention must be a positive number of days!",
+        )
+
+    logger.info(f"Purging connections closed more than {days} days ago...")
+    result = await apply_retention(session, days)
+    logger.info("Connections purged successfully!")
+    return result
+
+
+@router.get("/stats", response_model=ConnectionStats)
+async def retrieve_connection_stats(
+    session: DBSession,
+    start: Annotated[datetime | None, Query(alias="from")] = None,
+    end: Annotated[datetime | None, Query(alias="to")] = None,
+    step: Annotated[int, Query(ge=1)] = 3600,
+    top: Annotated[int, Query(ge=1, le=1000)] = 10,
+):
+    end = to_local(end) if end else datetime.now()
+    start = to_local(start) if start else end - STATS_RANGE
+    if start >= end:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="The range must start before it ends!",
+        )
+
+    logger.info(f"Aggregating connections from {start} to {end}...")
+    stats = await connection_stats(session, start, end, step, top)
+    logger.info("Connections aggregated successfully!")
+    return stats
+
+
+async def stream_events(subscription: Subscription):
+    try:
+        while True:
+            try:
+                item = await subscription.get(STREAM_KEEPALIVE)
+            except TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+
+            if item is None:
+                break
+            event_type, data = item
+            yield f"event: {event_type}\ndata: {data}\n\n"
+    finally:
+        broadcaster.unsubscribe(subscription)
+
+
+@router.get("/stream")
+async def stream_connection_events():
+    logger.info("Streaming connection events...")
+    return StreamingResponse(
+        stream_events(broadcaster.subscribe()),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.websocket("/stream")
+async def stream_connection_events_ws(websocket: WebSocket):
+    # the HTTP middlewares don't see WebSocket requests
+    if azure_security.is_secured(websocket.url.path):
+        try:
+            await azure_security.validate_token(websocket)
+        except HTTPException as e:
+            logger.error(f"Security checking failed: {e.detail}")
+            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+            return
+
+    await websocket.accept()
+    logger.info("Streaming connection events over WebSocket...")
+    subscription = broadcaster.subscribe()
+
+    async def forward():
+        while (item := await subscription.queue.get()) is not None:
+            await websocket.send_text(item[1])
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+
+    forwarding = asyncio.create_task(forward())
+    try:
+        # nothing is expected from the client, only its disconnect
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        forwarding.cancel()
+        broadcaster.unsubscribe(subscription)
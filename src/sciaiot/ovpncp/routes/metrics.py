@@ -0,0 +1,26 @@
+import logging
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, Response
+from sqlmodel import col, func, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from sciaiot.ovpncp.data.server import Connection
+from sciaiot.ovpncp.dependencies import get_async_session
+from sciaiot.ovpncp.utils import metrics
+
+logger = logging.getLogger(__name__)
+DBSession = Annotated[AsyncSession, Depends(get_async_session)]
+router = APIRouter(prefix="/metrics")
+
+
+@router.get("")
+async def get_metrics(session: DBSession):
+    # counted once per scrape, the same for all the workers
+    statement = select(func.count(col(Connection.id))).where(
+        Connection.disconnected_time == None
+    )
+    metrics.active_connections.set((await session.exec(statement)).one())
+
+    content, media_type = metrics.generate()
+    return Response(content, media_type=media_type)
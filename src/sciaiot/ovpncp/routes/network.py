@@ -4,16 +4,19 @@ from typing import Annotated
 
 from fastapi import APIRouter, Depends, HTTPException, status
 from pydantic import BaseModel
-from sqlmodel import Session, select
+from sqlalchemy.orm import selectinload
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from sciaiot.ovpncp.data.network import RestrictedNetwork
-from sciaiot.ovpncp.dependencies import get_session
+from sciaiot.ovpncp.data.server import Client
+from sciaiot.ovpncp.dependencies import get_async_session
 from sciaiot.ovpncp.routes.client import get_client_by_name
-from sciaiot.ovpncp.utils import iptables, openvpn
+from sciaiot.ovpncp.utils import ccd, iptables, openvpn
 
 logger = logging.getLogger(__name__)
-DBSession = Annotated[Session, Depends(get_session)]
-router = APIRouter()
+DBSession = Annotated[AsyncSession, Depends(get_async_session)]
+router = APIRouter(prefix="/networks")
 
 
 class RestrictedNetworkRequest(BaseModel):
@@ -29,8 +32,11 @@ async def create_restricted_network(
     logger.info(
         f"Creating restricted network: {request.source_name} -> {request.destination_name}"
     )
-    source = get_client_by_name(request.source_name, session)
-    destination = get_client_by_name(request.destination_name, session)
+    with_address = selectinload(Client.virtual_address)  # type: ignore
+    source = await get_client_by_name(request.source_name, session, with_address)
+    destination = await get_client_by_name(
+        request.destination_name, session, with_address
+    )
 
     if not source.virtual_address or not destination.virtual_address:
         logger.error("Virtual address must assigned to both clients!")
@@ -48,21 +54,29 @@ async def create_restricted_network(
         start_time=datetime.now(),
     )
 
+    # the ID tags the routes pushed for this network
+    session.add(network)
+    await session.flush()
+
     # add those rules before the final one on iptables
     chain = "FORWARD"
     size = len(iptables.list_rules(chain))
     if network.private_network_addresses:
         all = network.iptable_rules() + (network.private_iptable_rules())
         iptables.apply_rules(chain, size, all)
-        openvpn.push_client_routes(
-            source.name, network.push_routes(destination.virtual_address.ip)
-        )
+        if not ccd.is_dynamic():
+            openvpn.push_client_routes(
+                source.name,
+                network.push_routes(destination.virtual_address.ip),
+                network.id,
+            )
     else:
         iptables.apply_rules(chain, size, network.iptable_rules())
 
-    session.add(network)
-    session.commit()
-    session.refresh(network)
+    if ccd.is_dynamic():
+        await ccd.client_configs.invalidate(session)
+    await session.commit()
+    await session.refresh(network)
 
     logger.info("Restricted network created successfully.")
     return network
@@ -74,7 +88,7 @@ async def retrieve_restricted_networks(source_name: str, session: DBSession):
     statement = select(RestrictedNetwork).where(
         RestrictedNetwork.source_name == source_name
     )
-    networks = session.exec(statement).all()
+    networks = (await session.exec(statement)).all()
     logger.info(f"Retrieved {len(networks)} restricted networks.")
     return networks
 
@@ -83,7 +97,7 @@ async def retrieve_restricted_networks(source_name: str, session: DBSession):
 async def retrieve_restricted_network(network_id: int, session: DBSession):
     logger.info(f"Retrieving restricted network with ID {network_id}...")
     statement = select(RestrictedNetwork).where(RestrictedNetwork.id == network_id)
-    network = session.exec(statement).one_or_none()
+    network = (await session.exec(statement)).one_or_none()
 
     if not network:
         logger.error(f"Network with ID {network_id} not found!")
@@ -104,15 +118,21 @@ async def drop_restricted_network(network_id: int, session: DBSession):
 
     chain = "FORWARD"
     if network.private_network_addresses:
-        source = get_client_by_name(network.source_name, session)
-        openvpn.pull_client_routes(source.name)
+        source = await get_client_by_name(network.source_name, session)
+        if not ccd.is_dynamic():
+            openvpn.pull_client_routes(
+                source.name,
+                network.id,
+                network.push_routes(network.destination_virtual_address),
+            )
         all = network.iptable_rules() + network.private_iptable_rules()
         iptables.drop_rules(chain, all)
     else:
         iptables.drop_rules(chain, network.iptable_rules())
 
     session.add(network)
-    session.commit()
-    session.refresh(network)
+    if ccd.is_dynamic():
+        await ccd.client_configs.invalidate(session)
+    await session.commit()
 
     logger.info(f"Dropped restricted network with ID {network_id}.")
@@ -4,19 +4,22 @@ from typing import Annotated
 
 from fastapi import APIRouter, Depends, HTTPException, status
 from pydantic import BaseModel
-from sqlmodel import Session, select
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from sciaiot.ovpncp.data.server import (
+    CcdRebuildResult,
     Server,
     ServerWithVirtualAddresses,
     VirtualAddress,
 )
-from sciaiot.ovpncp.dependencies import get_session
-from sciaiot.ovpncp.utils import iproute, openvpn
+from sciaiot.ovpncp.dependencies import get_async_session
+from sciaiot.ovpncp.utils import ccd, iproute, openvpn
+from sciaiot.ovpncp.utils.cache import server_cache
 
 logger = logging.getLogger(__name__)
-DBSession = Annotated[Session, Depends(get_session)]
-router = APIRouter()
+DBSession = Annotated[AsyncSession, Depends(get_async_session)]
+router = APIRouter(prefix="/server")
 
 
 class RouteRequest(BaseModel):
@@ -29,8 +32,11 @@ async def init_server(session: DBSession):
     server = load_from_config()
 
     session.add(server)
-    session.commit()
-    session.refresh(server)
+    await server_cache.bump(session)
+    if ccd.is_dynamic():
+        await ccd.client_configs.invalidate(session)
+    await session.commit()
+    await session.refresh(server, ["virtual_addresses"])
 
     logger.info("Server initialized successfully!")
     return server
@@ -39,7 +45,13 @@ async def init_server(session: DBSession):
 @router.get("")
 async def get_server(session: DBSession):
     logger.info("Getting the server...")
-    server = session.exec(select(Server)).one_or_none()
+    await server_cache.sync_version(session)
+    server = server_cache.get(Server.__name__)
+    if server is not None:
+        logger.info("Server retrieved from cache.")
+        return server
+
+    server = (await session.exec(select(Server))).one_or_none()
 
     if not server:
         logger.error("Server not initialized yet!")
@@ -47,6 +59,10 @@ async def get_server(session: DBSession):
             status_code=status.HTTP_404_NOT_FOUND, detail="Server not found!"
         )
 
+    # cache a copy detached from the session
+    server = Server(**server.model_dump())
+    server_cache.set(Server.__name__, server)
+
     logger.info("Server retrieved successfully!")
     return server
 
@@ -59,11 +75,19 @@ async def get_service_health():
     return service_health
 
 
+@router.post("/rebuild-ccd", response_model=CcdRebuildResult)
+async def rebuild_ccd(session: DBSession):
+    logger.info("Rebuilding the ccd directory...")
+    result = await ccd.rebuild_ccd(session)
+    logger.info("The ccd directory rebuilt successfully!")
+    return result
+
+
 @router.get("/assignable-virtual-addresses")
 async def get_assignable_virtual_addresses(session: DBSession):
     logger.info("Getting the assignable virtual addresses...")
     statement = select(VirtualAddress).where(VirtualAddress.client == None)  # noqa: E711, is doesn't work here...
-    addresses = session.exec(statement).all()
+    addresses = (await session.exec(statement)).all()
     logger.info(f"Found {len(addresses)} assignable virtual addresses.")
     return addresses
 
@@ -3,28 +3,37 @@
 # OpenVPN environment variables are available when this script is run.
 # See: https://openvpn.net/community-resources/reference-manual-for-openvpn-2-6/
 
+SPOOL_FILE="${SPOOL_FILE:-/opt/ovpncp/spool/events.jsonl}"
+CCD_SOCKET="${CCD_SOCKET:-/opt/ovpncp/ccd.sock}"
 CLIENT_NAME="$common_name"
 REMOTE_ADDRESS="$untrusted_ip:$untrusted_port"
-CONNECTED_TIME=$(date -Is) # ISO 8601 format, suitable for JSON
+printf -v CONNECTED_TIME '%(%Y-%m-%dT%H:%M:%S%z)T' -1 # ISO 8601 format, without forking date
 
-# Construct the JSON payload
-JSON_PAYLOAD=$(cat <<EOF
-{
-    "remote_address": "$REMOTE_ADDRESS",
-    "connected_time": "$CONNECTED_TIME"
-}
-EOF
-)
+# In dynamic CCD mode, write the config rendered by the API to the file given by
+# OpenVPN, no config rejects the client
+if [ "$CCD_MODE" = "dynamic" ]; then
+    python3 -c '
+import socket, sys
+name, path, output = sys.argv[1:]
+with socket.socket(socket.AF_UNIX) as s:
+    s.settimeout(5)
+    s.connect(path)
+    s.sendall(name.encode() + b"\n")
+    config = b"".join(iter(lambda: s.recv(65536), b""))
+if not config:
+    sys.exit(f"No config for client {name}.")
+with open(output, "wb") as file:
+    file.write(config)
+' "$CLIENT_NAME" "$CCD_SOCKET" "$1" || exit 1
+fi
 
-# Send the POST request using curl
-curl -X POST \
-    -H 'Content-Type: application/json' \
-    -d "$JSON_PAYLOAD" \
-    "http://127.0.0.1:8000/clients/${CLIENT_NAME}/connections"
+# Append the event as one JSON line, the API ingests the spool in batches
+printf '{"type": "connect", "client_name": "%s", "remote_address": "%s", "time": "%s"}\n' \
+    "$CLIENT_NAME" "$REMOTE_ADDRESS" "$CONNECTED_TIME" >> "$SPOOL_FILE"
 
 # Optional: Add error handling
 if [ $? -ne 0 ]; then
-    echo 'Error sending POST request.' >&2 # Send error to stderr
+    echo "Error appending to $SPOOL_FILE." >&2 # Send error to stderr
     exit 1 # Indicate failure
 fi
 
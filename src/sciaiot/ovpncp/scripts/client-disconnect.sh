@@ -3,28 +3,18 @@
 # OpenVPN environment variables are available when this script is run.
 # See: https://openvpn.net/community-resources/reference-manual-for-openvpn-2-6/
 
+SPOOL_FILE="${SPOOL_FILE:-/opt/ovpncp/spool/events.jsonl}"
 CLIENT_NAME="$common_name"
 REMOTE_ADDRESS="$untrusted_ip:$untrusted_port"
-DISCONNECTED_TIME=$(date -Is) # ISO 8601 format, suitable for JSON
+printf -v DISCONNECTED_TIME '%(%Y-%m-%dT%H:%M:%S%z)T' -1 # ISO 8601 format, without forking date
 
-# Construct the JSON payload
-JSON_PAYLOAD=$(cat <<EOF
-{
-    "remote_address": "$REMOTE_ADDRESS",
-    "disconnected_time": "$DISCONNECTED_TIME"
-}
-EOF
-)
-
-# Send the PUT request using curl
-curl -X PUT \
-    -H 'Content-Type: application/json' \
-    -d "$JSON_PAYLOAD" \
-    "http://127.0.0.1:8000/clients/$CLIENT_NAME/connections"
+# Append the event as one JSON line, the API ingests the spool in batches
+printf '{"type": "disconnect", "client_name": "%s", "remote_address": "%s", "time": "%s"}\n' \
+    "$CLIENT_NAME" "$REMOTE_ADDRESS" "$DISCONNECTED_TIME" >> "$SPOOL_FILE"
 
 # Optional: Add error handling
 if [ $? -ne 0 ]; then
-    echo 'Error sending PUT request.' >&2 # Send error to stderr
+    echo "Error appending to $SPOOL_FILE." >&2 # Send error to stderr
     exit 1 # Indicate failure
 fi
 
@@ -0,0 +1,98 @@
+"""In-process fan-out of the connection events to the stream subscribers.
+
+The broadcaster lives in each worker process and nothing is shared between
+them: under several workers, a subscriber sees only the events ingested by
+its own worker, i.e. the hooks it served and, when spooled, the events read
+by the worker owning the spool.
+"""
+
+import asyncio
+import logging
+import os
+from collections.abc import Sequence
+
+from sciaiot.ovpncp.data.server import ConnectionEvent
+
+logger = logging.getLogger(__name__)
+
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "1000"))
+STREAM_KEEPALIVE = float(os.getenv("STREAM_KEEPALIVE", "15"))
+
+
+class Subscription:
+    def __init__(self, max_size: int):
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue[tuple[str, str] | None] = asyncio.Queue(max_size)
+        self.dropped = False
+
+    async def get(self, timeout: float) -> tuple[str, str] | None:
+        """Next (type, JSON) event, None once dropped; TimeoutError if idle."""
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+
+class EventBroadcaster:
+    """Publish every event to the queue of each subscriber.
+
+    Events are encoded once, whatever the number of subscribers, and put
+    without waiting: a subscriber whose queue is full is dropped rather than
+    slowing down the ingestion, its stream ends and the client reconnects.
+    """
+
+    def __init__(self, max_size: int = STREAM_QUEUE_SIZE):
+        self.max_size = max_size
+        self.subscriptions: set[Subscription] = set()
+        self.dropped = 0
+
+    def subscribe(self) -> Subscription:
+        subscription = Subscription(self.max_size)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self.subscriptions.discard(subscription)
+
+    def publish(self, events: list[ConnectionEvent]):
+        if not self.subscriptions or not events:
+            return
+
+        items = [(event.type, event.model_dump_json()) for event in events]
+        loop: asyncio.AbstractEventLoop | None
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        for subscription in list(self.subscriptions):
+            if subscription.loop is loop:
+                self.deliver(subscription, items)
+            else:
+                # subscribed from another event loop, e.g. of another thread
+                subscription.loop.call_soon_threadsafe(
+                    self.deliver, subscription, items
+                )
+
+    def deliver(self, subscription: Subscription, items: Sequence[tuple[str, str]]):
+        if subscription.dropped:
+            return
+
+        try:
+            for item in items:
+                subscription.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.drop(subscription)
+
+    def drop(self, subscription: Subscription):
+        subscription.dropped = True
+        self.unsubscribe(subscription)
+        self.dropped += 1
+        logger.warning(
+            f"Dropped a stream subscriber behind by {subscription.queue.qsize()} events."
+        )
+
+        # make room for the end of stream, the consumer is waiting on it
+        while not subscription.queue.empty():
+            subscription.queue.get_nowait()
+        subscription.queue.put_nowait(None)
+
+
+broadcaster = EventBroadcaster()
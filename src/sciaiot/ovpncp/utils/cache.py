@@ -0,0 +1,124 @@
+"""Read-through caches for rows that rarely change."""
+
+import logging
+import os
+import time
+from typing import Any
+
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select, update
+
+from sciaiot.ovpncp.data.cache import CacheVersion
+from sciaiot.ovpncp.utils import metrics
+
+logger = logging.getLogger(__name__)
+
+CACHE_TTL = float(os.getenv("CACHE_TTL", "300"))
+CACHE_VERSION_CHECK_INTERVAL = float(os.getenv("CACHE_VERSION_CHECK_INTERVAL", "1"))
+
+# the names of the caches, their version rows seeded with the tables
+cache_names: set[str] = set()
+
+
+class VersionedCache:
+    """In-process cache with a TTL and a version counter shared through the DB.
+
+    Writers call `bump` inside their transaction, which clears the local
+    entries and increments the counter; other workers notice the new version
+    on their next check and drop their entries too. The counter is read at
+    most once per check interval, so a cache hit costs no query in between.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        ttl: float = CACHE_TTL,
+        check_interval: float = CACHE_VERSION_CHECK_INTERVAL,
+    ):
+        self.name = name
+        cache_names.add(name)
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.version: int | None = None
+        self.checked_at = float("-inf")
+        self.entries: dict[Any, tuple[float, Any]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.hit_counter = metrics.cache_requests.labels(name, "hit")
+        self.miss_counter = metrics.cache_requests.labels(name, "miss")
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.entries.pop(key, None)
+            self.misses += 1
+            self.miss_counter.inc()
+            return None
+
+        self.hits += 1
+        self.hit_counter.inc()
+        return entry[1]
+
+    def set(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+
+    def invalidate(self, key=None):
+        if key is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(key, None)
+
+    def is_check_due(self) -> bool:
+        """Whether the version is read on the next sync, not throttled."""
+        return time.monotonic() - self.checked_at >= self.check_interval
+
+    async def sync_version(self, session):
+        """Drop the local entries if another worker bumped the version."""
+        if not self.is_check_due():
+            return
+
+        statement = select(CacheVersion.version).where(CacheVersion.name == self.name)
+        version = (await session.exec(statement)).one_or_none() or 0
+        if version != self.version:
+            if self.version is not None:
+                logger.info(f"Cache {self.name} invalidated by version {version}.")
+            self.invalidate()
+            self.version = version
+        self.checked_at = time.monotonic()
+
+    async def bump(self, session):
+        """Increment the shared version in the session's transaction."""
+        self.invalidate()
+        statement = (
+            update(CacheVersion)
+            .where(CacheVersion.name == self.name)  # type: ignore
+            .values(version=CacheVersion.version + 1)
+        )
+        result = await session.exec(statement)
+        if result.rowcount == 0:
+            # not seeded, e.g. a cache created after the tables
+            session.add(CacheVersion(name=self.name, version=1))
+        # force a version check on the next read
+        self.checked_at = float("-inf")
+
+
+def seed_versions(engine):
+    """Insert the missing version rows, so the bumps of the workers only update.
+
+    Concurrent bumps of an unseeded cache would both insert its row, and one
+    of their transactions would fail.
+    """
+    for name in sorted(cache_names):
+        with Session(engine) as session:
+            if session.get(CacheVersion, name) is not None:
+                continue
+
+            session.add(CacheVersion(name=name))
+            try:
+                session.commit()
+            except IntegrityError:
+                pass  # seeded by another worker meanwhile
+
+
+server_cache = VersionedCache("server")
+client_cache = VersionedCache("client")
@@ -0,0 +1,335 @@
+"""Client configs rendered from the DB for the client-connect hook."""
+
+import asyncio
+import contextlib
+import ipaddress
+import logging
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from sqlalchemy.orm import selectinload
+from sqlmodel import col, select
+
+from sciaiot.ovpncp.data.network import RestrictedNetwork
+from sciaiot.ovpncp.data.server import CcdRebuildResult, Client, Server
+from sciaiot.ovpncp.dependencies import app_directory, get_async_session
+from sciaiot.ovpncp.utils import openvpn
+from sciaiot.ovpncp.utils.cache import VersionedCache
+from sciaiot.ovpncp.utils.lock import OwnerLock
+from sciaiot.ovpncp.utils.tracing import propagated, traced
+
+logger = logging.getLogger(__name__)
+
+CCD_MODES = ("static", "dynamic")
+CCD_MODE = os.getenv("CCD_MODE", "static").lower()
+CCD_SOCKET = os.getenv("CCD_SOCKET", f"{app_directory}/ccd.sock")
+CCD_REBUILD_CHUNK_SIZE = 1000
+# files written by one task of the pool, to keep the per-task overhead low
+CCD_REBUILD_TASK_SIZE = 50
+CCD_REBUILD_WORKERS = int(os.getenv("CCD_REBUILD_WORKERS", "16"))
+# how often a worker standing by tries to take the socket over
+CCD_OWNER_RETRY_INTERVAL = 5.0
+
+if CCD_MODE not in CCD_MODES:
+    raise ValueError(f"Invalid CCD_MODE '{CCD_MODE}', expected one of {CCD_MODES}!")
+
+
+def is_dynamic() -> bool:
+    return CCD_MODE == "dynamic"
+
+
+def client_directives(
+    client: Client, subnet_mask: str, networks: list[RestrictedNetwork]
+) -> dict[str, list[str]]:
+    """Build the directives of a client's ccd file, keyed by their owner."""
+    if not client.virtual_address:
+        return {}
+
+    directives = {
+        openvpn.IP_OWNER: [f"ifconfig-push {client.virtual_address.ip} {subnet_mask}"]
+    }
+    if client.cidr:
+        cidr = ipaddress.ip_network(client.cidr, strict=False)
+        directives[openvpn.IROUTE_OWNER] = [
+            f"iroute {cidr.network_address} {cidr.netmask}"
+        ]
+    for network in networks:
+        if network.private_network_addresses:
+            routes = network.push_routes(network.destination_virtual_address)
+            directives[f"{openvpn.NETWORK_OWNER}:{network.id}"] = [
+                f'push "route {route}"' for route in routes
+            ]
+
+    return directives
+
+
+def render_client_config(
+    client: Client, subnet_mask: str, networks: list[RestrictedNetwork]
+) -> str:
+    """Render the directives the static mode writes to the ccd file of a client."""
+    directives = client_directives(client, subnet_mask, networks)
+    return "".join(f"{line}\n" for lines in directives.values() for line in lines)
+
+
+async def active_networks(session, source_name: str | None = None):
+    """Get the networks pushing routes, grouped by their source client."""
+    statement = select(RestrictedNetwork).where(
+        RestrictedNetwork.end_time == None,
+        RestrictedNetwork.private_network_addresses != "",
+    )
+    if source_name is not None:
+        statement = statement.where(RestrictedNetwork.source_name == source_name)
+
+    networks = defaultdict(list)
+    for network in (await session.exec(statement)).all():
+        networks[network.source_name].append(network)
+    return networks
+
+
+@traced()
+def sync_files(files: list[tuple[str, dict[str, list[str]]]]) -> int:
+    return sum(openvpn.sync_ccd(name, directives) for name, directives in files)
+
+
+async def rebuild_ccd(
+    session,
+    chunk_size: int = CCD_REBUILD_CHUNK_SIZE,
+    workers: int = CCD_REBUILD_WORKERS,
+) -> CcdRebuildResult:
+    """Write the ccd files of all clients from the DB & remove the orphans.
+
+    Clients are read in chunks by ID, the files of a chunk are written by a
+    thread pool while the next one is queried; files with the same content
+    hash are left untouched.
+    """
+    result = CcdRebuildResult()
+    server = (await session.exec(select(Server))).first()
+    if not server:
+        logger.info("Server not initialized yet, no ccd file to rebuild.")
+        return result
+
+    networks = await active_networks(session)
+    loop = asyncio.get_running_loop()
+    names = set()
+    pending = []
+    last_id = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            statement = (
+                select(Client)
+                .where(
+                    Client.id > last_id,
+                    col(Client.virtual_address_id).is_not(None),
+                )
+                .order_by(col(Client.id))
+                .limit(chunk_size)
+                .options(selectinload(Client.virtual_address))  # type: ignore
+            )
+            clients = (await session.exec(statement)).all()
+            if not clients:
+                break
+
+            last_id = clients[-1].id
+            files = []
+            for client in clients:
+                names.add(client.name)
+                files.append(
+                    (
+                        client.name,
+                        client_directives(
+                            client, server.subnet_mask, networks[client.name]
+                        ),
+                    )
+                )
+            for i in range(0, len(files), CCD_REBUILD_TASK_SIZE):
+                batch = files[i : i + CCD_REBUILD_TASK_SIZE]
+                pending.append(
+                    loop.run_in_executor(executor, propagated(sync_files), batch)
+                )
+
+        for written in await asyncio.gather(*pending):
+            result.written += written
+        result.unchanged = len(names) - result.written
+
+        orphans = [name for name in openvpn.list_ccd() if name not in names]
+        await asyncio.gather(
+            *(
+                loop.run_in_executor(executor, propagated(openvpn.remove_ccd), n)
+                for n in orphans
+            )
+        )
+        result.removed = len(orphans)
+
+    logger.info(
+        f"Rebuilt the ccd directory: {result.written} written, "
+        f"{result.unchanged} unchanged, {result.removed} removed."
+    )
+    return result
+
+
+class ClientConfigIndex:
+    """Rendered configs of all clients, kept in memory & served on a unix socket.
+
+    The hook sends the client name as one line and reads the config until the
+    socket is closed; an empty config rejects the client, the same as a
+    missing ccd file does with `ccd-exclusive`.
+
+    One worker owns the socket, the one holding the lock next to it; it
+    loads the configs & renders the missing ones on demand, the others stand
+    by to take it over. The writers on any worker bump the version of the
+    configs in their transaction, which drops them on the owner once it sees
+    the new version.
+    """
+
+    def __init__(self, sessions=None, path: str = CCD_SOCKET):
+        self.configs = VersionedCache("client_config")
+        self.sessions = sessions or asynccontextmanager(get_async_session)
+        self.path = path
+        self.lock = OwnerLock(f"{path}.lock")
+        self.server: asyncio.Server | None = None
+        self.stopped: asyncio.Event | None = None
+
+    def get(self, name: str) -> str:
+        return self.configs.get(name) or ""
+
+    async def load(self, session):
+        """Render the configs of all clients with a virtual address."""
+        await self.configs.sync_version(session)
+        server = (await session.exec(select(Server))).first()
+        if not server:
+            self.configs.invalidate()
+            logger.info("Server not initialized yet, no client configs loaded.")
+            return
+
+        networks = await active_networks(session)
+        statement = (
+            select(Client)
+            .where(col(Client.virtual_address_id).is_not(None))
+            .options(selectinload(Client.virtual_address))  # type: ignore
+        )
+        count = 0
+        for client in (await session.exec(statement)).all():
+            self.configs.set(
+                client.name,
+                render_client_config(client, server.subnet_mask, networks[client.name]),
+            )
+            count += 1
+        logger.info(f"Loaded {count} client configs.")
+
+    @traced("ccd.refresh")
+    async def refresh(self, session, name: str) -> str:
+        """Render the config of one client again, empty if it has none."""
+        server = (await session.exec(select(Server))).first()
+        statement = (
+            select(Client)
+            .where(Client.name == name)
+            .options(selectinload(Client.virtual_address))  # type: ignore
+        )
+        client = (await session.exec(statement)).one_or_none()
+
+        config = ""
+        if server and client:
+            networks = await active_networks(session, name)
+            config = render_client_config(client, server.subnet_mask, networks[name])
+
+        # the rejected ones too, not rendered again on each of their attempts
+        self.configs.set(name, config)
+        logger.info(f"Refreshed the config of client {name}.")
+        return config
+
+    async def invalidate(self, session):
+        """Drop the configs on every worker, in the session's transaction."""
+        await self.configs.bump(session)
+
+    async def lookup(self, name: str) -> str:
+        """The config of a client, rendered if dropped since the last change."""
+        config = None if self.configs.is_check_due() else self.configs.get(name)
+        if config is None:
+            async with self.sessions() as session:
+                await self.configs.sync_version(session)
+                config = self.configs.get(name)
+                if config is None:
+                    config = await self.refresh(session, name)
+        return config
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            name = (await reader.readline()).decode().strip()
+            config = await self.lookup(name)
+            if not config:
+                logger.warning(f"No config for client {name}, rejecting it.")
+            writer.write(config.encode())
+            await writer.drain()
+        finally:
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+
+    async def take_over(self) -> bool:
+        """Serve the configs if no other worker owns the socket, whether it does."""
+        if not self.lock.acquire():
+            return False
+
+        try:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path)  # left over by an unclean shutdown of the owner
+
+            async with self.sessions() as session:
+                await self.load(session)
+            self.server = await asyncio.start_unix_server(self.handle, self.path)
+            os.chmod(self.path, 0o660)
+        except BaseException:
+            await self.close()
+            raise
+        logger.info(f"Serving client configs on {self.path}.")
+        return True
+
+    async def run(self, owner_retry_interval: float = CCD_OWNER_RETRY_INTERVAL):
+        """Serve the configs until stopped, on the one worker holding the lock."""
+        self.stopped = asyncio.Event()
+        standing_by = False
+        while not self.stopped.is_set():
+            try:
+                if not self.lock.owned and not await self.take_over():
+                    if not standing_by:
+                        logger.info(
+                            f"Client configs served by another worker on "
+                            f"{self.path}, taken over once it is gone."
+                        )
+                    standing_by = True
+            except Exception as e:  # noqa: BLE001 - taken over again next round
+                logger.error(f"Failed to serve client configs on {self.path}: {e}")
+
+            try:
+                await asyncio.wait_for(self.stopped.wait(), owner_retry_interval)
+            except TimeoutError:
+                pass
+
+        await self.close()
+
+    def stop(self):
+        if self.stopped is not None:
+            self.stopped.set()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+            logger.info("Stopped serving client configs.")
+        self.lock.release()
+
+
+client_configs = ClientConfigIndex()
+
+
+def main():
+    """Rebuild the ccd directory from the DB, after a restore or a host move."""
+
+    async def run():
+        async with asynccontextmanager(get_async_session)() as session:
+            return await rebuild_ccd(session)
+
+    print(asyncio.run(run()).model_dump_json())
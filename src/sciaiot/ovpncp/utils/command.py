@@ -0,0 +1,36 @@
+"""Commands run for the routes, timed into the request they serve."""
+
+import subprocess
+import time
+
+from sciaiot.ovpncp.utils import metrics, tracing
+from sciaiot.ovpncp.utils.context import timed
+from sciaiot.ovpncp.utils.logging import mask_sensitive
+
+
+def run(cmd: list[str], **kwargs) -> subprocess.CompletedProcess:
+    """`subprocess.run`, its time added to the "subprocess" phase.
+
+    Its duration & its failure, raised as with `check=True`, are also counted
+    by tool in the metrics, and it is traced as a span of the request, its
+    arguments masked as in the logs.
+    """
+    tool = metrics.tool_name(cmd)
+    start = time.perf_counter()
+    try:
+        with (
+            timed("subprocess"),
+            tracing.span(
+                f"command {tool}",
+                attributes={
+                    "process.command": tool,
+                    "process.command_args": [mask_sensitive(arg) for arg in cmd],
+                },
+            ),
+        ):
+            return subprocess.run(cmd, **kwargs)  # noqa: PLW1510 - check given by the callers
+    except (subprocess.SubprocessError, OSError):
+        metrics.command_failures.labels(tool).inc()
+        raise
+    finally:
+        metrics.command_duration.labels(tool).observe(time.perf_counter() - start)
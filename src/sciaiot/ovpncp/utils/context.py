@@ -0,0 +1,116 @@
+"""Context of the request being served, stamped into its log records."""
+
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.types import Scope
+
+# stamped into every record, None out of a request
+CONTEXT_FIELDS = ("request_id", "route", "client_name", "latency_ms")
+
+
+def route_template(scope: Scope) -> str | None:
+    """The path template of the matched route, None if no route matched.
+
+    The routes of the included routers are copied with their prefix, so the
+    template of the route is the full one.
+    """
+    route = scope.get("route")
+    return getattr(route, "path_format", None)
+
+
+class RequestContext:
+    """Id, timings & the routing of a request, read from its ASGI scope.
+
+    The route & its client name are only known once the router matched the
+    request, so they are looked up when a record is logged.
+    """
+
+    __slots__ = ("phases", "request_id", "scope", "started_at")
+
+    def __init__(self, request_id: str, scope: Scope):
+        self.request_id = request_id
+        self.scope = scope
+        self.started_at = time.perf_counter()
+        self.phases: dict[str, float] = {}
+
+    @property
+    def route(self) -> str | None:
+        return route_template(self.scope)
+
+    @property
+    def client_name(self) -> str | None:
+        return self.scope.get("path_params", {}).get("client_name")
+
+    @property
+    def latency_ms(self) -> float:
+        return round((time.perf_counter() - self.started_at) * 1000, 3)
+
+    def add_phase(self, name: str, seconds: float):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def phases_ms(self) -> dict[str, float]:
+        return {name: round(s * 1000, 3) for name, s in self.phases.items()}
+
+
+request_context: ContextVar[RequestContext | None] = ContextVar(
+    "request_context", default=None
+)
+
+
+@contextmanager
+def timed(phase: str):
+    """Add the time spent in the block to a phase of the current request."""
+    context = request_context.get()
+    if context is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        context.add_phase(phase, time.perf_counter() - start)
+
+
+def time_queries(engine: Engine):
+    """Add the time spent in the queries of the engine to the "db" phase."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_query(conn, cursor, statement, parameters, context, executemany):
+        if request_context.get() is not None:
+            conn.info.setdefault("query_started_at", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def end_query(conn, cursor, statement, parameters, context, executemany):
+        started_at = conn.info.get("query_started_at")
+        request = request_context.get()
+        if started_at and request is not None:
+            request.add_phase("db", time.perf_counter() - started_at.pop())
+
+
+def install_record_factory():
+    """Stamp the context of the request into the records as they are created.
+
+    In the logging thread, as the records may be formatted by another one.
+    """
+    factory = logging.getLogRecordFactory()
+    if getattr(factory, "stamps_context", False):
+        return
+
+    def stamped_record(*args, **kwargs) -> logging.LogRecord:
+        record = factory(*args, **kwargs)
+        context = request_context.get()
+        if context is not None:
+            record.request_id = context.request_id
+            record.route = context.route
+            record.client_name = context.client_name
+            record.latency_ms = context.latency_ms
+        return record
+
+    stamped_record.stamps_context = True  # type: ignore
+    logging.setLogRecordFactory(stamped_record)
@@ -0,0 +1,257 @@
+"""Coalescing writer for connection events."""
+
+import asyncio
+import logging
+import os
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from sqlmodel import col, select
+
+from sciaiot.ovpncp.data.server import (
+    Client,
+    Connection,
+    ConnectionEvent,
+    ConnectionEventsResult,
+    RejectedConnectionEvent,
+)
+from sciaiot.ovpncp.dependencies import get_async_session
+from sciaiot.ovpncp.utils.broadcast import broadcaster
+from sciaiot.ovpncp.utils.cache import client_cache
+
+logger = logging.getLogger(__name__)
+
+INGESTION_INTERVAL = float(os.getenv("INGESTION_INTERVAL", "0.005"))
+INGESTION_MAX_BATCH = int(os.getenv("INGESTION_MAX_BATCH", "5000"))
+# bound of the IN lists, far below the variable limit of every backend
+QUERY_CHUNK_SIZE = 500
+
+
+def to_local(time: datetime) -> datetime:
+    """Drop the time zone of a connection time, the status file has none.
+
+    The connection times are stored as naive local times, the aware ones of
+    the hooks are converted first.
+    """
+    if time.tzinfo is None:
+        return time
+    return time.astimezone().replace(tzinfo=None)
+
+
+def chunks(items: list, size: int = QUERY_CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+async def resolve_client_ids(session, names: set[str]) -> dict[str, int]:
+    """Map client names to IDs through the cache, querying the missing ones."""
+    await client_cache.sync_version(session)
+    client_ids = {}
+    missing = []
+    for name in names:
+        client_id = client_cache.get(name)
+        if client_id is None:
+            missing.append(name)
+        else:
+            client_ids[name] = client_id
+
+    for chunk in chunks(missing):
+        statement = select(Client.id, Client.name).where(col(Client.name).in_(chunk))
+        for client_id, name in (await session.exec(statement)).all():
+            client_cache.set(name, client_id)
+            client_ids[name] = client_id
+
+    return client_ids
+
+
+class ConnectionEventWriter:
+    """Group commit for connection events submitted by concurrent requests.
+
+    The first submission opens a window of `interval` seconds; everything
+    submitted until it closes is written in one transaction, with one client
+    lookup and one open-connection lookup for the whole batch. Submissions
+    arriving during the write are picked up by the next round of the same
+    task, so batches never run concurrently.
+    """
+
+    def __init__(
+        self,
+        session_factory,
+        interval: float = INGESTION_INTERVAL,
+        max_batch: int = INGESTION_MAX_BATCH,
+    ):
+        self.session_factory = session_factory
+        self.interval = interval
+        self.max_batch = max_batch
+        self.pending: deque[tuple[list[ConnectionEvent], asyncio.Future]] = deque()
+        self.flush_task: asyncio.Task | None = None
+
+    async def submit(self, events: list[ConnectionEvent]) -> ConnectionEventsResult:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((events, future))
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush_later())
+        return await future
+
+    async def flush_later(self):
+        await asyncio.sleep(self.interval)
+        while self.pending:
+            batch = []
+            size = 0
+            while self.pending and (not batch or size < self.max_batch):
+                events, future = self.pending.popleft()
+                batch.append((events, future))
+                size += len(events)
+            await self.write(batch)
+
+    async def write(self, batch: list[tuple[list[ConnectionEvent], asyncio.Future]]):
+        results = [ConnectionEventsResult() for _ in batch]
+        try:
+            async with self.session_factory() as session:
+                accepted_events = await self.apply(session, batch, results)
+                await session.commit()
+        except Exception as e:  # noqa: BLE001 - raised to the waiting requests
+            logger.error(
+                f"Failed to write {len(batch)} connection event batch(es): {e}"
+            )
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        accepted = sum(result.accepted for result in results)
+        logger.info(f"Wrote {accepted} connection events from {len(batch)} request(s).")
+        broadcaster.publish(accepted_events)
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def apply(
+        self, session, batch, results: list[ConnectionEventsResult]
+    ) -> list[ConnectionEvent]:
+        accepted_events = []
+        names = {event.client_name for events, _ in batch for event in events}
+        client_ids = await resolve_client_ids(session, names)
+
+        disconnecting = {
+            client_ids[event.client_name]
+            for events, _ in batch
+            for event in events
+            if event.type == "disconnect" and event.client_name in client_ids
+        }
+        open_connections = await self.find_open_connections(session, disconnecting)
+        connected = await self.find_connected(
+            session,
+            [
+                (client_ids[event.client_name], to_local(event.time))
+                for events, _ in batch
+                for event in events
+                if event.type == "connect" and event.client_name in client_ids
+            ],
+        )
+
+        for (events, _), result in zip(batch, results):
+            for index, event in enumerate(events):
+                client_id = client_ids.get(event.client_name)
+                if client_id is None:
+                    result.rejected.append(
+                        RejectedConnectionEvent(
+                            index=index,
+                            detail=f'Client "{event.client_name}" not found!',
+                        )
+                    )
+                    continue
+
+                key = (client_id, event.remote_address)
+                # compared with the naive times of the connections read
+                time = to_local(event.time)
+                if event.type == "connect":
+                    connected_key = (*key, time)
+                    if connected_key in connected:
+                        # delivered again, e.g. replayed from the spool
+                        result.accepted += 1
+                        continue
+
+                    connected.add(connected_key)
+                    connection = Connection(
+                        client_id=client_id,
+                        remote_address=event.remote_address,
+                        connected_time=time,
+                    )
+                    session.add(connection)
+                    open_connections[key].append(connection)
+                    accepted_events.append(event)
+                    result.accepted += 1
+                    continue
+
+                candidates = open_connections.get(key)
+                if not candidates:
+                    result.rejected.append(
+                        RejectedConnectionEvent(
+                            index=index,
+                            detail=f'Connection with client "{event.client_name}" not found!',
+                        )
+                    )
+                    continue
+
+                # close the latest one, same as the single disconnect endpoint
+                latest = max(candidates, key=lambda c: c.connected_time)
+                candidates.remove(latest)
+                latest.disconnected_time = time
+                session.add(latest)
+                accepted_events.append(event)
+                result.accepted += 1
+
+        return accepted_events
+
+    async def find_open_connections(self, session, client_ids: set[int]):
+        open_connections = defaultdict(list)
+        for chunk in chunks(sorted(client_ids)):
+            statement = select(Connection).where(
+                col(Connection.client_id).in_(chunk),
+                Connection.disconnected_time == None,
+            )
+            for connection in (await session.exec(statement)).all():
+                key = (connection.client_id, connection.remote_address)
+                open_connections[key].append(connection)
+
+        return open_connections
+
+    async def find_connected(
+        self, session, connects: list[tuple[int, datetime]]
+    ) -> set[tuple[int, str, datetime]]:
+        """The connections already written of the connect events, by their key.
+
+        The connections of the clients are read within the time range of the
+        events, given in naive local time as stored.
+        """
+        connected: set[tuple[int, str, datetime]] = set()
+        if not connects:
+            return connected
+
+        times = [time for _, time in connects]
+        for chunk in chunks(sorted({client_id for client_id, _ in connects})):
+            statement = select(
+                Connection.client_id,
+                Connection.remote_address,
+                Connection.connected_time,
+            ).where(
+                col(Connection.client_id).in_(chunk),
+                col(Connection.connected_time).between(min(times), max(times)),
+            )
+            for client_id, remote_address, connected_time in (
+                await session.exec(statement)
+            ).all():
+                connected.add(
+                    (client_id, remote_address, connected_time.replace(tzinfo=None))
+                )
+
+        return connected
+
+
+event_writer = ConnectionEventWriter(asynccontextmanager(get_async_session))
+
+
+def get_event_writer() -> ConnectionEventWriter:
+    return event_writer
@@ -1,6 +1,7 @@
 import logging
 import re
-import subprocess
+
+from sciaiot.ovpncp.utils import command
 
 logger = logging.getLogger(__name__)
 
@@ -23,7 +24,7 @@ def validate_dev(dev_name: str):
 def list(dev_name):
     validate_dev(dev_name)
     logging.info(f"Listing routes on {dev_name}...")
-    result = subprocess.run(
+    result = command.run(
         ["ip", "route", "show", "dev", dev_name],
         capture_output=True,
         text=True,
@@ -40,7 +41,7 @@ def add(private_network, server_ip, dev_name):
     validate_dev(dev_name)
 
     logging.info(f"Adding route for {private_network} via {server_ip} on {dev_name}...")
-    subprocess.run(
+    command.run(
         ["ip", "route", "add", private_network, "via", server_ip, "dev", dev_name],
         shell=False,
         check=True,
@@ -64,5 +65,5 @@ def delete(route, dev_name):
             validate_ip_or_net(part)
 
     cmd = ["ip", "route", "del"] + parts + ["dev", dev_name]
-    subprocess.run(cmd, shell=False, check=True)
+    command.run(cmd, shell=False, check=True)
     logging.info(f"Deleted IP route from {dev_name}")
@@ -1,5 +1,7 @@
 import logging
-import subprocess
+
+from sciaiot.ovpncp.utils import command
+from sciaiot.ovpncp.utils.tracing import traced
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +25,7 @@ def validate_rule(rule: str):
         raise ValueError(f"Malicious characters detected in rule: {rule}")
 
 
+@traced()
 def list_rules(chain):
     """
     List iptables rules for a specified chain with line numbers.
@@ -34,7 +37,7 @@ def list_rules(chain):
     validate_chain(chain)
     logging.info(f"Listing iptables rules for chain: {chain}")
     # Execute the iptables command with the --line-numbers and --list options
-    result = subprocess.run(
+    result = command.run(
         ["iptables", "-L", chain, "--line-numbers"],
         capture_output=True,
         text=True,
@@ -50,6 +53,7 @@ def list_rules(chain):
     return rules
 
 
+@traced()
 def apply_rules(chain, line_number, rules):
     """
     Insert multiple iptables rules before a specified line number in the given chain.
@@ -71,11 +75,12 @@ def apply_rules(chain, line_number, rules):
         cmd = ["iptables", "-I", chain, str(current_line)] + rule_parts
 
         logging.info(f"Executing iptables command: {' '.join(cmd)}")
-        subprocess.run(cmd, shell=False, check=True)
+        command.run(cmd, shell=False, check=True)
 
     logging.info(f"Successfully inserted all iptables rules in chain {chain}.")
 
 
+@traced()
 def drop_rules(chain, rules):
     """
     Drop multiple iptables rules in the given chain.
@@ -90,6 +95,6 @@ def drop_rules(chain, rules):
         cmd = ["iptables", "-D", chain] + rule_parts
 
         logging.info(f"Executing iptables command: {' '.join(cmd)}")
-        subprocess.run(cmd, shell=False, check=True)
+        command.run(cmd, shell=False, check=True)
 
     logging.info(f"Successfully dropped all iptables rules in chain {chain}.")
@@ -0,0 +1,215 @@
+"""Caches of the token signing keys & of the tokens verified with them."""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+from urllib.request import urlopen
+
+from fastapi.concurrency import run_in_threadpool
+from jose import jwk
+from jose.backends.base import Key
+
+from sciaiot.ovpncp.utils import metrics
+
+logger = logging.getLogger(__name__)
+
+JWKS_CACHE_TTL = float(os.getenv("JWKS_CACHE_TTL", "3600"))
+# an unknown kid refetches the keys at most this often, against floods of them
+JWKS_REFETCH_INTERVAL = float(os.getenv("JWKS_REFETCH_INTERVAL", "60"))
+JWKS_TIMEOUT = float(os.getenv("JWKS_TIMEOUT", "5"))
+# verified tokens kept, 0 verifies every request
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "1024"))
+
+
+class JwksCache:
+    """Public keys by kid, built once per fetch.
+
+    Keys older than the TTL are still served while a background thread
+    refetches them. A request only waits on the network when there are no
+    keys at all, or for a kid missing from the cached set, e.g. after a key
+    rotation, and then in the threadpool. The fetches are attempted at most
+    once per refetch interval, failed or empty ones included.
+    """
+
+    def __init__(
+        self,
+        ttl: float = JWKS_CACHE_TTL,
+        refetch_interval: float = JWKS_REFETCH_INTERVAL,
+        timeout: float = JWKS_TIMEOUT,
+    ):
+        self.ttl = ttl
+        self.refetch_interval = refetch_interval
+        self.timeout = timeout
+        self.url: str | None = None
+        self.keys: dict[str, Key] = {}
+        self.fetched_at = 0.0
+        self.attempted_at = float("-inf")
+        self.lock = threading.Lock()
+        self.refreshing = False
+        self.fetches = 0
+
+    def use(self, url: str):
+        if url != self.url:
+            # another issuer, e.g. after a change of tenant
+            with self.lock:
+                self.url, self.keys = url, {}
+                self.fetched_at, self.attempted_at = 0.0, float("-inf")
+
+    def warm(self, url: str):
+        """Fetch the keys ahead of the first request."""
+        self.use(url)
+        self.refetch()
+
+    def is_refetch_due(self) -> bool:
+        return time.monotonic() - self.attempted_at >= self.refetch_interval
+
+    def cached(self, url: str, kid: str) -> Key | None:
+        """The cached key of the kid, refreshed in the background when stale."""
+        self.use(url)
+        key = self.keys.get(kid)
+        if key is not None and time.monotonic() - self.fetched_at > self.ttl:
+            self.refresh_in_background()
+        return key
+
+    def get(self, url: str, kid: str) -> Key | None:
+        key = self.cached(url, kid)
+        if key is not None:
+            return key
+
+        # no keys yet or an unknown kid, which may have been rotated in
+        self.refetch()
+        return self.keys.get(kid)
+
+    async def get_async(self, url: str, kid: str) -> Key | None:
+        """The key of the kid, fetched in the threadpool, off the event loop."""
+        key = self.cached(url, kid)
+        if key is None and self.is_refetch_due():
+            key = await run_in_threadpool(self.get, url, kid)
+        return key
+
+    def refetch(self):
+        with self.lock:
+            # attempted recently, by this thread or another one
+            if not self.is_refetch_due():
+                return
+
+            self.attempted_at = time.monotonic()
+            self.keys = self.fetch(self.require_url())
+            self.fetched_at = time.monotonic()
+
+    def refresh_in_background(self):
+        with self.lock:
+            if self.refreshing or not self.is_refetch_due():
+                return
+            self.refreshing = True
+            self.attempted_at = time.monotonic()
+            url = self.require_url()
+
+        def run():
+            try:
+                keys = self.fetch(url)
+                with self.lock:
+                    self.keys = keys
+                    self.fetched_at = time.monotonic()
+            except Exception as e:  # noqa: BLE001 - the stale keys are kept
+                # retried by a request once the refetch interval is over
+                logger.error(f"Failed to refresh the signing keys: {e}")
+            finally:
+                self.refreshing = False
+
+        threading.Thread(target=run, name="jwks-refresh", daemon=True).start()
+
+    def require_url(self) -> str:
+        if self.url is None:
+            raise ValueError("The URL of the signing keys is not set!")
+        return self.url
+
+    def fetch(self, url: str) -> dict[str, Key]:
+        logger.info(f"Fetching the signing keys from {url}...")
+        with urlopen(url, timeout=self.timeout) as response:
+            jwks = json.loads(response.read())
+        self.fetches += 1
+        metrics.jwks_fetches.inc()
+
+        keys = {}
+        for key in jwks.get("keys", []):
+            if key.get("kty") != "RSA" or "kid" not in key:
+                continue
+            try:
+                keys[key["kid"]] = jwk.construct(key, "RS256")
+            except Exception as e:  # noqa: BLE001 - the other keys are still used
+                logger.warning(f"Skipped the signing key {key['kid']}: {e}")
+
+        logger.info(f"Fetched {len(keys)} signing keys.")
+        return keys
+
+
+class VerifiedTokenCache:
+    """LRU of the payloads of verified tokens, each kept until its `exp`.
+
+    Entries are keyed by the SHA-256 of the token, so the tokens themselves
+    are not kept in memory; a repeated token costs a hash and a lookup
+    instead of the claims decoding and the RSA verification.
+    """
+
+    def __init__(self, max_size: int = TOKEN_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries: OrderedDict[bytes, tuple[float, dict[str, Any]]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.hit_counter = metrics.cache_requests.labels("token", "hit")
+        self.miss_counter = metrics.cache_requests.labels("token", "miss")
+        self.expirations = 0
+        self.evictions = 0
+
+    @staticmethod
+    def digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> dict[str, Any] | None:
+        key = self.digest(token)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                self.miss_counter.inc()
+                return None
+
+            if entry[0] <= time.time():
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                self.miss_counter.inc()
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.hit_counter.inc()
+            return entry[1]
+
+    def set(self, token: str, payload: dict[str, Any]):
+        expires_at = payload.get("exp")
+        if self.max_size <= 0 or not isinstance(expires_at, (int, float)):
+            return
+
+        key = self.digest(token)
+        with self.lock:
+            self.entries[key] = (expires_at, payload)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+jwks_cache = JwksCache()
+token_cache = VerifiedTokenCache()
@@ -0,0 +1,72 @@
+"""File locks shared by the app's workers, e.g. electing the one owning a task."""
+
+import contextlib
+import fcntl
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class OwnerLock:
+    """An exclusive `flock` on a file, taken without waiting & held until released.
+
+    Each worker of the app tries to take it and only the one holding it runs
+    the task, e.g. reads the spool or serves the ccd socket. The lock goes
+    with the process, so the worker started in place of a dead owner takes
+    the task over.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fd: int | None = None
+
+    @property
+    def owned(self) -> bool:
+        return self.fd is not None
+
+    def acquire(self) -> bool:
+        """Take the lock if no other process holds it, whether it is owned."""
+        if self.fd is not None:
+            return True
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+
+        self.fd = fd
+        logger.info(f"Took the lock {self.path}, pid {os.getpid()} owns it.")
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+
+@contextlib.contextmanager
+def file_lock(path: str):
+    """Hold an exclusive `flock` on a file, waiting for the other holders.
+
+    The file is removed on release so the locks don't pile up, e.g. one per
+    client; a holder having opened the file removed meanwhile opens it again.
+    """
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.path.samestat(os.fstat(fd), os.stat(path)):
+                break
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+    try:
+        yield
+    finally:
+        os.remove(path)
+        os.close(fd)
@@ -2,8 +2,52 @@
 
 import json
 import logging
+import logging.handlers
+import os
+import queue
 import re
 
+from sciaiot.ovpncp.utils import metrics
+from sciaiot.ovpncp.utils.context import CONTEXT_FIELDS
+
+try:
+    import orjson
+except ImportError:  # optional, the standard encoder is used instead
+    orjson = None  # type: ignore[assignment]
+
+# records waiting for the listener thread, 0 writes them in the request path
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# records formatted & written at once by the listener thread
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "100"))
+
+# of the request & of its access record, set on the records that have them
+RECORD_FIELDS = (*CONTEXT_FIELDS, "method", "status", "phases")
+
+# the sensitive data, matched in one pass & masked by the name of its group
+SENSITIVE_PATTERNS = {
+    "private_key": r"-----BEGIN (?P<key_type>[A-Z ]*)PRIVATE KEY-----"
+    r".*?-----END (?P=key_type)PRIVATE KEY-----",
+    "bearer": r"\bBearer\s+[\w.~+/-]+=*",
+    "signature": r"(?P<param>[?&;](?:sig|Signature|X-Amz-Signature|X-Amz-Security-Token)=)"
+    r"[^&\s\"']+",
+    # unrolled, faster than a repeated group
+    "ipv4": r"\b\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}\b",
+}
+# the first characters of the patterns, the others are skipped right away
+SENSITIVE_DATA = re.compile(
+    r"(?=[-B?&;0-9])(?:"
+    + "|".join(f"(?P<{name}>{pattern})" for name, pattern in SENSITIVE_PATTERNS.items())
+    + ")",
+    re.DOTALL,
+)
+
+
+def dumps(log_record: dict) -> str:
+    if orjson is not None:
+        # the standard encoder's str() of what orjson can't encode
+        return orjson.dumps(log_record, default=str).decode()
+    return json.dumps(log_record, default=str)
+
 
 class JSONFormatter(logging.Formatter):
     """Formatter for JSON structured logging."""
@@ -16,9 +60,180 @@ class JSONFormatter(logging.Formatter):
             "name": record.name,
             "message": record.getMessage(),
         }
+        for field in RECORD_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                log_record[field] = value
         if record.exc_info:
-            log_record["exc_info"] = self.formatException(record.exc_info)
-        return json.dumps(log_record)
+            # formatted once, masked, by the filter of the handler if any
+            log_record["exc_info"] = record.exc_text or self.formatException(
+                record.exc_info
+            )
+        if record.stack_info:
+            log_record["stack_info"] = record.stack_info
+        return dumps(log_record)
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """Queues the records for the listener thread, dropping them when full.
+
+    The request path only merges the message with its arguments; formatting
+    & I/O are left to the listener. A full queue never blocks the event
+    loop, the records are dropped & counted instead.
+    """
+
+    def __init__(self, size: int = LOG_QUEUE_SIZE):
+        super().__init__(queue.Queue(size))
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            metrics.log_records_dropped.inc()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the arguments may change once the call returned, not the message;
+        # merged in place, the other handlers get the same message from it
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+    """Writes the queued records in batches, one write & flush per handler.
+
+    Reports the records dropped by the queue handler since the last batch
+    with a warning of its own.
+    """
+
+    def __init__(
+        self,
+        source: BoundedQueueHandler,
+        *handlers: logging.Handler,
+        batch_size: int = LOG_BATCH_SIZE,
+    ):
+        super().__init__(source.queue, *handlers, respect_handler_level=True)
+        self.source = source
+        self.batch_size = batch_size
+        self.reported = 0
+
+    def enqueue_sentinel(self):
+        # waits for room, unlike the records
+        self.queue.put(self._sentinel)
+
+    def _monitor(self):
+        stopping = False
+        while not stopping:
+            records = [self.queue.get()]
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for _ in records:
+                self.queue.task_done()
+
+            if self._sentinel in records:
+                records = [r for r in records if r is not self._sentinel]
+                stopping = True
+            self.handle_batch(records)
+
+    def handle_batch(self, records: list[logging.LogRecord]):
+        dropped = self.source.dropped
+        if dropped > self.reported:
+            records.append(
+                logging.makeLogRecord(
+                    {
+                        "name": __name__,
+                        "levelno": logging.WARNING,
+                        "levelname": "WARNING",
+                        "msg": f"Dropped {dropped - self.reported} log records, "
+                        "the queue was full.",
+                    }
+                )
+            )
+            self.reported = dropped
+        if not records:
+            return
+
+        for handler in self.handlers:
+            try:
+                write_batch(handler, records)
+            except Exception:  # noqa: BLE001 - reported as logging.Handler does
+                handler.handleError(records[-1])
+
+
+def write_batch(handler: logging.Handler, records: list[logging.LogRecord]):
+    records = [r for r in records if r.levelno >= handler.level and handler.filter(r)]
+    if not records:
+        return
+    if not isinstance(handler, logging.StreamHandler):
+        for record in records:
+            handler.handle(record)
+        return
+
+    lines = []
+    for record in records:
+        try:
+            lines.append(handler.format(record) + handler.terminator)
+        except Exception:  # noqa: BLE001 - reported as logging.Handler does
+            handler.handleError(record)
+
+    with handler.lock:  # type: ignore
+        if isinstance(
+            handler,
+            (
+                logging.handlers.RotatingFileHandler,
+                logging.handlers.TimedRotatingFileHandler,
+            ),
+        ) and handler.shouldRollover(records[0]):
+            handler.doRollover()
+        if handler.stream is None:
+            # a file handler opening its file on the first record
+            handler.stream = handler._open()  # type: ignore
+        handler.stream.write("".join(lines))
+        handler.flush()
+
+
+queue_listener: BatchingQueueListener | None = None
+
+
+def queue_handlers(logger: logging.Logger, size: int = LOG_QUEUE_SIZE):
+    """Move the handlers of the logger behind a queue & a listener thread."""
+    global queue_listener
+    if size <= 0 or not logger.handlers:
+        return
+
+    handler = BoundedQueueHandler(size)
+    queue_listener = BatchingQueueListener(handler, *logger.handlers)
+    logger.handlers = [handler]
+    queue_listener.start()
+
+
+def unqueue_handlers(logger: logging.Logger):
+    """Stop the listener, writing the queued records, & restore the handlers."""
+    global queue_listener
+    if queue_listener is None:
+        return
+
+    queue_listener.stop()
+    logger.handlers = [
+        h for h in logger.handlers if h is not queue_listener.source
+    ] + list(queue_listener.handlers)
+    queue_listener = None
+
+
+def mask_match(match: re.Match) -> str:
+    name = match.lastgroup
+    if name == "signature":
+        return f"{match['param']}***"
+    elif name == "ipv4":
+        return "***.***.***.***"
+    elif name == "bearer":
+        return "Bearer ***"
+    return f"-----{match['key_type']}PRIVATE KEY REDACTED-----"
 
 
 def mask_sensitive(text: str) -> str:
@@ -26,10 +241,29 @@ def mask_sensitive(text: str) -> str:
     if not isinstance(text, str):
         return text
 
-    # Mask SAS signature (e.g., sig=SENSITIVE_TOKEN)
-    text = re.sub(r"sig=[^&]+", "sig=***", text)
+    return SENSITIVE_DATA.sub(mask_match, text)
+
+
+class SensitiveDataFilter(logging.Filter):
+    """Masks the sensitive data of the records, see `SENSITIVE_PATTERNS`.
+
+    Set on the handlers, so only the records they emit are masked, in the
+    listener thread when the handlers are queued. A record is masked once,
+    whatever the number of handlers: its message, its traceback, formatted
+    into `exc_text` which the formatters reuse, and its stack.
+    """
 
-    # Mask IPv4 addresses
-    text = re.sub(r"\b(?:\d{1,3}\.){3}\d{1,3}\b", "***.***.***.***", text)
+    formatter = logging.Formatter()
 
-    return text
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "masked", False):
+            record.msg = mask_sensitive(record.getMessage())
+            record.args = None
+            if record.exc_info and not record.exc_text:
+                record.exc_text = self.formatter.formatException(record.exc_info)
+            if record.exc_text:
+                record.exc_text = mask_sensitive(record.exc_text)
+            if record.stack_info:
+                record.stack_info = mask_sensitive(record.stack_info)
+            record.masked = True
+        return True
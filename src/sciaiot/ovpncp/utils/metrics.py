@@ -0,0 +1,199 @@
+"""Prometheus metrics of the API, the database & the commands run.
+
+Under several uvicorn workers, set `PROMETHEUS_MULTIPROC_DIR` to an empty
+directory: each worker writes its samples there and `/metrics` merges them,
+whichever worker serves it.
+"""
+
+import os
+import time
+from typing import Literal
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:  # optional, the metrics are not collected then
+    prometheus_client = None  # type: ignore[assignment]
+
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+# the statements counted apart, the others as OTHER
+QUERY_OPERATIONS = ("SELECT", "INSERT", "UPDATE", "DELETE")
+# the route of the requests no route matched, against unbounded labels
+UNMATCHED_ROUTE = "unmatched"
+
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+COMMAND_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# how the samples of a gauge are merged across the workers, "live" ones
+# dropping the samples of the dead workers
+MultiprocessMode = Literal[
+    "all",
+    "liveall",
+    "min",
+    "livemin",
+    "max",
+    "livemax",
+    "sum",
+    "livesum",
+    "mostrecent",
+    "livemostrecent",
+]
+
+
+class NullMetric:
+    """Stands in for the metrics when prometheus_client is not installed."""
+
+    def labels(self, *args, **kwargs) -> "NullMetric":
+        return self
+
+    def inc(self, amount: float = 1):
+        pass
+
+    def set(self, value: float):
+        pass
+
+    def observe(self, amount: float):
+        pass
+
+
+def is_enabled() -> bool:
+    return prometheus_client is not None
+
+
+def counter(name: str, documentation: str, labels: tuple[str, ...] = ()):
+    if prometheus_client is None:
+        return NullMetric()
+    return prometheus_client.Counter(name, documentation, labels)
+
+
+def histogram(name: str, documentation: str, labels: tuple[str, ...], buckets=None):
+    if prometheus_client is None:
+        return NullMetric()
+    return prometheus_client.Histogram(
+        name,
+        documentation,
+        labels,
+        buckets=buckets or prometheus_client.Histogram.DEFAULT_BUCKETS,
+    )
+
+
+def gauge(
+    name: str, documentation: str, labels: tuple[str, ...], mode: MultiprocessMode
+):
+    """A gauge, merged across the workers by the multiprocess mode."""
+    if prometheus_client is None:
+        return NullMetric()
+    return prometheus_client.Gauge(name, documentation, labels, multiprocess_mode=mode)
+
+
+request_duration = histogram(
+    "ovpncp_http_request_duration_seconds",
+    "Latency of the HTTP requests by route template.",
+    ("method", "route", "status"),
+)
+query_duration = histogram(
+    "ovpncp_db_query_duration_seconds",
+    "Duration of the database queries by operation.",
+    ("operation",),
+    buckets=QUERY_BUCKETS,
+)
+pool_connections = gauge(
+    "ovpncp_db_pool_connections",
+    "Connections of the database pools, checked out or idle.",
+    ("pool", "state"),
+    mode="livesum",
+)
+command_duration = histogram(
+    "ovpncp_command_duration_seconds",
+    "Duration of the external commands by tool.",
+    ("tool",),
+    buckets=COMMAND_BUCKETS,
+)
+command_failures = counter(
+    "ovpncp_command_failures_total",
+    "External commands failed or exited with a non-zero status, by tool.",
+    ("tool",),
+)
+active_connections = gauge(
+    "ovpncp_active_connections",
+    "Open VPN connections, counted when scraped.",
+    (),
+    mode="livemostrecent",
+)
+cache_requests = counter(
+    "ovpncp_cache_requests_total",
+    "Lookups of the in-process caches by result, hit or miss.",
+    ("cache", "result"),
+)
+jwks_fetches = counter(
+    "ovpncp_jwks_fetches_total",
+    "Fetches of the signing keys of Azure Entra ID.",
+)
+log_records_dropped = counter(
+    "ovpncp_log_records_dropped_total",
+    "Log records dropped as the logging queue was full.",
+)
+
+
+def query_operation(statement: str) -> str:
+    operation = statement.lstrip()[:6].upper()
+    return operation if operation in QUERY_OPERATIONS else "OTHER"
+
+
+def tool_name(cmd: list[str]) -> str:
+    """The tool of the command, e.g. `easyrsa` for `./easyrsa`."""
+    return os.path.basename(cmd[0]) if cmd else "unknown"
+
+
+def instrument_engine(engine: Engine, name: str):
+    """Observe the queries & the pool of the engine, named in its samples."""
+    if prometheus_client is None:
+        return
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_query(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_started_at", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def end_query(conn, cursor, statement, parameters, context, executemany):
+        started_at = conn.info.get("metrics_started_at")
+        if started_at:
+            query_duration.labels(query_operation(statement)).observe(
+                time.perf_counter() - started_at.pop()
+            )
+
+    pool = engine.pool
+    # only the queue pools count their connections
+    if not isinstance(pool, QueuePool):
+        return
+
+    def update_pool(returning: int):
+        pool_connections.labels(name, "checked_out").set(pool.checkedout() - returning)
+        pool_connections.labels(name, "idle").set(pool.checkedin() + returning)
+
+    # a connection is checked in before it is back in the pool
+    event.listen(pool, "checkout", lambda *args: update_pool(0))
+    event.listen(pool, "checkin", lambda *args: update_pool(1))
+
+
+def generate() -> tuple[bytes, str]:
+    """The samples of all the workers, in the text format."""
+    if prometheus_client is None:
+        return b"", "text/plain; charset=utf-8"
+    registry = prometheus_client.REGISTRY
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return prometheus_client.generate_latest(
+        registry
+    ), prometheus_client.CONTENT_TYPE_LATEST
+
+
+def mark_process_dead():
+    """Drop the live gauges of this worker, as it exits."""
+    if prometheus_client is not None and PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(os.getpid())
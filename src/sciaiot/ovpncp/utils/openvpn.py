@@ -1,4 +1,5 @@
 import contextlib
+import hashlib
 import logging
 import os
 import re
@@ -9,6 +10,10 @@ from cryptography import x509
 from cryptography.hazmat.backends import default_backend
 from cryptography.x509.oid import NameOID
 
+from sciaiot.ovpncp.utils import command
+from sciaiot.ovpncp.utils.lock import file_lock
+from sciaiot.ovpncp.utils.tracing import traced
+
 logger = logging.getLogger(__name__)
 
 status_pattern = re.compile(r"(.*?)Active: (.*?) since (.*?); (.*?) ago")
@@ -17,6 +22,16 @@ default = "N/A"
 openvpn_dir = "/etc/openvpn"
 openvpn_log_dir = "/var/log/openvpn"
 easyrsa_dir = f"{openvpn_dir}/easy-rsa"
+# the lock files of the clients' ccd files, shared by the app's workers
+ccd_lock_dir = os.getenv("CCD_LOCK_DIR", "/tmp/ovpncp-ccd")
+
+# ccd files tag their directives with the owner managing them
+OWNER_TAG = "# owner:"
+IP_OWNER = "ip"
+IROUTE_OWNER = "iroute"
+NETWORK_OWNER = "network"
+LEGACY_OWNER = "legacy"
+UNTAGGED_OWNERS = {"ifconfig-push": IP_OWNER, "iroute": IROUTE_OWNER}
 
 
 def validate_name(name: str):
@@ -57,7 +72,7 @@ def get_status():
 
     logger.info("Checking the status of OpenVPN server...")
     try:
-        result = subprocess.run(
+        result = command.run(
             ["systemctl", "status", "openvpn"],
             capture_output=True,
             text=True,
@@ -88,7 +103,7 @@ def build_client(name: str):
 
     validate_name(name)
     logger.info(f"Building client {name}...")
-    result = subprocess.run(
+    result = command.run(
         ["./easyrsa", "--batch", "build-client-full", name, "nopass"],
         cwd=easyrsa_dir,
         shell=False,
@@ -160,7 +175,7 @@ def renew_client_cert(name: str) -> dict:
 
     validate_name(name)
     logger.info(f"Renewing client {name} certificate...")
-    result = subprocess.run(
+    result = command.run(
         ["./easyrsa", "--batch", "revoke-renewed", name],
         cwd=easyrsa_dir,
         shell=False,
@@ -181,7 +196,7 @@ def revoke_client(name: str):
 
     validate_name(name)
     logger.info(f"Revoking client {name}...")
-    result = subprocess.run(
+    result = command.run(
         ["./easyrsa", "--batch", "revoke", name],
         cwd=easyrsa_dir,
         shell=False,
@@ -199,7 +214,7 @@ def revoke_client(name: str):
 def generate_crl() -> bool:
     """Generate a new CRL."""
     logger.info("Generating CRL...")
-    result = subprocess.run(
+    result = command.run(
         ["./easyrsa", "--batch", "gen-crl"],
         cwd=easyrsa_dir,
         shell=False,
@@ -214,15 +229,137 @@ def generate_crl() -> bool:
         return False
 
 
+def ccd_path(name: str) -> str:
+    return os.path.join(openvpn_dir, "ccd", name)
+
+
+@contextlib.contextmanager
+def ccd_lock(name: str):
+    """Serialize the updates of one client's ccd file, across the workers too.
+
+    The lock file of the client is removed once released, so the locks do
+    not pile up with the clients, e.g. the removed ones.
+    """
+    os.makedirs(ccd_lock_dir, exist_ok=True)
+    with file_lock(os.path.join(ccd_lock_dir, f"{name}.lock")):
+        yield
+
+
+def ccd_temp_name(name: str) -> str:
+    return f".{name}.tmp"
+
+
+def ccd_owner(file_name: str) -> str:
+    """The client of a file of the ccd directory, its ccd or temp file."""
+    if file_name.startswith(".") and file_name.endswith(".tmp"):
+        return file_name[1 : -len(".tmp")]
+    return file_name
+
+
+def read_ccd(name: str) -> dict[str, list[str]]:
+    """Read the directives of a ccd file, grouped by the owner tag above them.
+
+    Directives of files written before the tags existed are given the owner
+    their kind implies, or the legacy one for pushed routes.
+    """
+    directives: dict[str, list[str]] = {}
+    try:
+        with open(ccd_path(name), "r") as file:
+            lines = file.read().splitlines()
+    except FileNotFoundError:
+        return directives
+
+    owner = None
+    for line in lines:
+        line = line.strip()
+        if line.startswith(OWNER_TAG):
+            owner = line[len(OWNER_TAG) :].strip()
+            continue
+        if not line or line.startswith("#"):
+            continue
+
+        key = owner or UNTAGGED_OWNERS.get(line.split(None, 1)[0], LEGACY_OWNER)
+        directives.setdefault(key, []).append(line)
+
+    return directives
+
+
+def format_ccd(directives: dict[str, list[str]]) -> str:
+    return "".join(
+        f"{OWNER_TAG} {owner}\n" + "".join(f"{line}\n" for line in lines)
+        for owner, lines in directives.items()
+        if lines
+    )
+
+
+@traced()
+def write_ccd(name: str, directives: dict[str, list[str]]):
+    """Replace the ccd file atomically, removing it if no directive is left."""
+    path = ccd_path(name)
+    content = format_ccd(directives)
+    if not content:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        return
+
+    temp_path = os.path.join(os.path.dirname(path), ccd_temp_name(name))
+    with open(temp_path, "w") as file:
+        file.write(content)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+def sync_ccd(name: str, directives: dict[str, list[str]]) -> bool:
+    """Write the ccd file unless its content hash is the same already."""
+    validate_name(name)
+    digest = hashlib.sha256(format_ccd(directives).encode()).digest()
+    with ccd_lock(name):
+        try:
+            with open(ccd_path(name), "rb") as file:
+                if hashlib.sha256(file.read()).digest() == digest:
+                    return False
+        except FileNotFoundError:
+            pass
+
+        write_ccd(name, directives)
+        return True
+
+
+def list_ccd() -> list[str]:
+    """List the clients having a ccd file, temp files left over included."""
+    return os.listdir(os.path.join(openvpn_dir, "ccd"))
+
+
+@traced()
+def remove_ccd(file_name: str):
+    """Remove a file of the ccd directory under the lock of its client.
+
+    A temp file is only written under that lock too, so one being written
+    is not removed from under write_ccd, only the ones left over.
+    """
+    with ccd_lock(ccd_owner(file_name)), contextlib.suppress(FileNotFoundError):
+        os.remove(ccd_path(file_name))
+
+
+@contextlib.contextmanager
+def edit_ccd(name: str):
+    """Read, update & write back the directives of a client under its lock."""
+    validate_name(name)
+    with ccd_lock(name):
+        directives = read_ccd(name)
+        yield directives
+        write_ccd(name, directives)
+
+
 def assign_client_ip(name: str, ip: str, subnet_mask: str):
     """Add a client with the given name and IP address to the OpenVPN server."""
 
     validate_name(name)
     logger.info(f"Adding client {name} with IP address {ip} to OpenVPN server...")
 
-    config_path = os.path.join(openvpn_dir, "ccd", name)
-    with open(config_path, "w") as file:
-        file.write(f"ifconfig-push {ip} {subnet_mask}\n")
+    with edit_ccd(name) as directives:
+        directives[IP_OWNER] = [f"ifconfig-push {ip} {subnet_mask}"]
 
     logger.info(
         f"Client {name} with IP address {ip} has been successfully added to OpenVPN server."
@@ -235,9 +372,9 @@ def unassign_client_ip(name: str):
     validate_name(name)
     logger.info(f'Removing client "{name}" IP from OpenVPN server...')
 
-    config_path = os.path.join(openvpn_dir, "ccd", name)
-    if os.path.exists(config_path):
-        os.remove(config_path)
+    # routes of the client are meaningless without an address, drop them all
+    with edit_ccd(name) as directives:
+        directives.clear()
 
     logger.info(
         f'Client "{name}" IP has been successfully removed from OpenVPN server.'
@@ -249,9 +386,10 @@ def add_iroute(name: str, rule: str):
 
     validate_name(name)
     logger.info(f"Adding route to OpenVPN server for client {name}...")
-    config_path = os.path.join(openvpn_dir, "ccd", name)
-    with open(config_path, "a") as file:
-        file.write(f"iroute {rule}\n")
+    with edit_ccd(name) as directives:
+        iroutes = directives.setdefault(IROUTE_OWNER, [])
+        if f"iroute {rule}" not in iroutes:
+            iroutes.append(f"iroute {rule}")
     logger.info(
         f"Route to OpenVPN server for client {name} has been successfully added."
     )
@@ -263,46 +401,48 @@ def remove_iroute(name: str, rule: str):
     validate_name(name)
     logger.info(f"Removing route from OpenVPN server for client {name}...")
 
-    file_path = os.path.join(openvpn_dir, "ccd", name)
-    with open(file_path, "r") as file:
-        lines = file.readlines()
-
-    updated_lines = [line for line in lines if not line.startswith(f"iroute {rule}\n")]
-    with open(file_path, "w") as file:
-        file.writelines(updated_lines)
+    with edit_ccd(name) as directives:
+        for owner, lines in directives.items():
+            directives[owner] = [line for line in lines if line != f"iroute {rule}"]
 
     logger.info(
         f"Route from OpenVPN server for client {name} has been successfully removed."
     )
 
 
-def push_client_routes(name: str, rules: list[str]):
-    """Push a list of routes to the OpenVPN client."""
+@traced()
+def push_client_routes(name: str, rules: list[str], network_id: int):
+    """Push the routes of a restricted network to the OpenVPN client."""
 
     validate_name(name)
     logger.info(f"Pushing route to OpenVPN client {name}...")
-    config_path = os.path.join(openvpn_dir, "ccd", name)
-    with open(config_path, "a") as file:
-        for rule in rules:
-            file.write(f'push "route {rule}"\n')
+    with edit_ccd(name) as directives:
+        directives[f"{NETWORK_OWNER}:{network_id}"] = [
+            f'push "route {rule}"' for rule in rules
+        ]
     logger.info(f"Pushed {len(rules)} routes to OpenVPN client {name}.")
 
 
-def pull_client_routes(name: str):
-    """Pull all routes from the OpenVPN client."""
+@traced()
+def pull_client_routes(name: str, network_id: int, rules: list[str] | None = None):
+    """Pull the routes of a restricted network from the OpenVPN client.
+
+    The given rules are also removed from the untagged routes of files written
+    by an older release.
+    """
 
     validate_name(name)
     logger.info(f"Pulling routes from OpenVPN client {name}...")
 
-    file_path = os.path.join(openvpn_dir, "ccd", name)
-    with open(file_path, "r") as file:
-        lines = file.readlines()
-
-    updated_lines = [line for line in lines if not line.startswith('push "route')]
-    with open(file_path, "w") as file:
-        file.writelines(updated_lines)
+    with edit_ccd(name) as directives:
+        pulled = directives.pop(f"{NETWORK_OWNER}:{network_id}", [])
+        legacy = {f'push "route {rule}"' for rule in rules or []}
+        if LEGACY_OWNER in directives:
+            kept = [line for line in directives[LEGACY_OWNER] if line not in legacy]
+            pulled += [line for line in directives[LEGACY_OWNER] if line in legacy]
+            directives[LEGACY_OWNER] = kept
 
-    logger.info(f"Pulled all routes from OpenVPN client {name}.")
+    logger.info(f"Pulled {len(pulled)} routes from OpenVPN client {name}.")
 
 
 def list_connections():
@@ -315,19 +455,21 @@ def list_connections():
         routing_table_start = lines.index("ROUTING TABLE")
         global_stats_start = lines.index("GLOBAL STATS")
 
+        # the first route of each client, read in one pass over the table
+        virtual_addresses = {}
+        for i in range(routing_table_start + 2, global_stats_start):
+            route_info = lines[i].split(",")
+            virtual_addresses.setdefault(route_info[1], route_info[0])
+
         connections = []
         for i in range(client_list_start + 3, routing_table_start):
             client_info = lines[i].split(",")
             client_name = client_info[0]
             remote_address = client_info[1]
+            bytes_received = int(client_info[2])
+            bytes_sent = int(client_info[3])
             connected_time = client_info[4]
-            virtual_address = None
-
-            for j in range(routing_table_start + 2, global_stats_start):
-                route_info = lines[j].split(",")
-                if route_info[1] == client_name:
-                    virtual_address = route_info[0]
-                    break
+            virtual_address = virtual_addresses.get(client_name)
 
             if virtual_address:
                 connections.append(
@@ -336,6 +478,8 @@ def list_connections():
                         "ip": virtual_address,
                         "remote_address": remote_address,
                         "connected_time": connected_time,
+                        "bytes_received": bytes_received,
+                        "bytes_sent": bytes_sent,
                     }
                 )
 
@@ -0,0 +1,162 @@
+"""Reconciliation of the open connections with the live server state."""
+
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+
+from fastapi.concurrency import run_in_threadpool
+from sqlmodel import col, select, update
+
+from sciaiot.ovpncp.data.server import Client, Connection, ReconcileResult
+from sciaiot.ovpncp.dependencies import get_async_session
+from sciaiot.ovpncp.utils import openvpn
+from sciaiot.ovpncp.utils.ingestion import chunks, resolve_client_ids, to_local
+from sciaiot.ovpncp.utils.lock import OwnerLock
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_INTERVAL = float(os.getenv("RECONCILE_INTERVAL", "300"))
+# connections younger than the status file refresh & the spool delay are left
+RECONCILE_GRACE = float(os.getenv("RECONCILE_GRACE", "120"))
+# held by the one worker of the app reconciling periodically
+RECONCILE_LOCK_FILE = os.getenv("RECONCILE_LOCK_FILE", "/tmp/ovpncp-reconcile.lock")
+STATUS_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+async def reconcile_connections(
+    session, grace: float = RECONCILE_GRACE
+) -> ReconcileResult:
+    """Close the open connections the server no longer has & open the missing.
+
+    One query reads all open connections, through the partial index on them,
+    so the cost grows with the connected clients only.
+    """
+    live = await run_in_threadpool(openvpn.list_connections)
+    now = datetime.now()
+    cutoff = now - timedelta(seconds=grace)
+    result = ReconcileResult()
+
+    statement = (
+        select(
+            Connection.id,
+            Client.name,
+            Connection.remote_address,
+            Connection.connected_time,
+        )
+        .join(Client, col(Client.id) == Connection.client_id)
+        .where(Connection.disconnected_time == None)
+        .order_by(col(Connection.connected_time).desc())
+    )
+    open_connections: dict[tuple[str, str], tuple[int, datetime]] = {}
+    stale = []
+    for row in (await session.exec(statement)).all():
+        connection_id, name, remote_address, connected_time = row
+        key = (name, remote_address)
+        if key in open_connections:
+            stale.append(connection_id)  # older than the one kept
+        else:
+            open_connections[key] = (connection_id, to_local(connected_time))
+
+    missing = []
+    for connection in live:
+        key = (connection["name"], connection["remote_address"])
+        if open_connections.pop(key, None) is not None:
+            continue
+
+        connected_time = datetime.strptime(
+            connection["connected_time"], STATUS_TIME_FORMAT
+        )
+        if connected_time < cutoff:
+            missing.append((connection, connected_time))
+
+    # what is left is not connected any more, unless opened just now
+    stale += [
+        connection_id
+        for connection_id, connected_time in open_connections.values()
+        if connected_time < cutoff
+    ]
+    for chunk in chunks(stale):
+        close_statement = (
+            update(Connection)
+            .where(col(Connection.id).in_(chunk))
+            .values(disconnected_time=now)
+        )
+        await session.execute(close_statement)
+    result.closed = len(stale)
+
+    client_ids = await resolve_client_ids(
+        session, {connection["name"] for connection, _ in missing}
+    )
+    for connection, connected_time in missing:
+        client_id = client_ids.get(connection["name"])
+        if client_id is None:
+            result.unknown_clients.append(connection["name"])
+            continue
+
+        session.add(
+            Connection(
+                client_id=client_id,
+                remote_address=connection["remote_address"],
+                connected_time=connected_time,
+            )
+        )
+        result.opened += 1
+
+    await session.commit()
+    logger.info(
+        f"Reconciled {len(live)} live connection(s): {result.closed} closed, "
+        f"{result.opened} opened, {len(result.unknown_clients)} unknown client(s)."
+    )
+    return result
+
+
+class ConnectionReconciler:
+    """Periodic reconciliation, for the disconnects lost by failed hooks.
+
+    Of the workers of the app, only the one holding the lock file reconciles,
+    as concurrent rounds would each open the missing connections; the others
+    try to take it over at each interval, once the owner is gone.
+    """
+
+    def __init__(
+        self,
+        session_factory,
+        interval: float = RECONCILE_INTERVAL,
+        lock_file: str = RECONCILE_LOCK_FILE,
+    ):
+        self.session_factory = session_factory
+        self.interval = interval
+        self.lock = OwnerLock(lock_file)
+        self.stopped: asyncio.Event | None = None
+
+    async def run(self):
+        self.stopped = asyncio.Event()
+        while not self.stopped.is_set():
+            if self.lock.owned or self.take_over():
+                try:
+                    async with self.session_factory() as session:
+                        await reconcile_connections(session)
+                except Exception as e:  # noqa: BLE001 - retried on the next round
+                    logger.error(f"Failed to reconcile connections: {e}")
+
+            try:
+                await asyncio.wait_for(self.stopped.wait(), self.interval)
+            except TimeoutError:
+                pass
+
+        self.lock.release()
+
+    def take_over(self) -> bool:
+        if not self.lock.acquire():
+            return False
+        logger.info(f"Reconciling connections every {self.interval} seconds.")
+        return True
+
+    def stop(self):
+        if self.stopped is not None:
+            self.stopped.set()
+
+
+reconciler = ConnectionReconciler(asynccontextmanager(get_async_session))
@@ -0,0 +1,335 @@
+"""Retention of the connection history, rolled up into daily aggregates."""
+
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import delete, text
+from sqlmodel import col, select
+
+from sciaiot.ovpncp import dependencies
+from sciaiot.ovpncp.data.server import Connection, ConnectionRollup, RetentionResult
+from sciaiot.ovpncp.dependencies import get_async_session
+from sciaiot.ovpncp.utils.ingestion import chunks, to_local
+from sciaiot.ovpncp.utils.lock import OwnerLock
+
+logger = logging.getLogger(__name__)
+
+# closed connections older than this are rolled up & purged, 0 keeps them all
+RETENTION_DAYS = float(os.getenv("RETENTION_DAYS", "0"))
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "1000"))
+# between batches, so the hooks get the database in between
+RETENTION_BATCH_PAUSE = float(os.getenv("RETENTION_BATCH_PAUSE", "0.1"))
+# held by the one worker of the app running the retention
+RETENTION_LOCK_FILE = os.getenv("RETENTION_LOCK_FILE", "/tmp/ovpncp-retention.lock")
+# monthly partitions created ahead on a partitioned connection table
+PARTITION_MONTHS_AHEAD = 3
+PARTITION_PREFIX = "connection_p"
+
+
+async def rollup(session, totals: dict[tuple[int, date], list]) -> int:
+    """Add the (sessions, seconds) of each client & day to their rollup."""
+    keys = list(totals)
+    for chunk in chunks(keys):
+        statement = select(ConnectionRollup).where(
+            col(ConnectionRollup.client_id).in_({key[0] for key in chunk}),
+            col(ConnectionRollup.day).in_({key[1] for key in chunk}),
+        )
+        for existing in (await session.exec(statement)).all():
+            key = (existing.client_id, existing.day)
+            if key in totals:
+                sessions, seconds = totals.pop(key)
+                existing.sessions += sessions
+                existing.seconds += seconds
+                session.add(existing)
+
+    session.add_all(
+        ConnectionRollup(
+            client_id=client_id, day=day, sessions=sessions, seconds=seconds
+        )
+        for (client_id, day), (sessions, seconds) in totals.items()
+    )
+    return len(keys)
+
+
+async def purge_batch(session, cutoff: datetime, batch_size: int) -> tuple[int, int]:
+    """Roll up & delete the oldest closed connections, in one short transaction."""
+    statement = (
+        select(
+            Connection.id,
+            Connection.client_id,
+            Connection.connected_time,
+            Connection.disconnected_time,
+        )
+        .where(col(Connection.disconnected_time) < cutoff)
+        .order_by(col(Connection.disconnected_time))
+        .limit(batch_size)
+    )
+    rows = (await session.exec(statement)).all()
+    if not rows:
+        return 0, 0
+
+    totals: dict[tuple[int, date], list] = {}
+    for _, client_id, connected_time, disconnected_time in rows:
+        connected_time = to_local(connected_time)
+        total = totals.setdefault((client_id, connected_time.date()), [0, 0.0])
+        total[0] += 1
+        total[1] += (to_local(disconnected_time) - connected_time).total_seconds()
+    rolled_up = await rollup(session, totals)
+
+    for chunk in chunks([row[0] for row in rows]):
+        await session.execute(delete(Connection).where(col(Connection.id).in_(chunk)))
+    await session.commit()
+    return rolled_up, len(rows)
+
+
+async def purge_connections(
+    session,
+    cutoff: datetime,
+    batch_size: int = RETENTION_BATCH_SIZE,
+    pause: float = RETENTION_BATCH_PAUSE,
+) -> RetentionResult:
+    """Purge the connections closed before the cutoff, batch by batch.
+
+    Each batch is committed on its own, so locks are held for one batch only
+    and an interrupted purge loses nothing.
+    """
+    result = RetentionResult()
+    while True:
+        rolled_up, deleted = await purge_batch(session, to_local(cutoff), batch_size)
+        if not deleted:
+            break
+
+        result.rolled_up += rolled_up
+        result.deleted += deleted
+        await asyncio.sleep(pause)
+
+    logger.info(
+        f"Purged {result.deleted} connection(s) closed before {cutoff}, "
+        f"rolled up into {result.rolled_up} daily aggregate(s)."
+    )
+    return result
+
+
+async def apply_retention(session, days: float) -> RetentionResult:
+    """Drop the expired partitions if any, then purge what is left."""
+    cutoff = datetime.now() - timedelta(days=days)
+    dropped = await run_in_threadpool(maintain_partitions, dependencies.engine, cutoff)
+    result = await purge_connections(session, cutoff)
+    result.dropped_partitions = dropped
+    return result
+
+
+def partition_name(month: date) -> str:
+    return f"{PARTITION_PREFIX}{month:%Y%m}"
+
+
+def next_month(month: date) -> date:
+    return (month.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+def is_partitioned(conn) -> bool:
+    """Whether the connection table is a partitioned table on Postgres."""
+    if conn.dialect.name != "postgresql":
+        return False
+
+    statement = text("SELECT relkind FROM pg_class WHERE relname = 'connection'")
+    return conn.execute(statement).scalar() == "p"
+
+
+def create_partitions(conn, start: date, end: date):
+    """Create the monthly partitions from the month of start to the one of end."""
+    month = start.replace(day=1)
+    while month <= end:
+        conn.execute(
+            text(
+                f"CREATE TABLE IF NOT EXISTS {partition_name(month)} "
+                "PARTITION OF connection "
+                f"FOR VALUES FROM ('{month}') TO ('{next_month(month)}')"
+            )
+        )
+        month = next_month(month)
+
+
+def maintain_partitions(engine, cutoff: datetime) -> list[str]:
+    """Create the partitions ahead & drop the ones past the retention.
+
+    A partition is dropped whole, without a delete, once all its connections
+    are closed; the rows are rolled up by the database in the same
+    transaction. Partitions with open connections are left to the batches.
+    """
+    dropped: list[str] = []
+    if engine.dialect.name != "postgresql":
+        return dropped
+
+    with engine.begin() as conn:
+        if not is_partitioned(conn):
+            return dropped
+
+        today = date.today()
+        create_partitions(
+            conn, today, today + timedelta(days=31 * PARTITION_MONTHS_AHEAD)
+        )
+
+        statement = text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE parent.relname = 'connection' AND child.relname LIKE :prefix "
+            "ORDER BY child.relname"
+        )
+        result = conn.execute(statement, {"prefix": f"{PARTITION_PREFIX}%"})
+        names = result.scalars().all()
+
+    for name in names:
+        month = datetime.strptime(name.removeprefix(PARTITION_PREFIX), "%Y%m")
+        if next_month(month.date()) > cutoff.date():
+            break
+
+        with engine.begin() as conn:
+            statement = text(
+                f"SELECT 1 FROM {name} WHERE disconnected_time IS NULL "
+                f"OR disconnected_time >= :cutoff LIMIT 1"
+            )
+            if conn.execute(statement, {"cutoff": cutoff}).first():
+                continue
+
+            conn.execute(
+                text(
+                    "INSERT INTO connectionrollup (client_id, day, sessions, seconds) "
+                    "SELECT client_id, CAST(connected_time AS date), COUNT(*), "
+                    "SUM(EXTRACT(EPOCH FROM disconnected_time - connected_time)) "
+                    f"FROM {name} GROUP BY 1, 2 "
+                    "ON CONFLICT (client_id, day) DO UPDATE SET "
+                    "sessions = connectionrollup.sessions + excluded.sessions, "
+                    "seconds = connectionrollup.seconds + excluded.seconds"
+                )
+            )
+            conn.execute(text(f"DROP TABLE {name}"))
+        dropped.append(name)
+        logger.info(f"Dropped the connection partition {name}.")
+
+    return dropped
+
+
+def partition_connections(engine):
+    """Turn the connection table into monthly partitions on connected_time.
+
+    A one-off migration, copying the history into the new table; the
+    partitions are kept up to date by the retention afterwards. Postgres
+    requires the partition key in the primary key, so it becomes
+    (id, connected_time).
+    """
+    with engine.begin() as conn:
+        if conn.dialect.name != "postgresql":
+            raise ValueError("Partitioning is only supported on PostgreSQL!")
+        if is_partitioned(conn):
+            logger.info("The connection table is partitioned already.")
+            return
+
+        conn.execute(text("ALTER TABLE connection RENAME TO connection_unpartitioned"))
+        # the name of the primary key index is taken by the new table
+        conn.execute(
+            text(
+                "ALTER TABLE connection_unpartitioned "
+                "RENAME CONSTRAINT connection_pkey TO connection_unpartitioned_pkey"
+            )
+        )
+        conn.execute(
+            text(
+                "CREATE TABLE connection "
+                "(LIKE connection_unpartitioned INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+                "PARTITION BY RANGE (connected_time)"
+            )
+        )
+        conn.execute(
+            text("ALTER TABLE connection ADD PRIMARY KEY (id, connected_time)")
+        )
+        conn.execute(
+            text(
+                "ALTER TABLE connection ADD FOREIGN KEY (client_id) REFERENCES client (id)"
+            )
+        )
+
+        first = conn.execute(
+            text("SELECT MIN(connected_time) FROM connection_unpartitioned")
+        ).scalar()
+        today = date.today()
+        start = first.date() if first else today
+        create_partitions(
+            conn, start, today + timedelta(days=31 * PARTITION_MONTHS_AHEAD)
+        )
+        conn.execute(
+            text("CREATE TABLE connection_default PARTITION OF connection DEFAULT")
+        )
+
+        conn.execute(
+            text("INSERT INTO connection SELECT * FROM connection_unpartitioned")
+        )
+        # the id sequence would go with the old table otherwise
+        conn.execute(text("ALTER SEQUENCE connection_id_seq OWNED BY connection.id"))
+        conn.execute(text("DROP TABLE connection_unpartitioned"))
+        for index in Connection.__table__.indexes:  # type: ignore
+            index.create(conn)
+
+    logger.info("Partitioned the connection table by month.")
+
+
+class RetentionWorker:
+    """Periodic purge of the connection history past the retention.
+
+    Of the workers of the app, only the one holding the lock file purges;
+    the others try to take it over at each interval, once the owner is gone.
+    """
+
+    def __init__(
+        self,
+        session_factory,
+        days: float = RETENTION_DAYS,
+        interval: float = RETENTION_INTERVAL,
+        lock_file: str = RETENTION_LOCK_FILE,
+    ):
+        self.session_factory = session_factory
+        self.days = days
+        self.interval = interval
+        self.lock = OwnerLock(lock_file)
+        self.stopped: asyncio.Event | None = None
+
+    async def run(self):
+        self.stopped = asyncio.Event()
+        while not self.stopped.is_set():
+            if self.lock.owned or self.take_over():
+                try:
+                    async with self.session_factory() as session:
+                        await apply_retention(session, self.days)
+                except Exception as e:  # noqa: BLE001 - purged again next interval
+                    logger.error(f"Failed to purge connections: {e}")
+
+            try:
+                await asyncio.wait_for(self.stopped.wait(), self.interval)
+            except TimeoutError:
+                pass
+
+        self.lock.release()
+
+    def take_over(self) -> bool:
+        if not self.lock.acquire():
+            return False
+        logger.info(f"Purging connections older than {self.days} days.")
+        return True
+
+    def stop(self):
+        if self.stopped is not None:
+            self.stopped.set()
+
+
+retention_worker = RetentionWorker(asynccontextmanager(get_async_session))
+
+
+def main():
+    """Partition the connection table of a PostgreSQL database by month."""
+    partition_connections(dependencies.engine)
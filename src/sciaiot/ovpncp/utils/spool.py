@@ -0,0 +1,241 @@
+"""Ingestion of the connection events spooled by the hook scripts."""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import BinaryIO
+
+from fastapi.concurrency import run_in_threadpool
+from pydantic import ValidationError
+
+from sciaiot.ovpncp.data.server import ConnectionEvent, ConnectionEventsResult
+from sciaiot.ovpncp.dependencies import spool_directory
+from sciaiot.ovpncp.utils.ingestion import ConnectionEventWriter, event_writer
+from sciaiot.ovpncp.utils.lock import OwnerLock
+
+logger = logging.getLogger(__name__)
+
+SPOOL_FILE = os.getenv("SPOOL_FILE", f"{spool_directory}/events.jsonl")
+SPOOL_POLL_INTERVAL = float(os.getenv("SPOOL_POLL_INTERVAL", "0.2"))
+SPOOL_MAX_BATCH = int(os.getenv("SPOOL_MAX_BATCH", "5000"))
+SPOOL_ROTATE_SIZE = int(os.getenv("SPOOL_ROTATE_SIZE", str(16 * 1024 * 1024)))
+# a hook may still append to a segment it opened right before the rotation
+SPOOL_ROTATE_GRACE = 5.0
+# the other workers try to take the spool over at this interval
+SPOOL_OWNER_RETRY_INTERVAL = 5.0
+# writes of a batch, backing off in between, before it is written event by
+# event & the failing events quarantined, so one of them cannot stall it
+SPOOL_MAX_ATTEMPTS = int(os.getenv("SPOOL_MAX_ATTEMPTS", "10"))
+SPOOL_MAX_BACKOFF = 60.0
+
+
+class SpoolReader:
+    """Tail the spool file and write its events in batches.
+
+    The checkpoint holds the inode & the offset of the last line written, it
+    is saved only after the batch is committed, so events are delivered at
+    least once. A consumed spool larger than `rotate_size` is renamed to
+    `<name>.1`, which is drained and then dropped once no hook writes to it.
+
+    A batch failing `max_attempts` times in a row is written event by event
+    and the events failing on their own are appended to `<name>.failed`,
+    then the checkpoint moves on.
+
+    Of the workers of the app, only the one holding the lock `<name>.lock`
+    reads the spool, the others stand by to take it over.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        writer: ConnectionEventWriter,
+        max_batch: int = SPOOL_MAX_BATCH,
+        rotate_size: int = SPOOL_ROTATE_SIZE,
+        rotate_grace: float = SPOOL_ROTATE_GRACE,
+        max_attempts: int = SPOOL_MAX_ATTEMPTS,
+    ):
+        self.path = Path(path)
+        self.rotated_path = self.path.with_name(f"{self.path.name}.1")
+        self.checkpoint_path = self.path.with_name(f"{self.path.name}.offset")
+        self.quarantine_path = self.path.with_name(f"{self.path.name}.failed")
+        self.lock = OwnerLock(str(self.path.with_name(f"{self.path.name}.lock")))
+        self.writer = writer
+        self.max_batch = max_batch
+        self.rotate_size = rotate_size
+        self.rotate_grace = rotate_grace
+        self.max_attempts = max_attempts
+        # the failed writes of the current batch
+        self.failures = 0
+        self.inode: int | None = None
+        self.offset: int | None = None
+        self.stopped: asyncio.Event | None = None
+
+    def load_checkpoint(self):
+        try:
+            checkpoint = json.loads(self.checkpoint_path.read_text())
+            self.inode, self.offset = checkpoint["inode"], checkpoint["offset"]
+        except FileNotFoundError:
+            self.inode, self.offset = None, 0
+        except (ValueError, KeyError) as e:
+            logger.warning(f"Ignored invalid spool checkpoint: {e}")
+            self.inode, self.offset = None, 0
+
+    def save_checkpoint(self):
+        temp_path = self.checkpoint_path.with_name(f"{self.checkpoint_path.name}.tmp")
+        temp_path.write_text(json.dumps({"inode": self.inode, "offset": self.offset}))
+        os.replace(temp_path, self.checkpoint_path)
+
+    def read(self):
+        """Read the complete lines of the current segment past the checkpoint."""
+        if self.offset is None:
+            self.load_checkpoint()
+
+        segment = self.rotated_path if self.rotated_path.exists() else self.path
+        try:
+            with open(segment, "rb") as file:
+                return self.read_segment(segment, file)
+        except FileNotFoundError:
+            return segment, None, [], self.offset
+
+    def read_segment(self, segment: Path, file: BinaryIO):
+        stat = os.fstat(file.fileno())
+        offset = self.offset or 0
+        if stat.st_ino != self.inode or stat.st_size < offset:
+            # a new segment, or one truncated behind our back
+            self.inode, self.offset = stat.st_ino, 0
+            offset = 0
+
+        file.seek(offset)
+        events = []
+        end = offset
+        for line in file:
+            if not line.endswith(b"\n"):
+                break  # the hook is still writing it
+
+            end += len(line)
+            if not line.strip():
+                continue
+            try:
+                events.append(ConnectionEvent.model_validate_json(line))
+            except ValidationError as e:
+                logger.warning(f"Skipped malformed line of {segment}: {e}")
+            if len(events) >= self.max_batch:
+                break
+
+        return segment, stat, events, end
+
+    def rotate(self, segment: Path, stat: os.stat_result, end: int):
+        if end < stat.st_size:
+            return
+
+        if segment == self.rotated_path:
+            if time.time() - stat.st_mtime > self.rotate_grace:
+                segment.unlink()
+                logger.info(f"Removed the drained spool segment {segment}.")
+        elif stat.st_size >= self.rotate_size:
+            # the inode survives the rename, so does the checkpoint
+            os.rename(segment, self.rotated_path)
+            logger.info(f"Rotated the spool {segment} at {stat.st_size} bytes.")
+
+    async def poll(self) -> int:
+        """Write one batch of spooled events, returns the number of them."""
+        segment, stat, events, end = await run_in_threadpool(self.read)
+        if stat is None:
+            return 0
+
+        if events:
+            try:
+                result = await self.writer.submit(events)
+            except Exception as e:
+                self.failures += 1
+                if self.failures < self.max_attempts:
+                    raise
+                logger.error(
+                    f"Failed to write a spooled batch {self.failures} times, "
+                    f"writing its {len(events)} events one by one: {e}"
+                )
+                result = await self.submit_each(events)
+            self.failures = 0
+            for rejected in result.rejected:
+                logger.warning(f"Rejected spooled event: {rejected.detail}")
+
+        if end != self.offset:
+            self.offset = end
+            await run_in_threadpool(self.save_checkpoint)
+
+        await run_in_threadpool(self.rotate, segment, stat, end)
+        return len(events)
+
+    async def submit_each(
+        self, events: list[ConnectionEvent]
+    ) -> ConnectionEventsResult:
+        """Write the events one by one, quarantining the ones failing."""
+        result = ConnectionEventsResult()
+        failed = []
+        for event in events:
+            try:
+                written = await self.writer.submit([event])
+            except Exception as e:  # noqa: BLE001 - quarantined, the others written
+                logger.error(f"Quarantined a spooled event of {event.client_name}: {e}")
+                failed.append(event)
+                continue
+            result.accepted += written.accepted
+            result.rejected.extend(written.rejected)
+
+        if failed:
+            await run_in_threadpool(self.quarantine, failed)
+        return result
+
+    def quarantine(self, events: list[ConnectionEvent]):
+        with open(self.quarantine_path, "a") as file:
+            file.writelines(f"{event.model_dump_json()}\n" for event in events)
+
+    async def wait(self, seconds: float):
+        """Sleep for the seconds, or until stopped."""
+        if self.stopped is not None:
+            try:
+                await asyncio.wait_for(self.stopped.wait(), seconds)
+            except TimeoutError:
+                pass
+
+    def take_over(self) -> bool:
+        if not self.lock.acquire():
+            return False
+        logger.info(f"Started ingesting the spool {self.path}.")
+        return True
+
+    async def run(
+        self,
+        interval: float = SPOOL_POLL_INTERVAL,
+        owner_retry_interval: float = SPOOL_OWNER_RETRY_INTERVAL,
+    ):
+        """Ingest the spool until stopped, on the one worker holding its lock."""
+        self.stopped = asyncio.Event()
+        while not self.stopped.is_set():
+            try:
+                if not self.lock.owned and not self.take_over():
+                    # read by another worker, taken over once it is gone
+                    await self.wait(owner_retry_interval)
+                    continue
+                count = await self.poll()
+            except Exception as e:  # noqa: BLE001 - the reader outlives a round
+                # the checkpoint stays, the batch is read again next round
+                logger.error(f"Failed to ingest the spool {self.path}: {e}")
+                count = 0
+
+            if self.failures:
+                await self.wait(min(interval * 2**self.failures, SPOOL_MAX_BACKOFF))
+            elif count < self.max_batch:
+                await self.wait(interval)
+
+        self.lock.release()
+
+    def stop(self):
+        if self.stopped is not None:
+            self.stopped.set()
+
+
+spool_reader = SpoolReader(SPOOL_FILE, event_writer)
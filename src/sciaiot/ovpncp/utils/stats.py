@@ -0,0 +1,202 @@
+"""Connection analytics, aggregated in SQL and swept over in arrays."""
+
+import logging
+import math
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, or_
+from sqlmodel import col, select
+
+from sciaiot.ovpncp.data.server import (
+    Client,
+    ClientSessionCount,
+    ConcurrencyPoint,
+    Connection,
+    ConnectionStats,
+)
+from sciaiot.ovpncp.utils.ingestion import to_local
+
+try:
+    import numpy as np
+except ImportError:  # optional, the pure Python sweep is used instead
+    np = None  # type: ignore[assignment]
+
+logger = logging.getLogger(__name__)
+
+STATS_MAX_BUCKETS = int(os.getenv("STATS_MAX_BUCKETS", "1000"))
+PERCENTILES = (50, 95, 99)
+# the connection times are naive local times, counted on the wall clock
+EPOCH = datetime(1970, 1, 1)
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Linear interpolation between the closest ranks, as numpy does."""
+    position = (len(values) - 1) * q / 100
+    low = math.floor(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def duration_percentiles(durations) -> dict[str, float]:
+    if not len(durations):
+        return {}
+
+    if np is not None:
+        values = np.percentile(np.asarray(durations, dtype=float), PERCENTILES)
+        return {f"p{q}": float(value) for q, value in zip(PERCENTILES, values)}
+
+    durations = sorted(durations)
+    return {f"p{q}": percentile(durations, q) for q in PERCENTILES}
+
+
+def sweep(starts, ends, edges) -> list[int]:
+    """Peak concurrency of each bucket between the edges.
+
+    Every session adds +1 at its start and -1 at its end, the running sum of
+    the events sorted by time is the concurrency; at the same time, ends go
+    before starts so back-to-back sessions don't overlap.
+    """
+    if np is not None:
+        return sweep_arrays(starts, ends, edges)
+
+    events = sorted([(t, 1) for t in starts] + [(t, -1) for t in ends])
+    peaks = []
+    level = 0
+    index = 0
+    for bucket_end in edges[1:]:
+        peak = level
+        while index < len(events) and events[index][0] < bucket_end:
+            level += events[index][1]
+            peak = max(peak, level)
+            index += 1
+        peaks.append(peak)
+    return peaks
+
+
+def sweep_arrays(starts, ends, edges) -> list[int]:
+    times = np.concatenate(
+        (np.asarray(starts, dtype=float), np.asarray(ends, dtype=float))
+    )
+    deltas = np.concatenate(
+        (np.ones(len(starts), dtype=np.int64), -np.ones(len(ends), dtype=np.int64))
+    )
+    order = np.lexsort((deltas, times))
+    times = times[order]
+    levels = np.cumsum(deltas[order])
+
+    # the events of bucket i are indices[i]:indices[i + 1], a sentinel keeps
+    # the indices in range when there are none
+    indices = np.searchsorted(times, np.asarray(edges, dtype=float), side="left")
+    levels = np.append(levels, 0)
+    carried = np.where(indices[:-1] > 0, levels[indices[:-1] - 1], 0)
+    maxima = np.maximum.reduceat(levels, indices[:-1])
+    empty = indices[:-1] == indices[1:]
+    peaks = np.where(empty, carried, np.maximum(carried, maxima))
+    return peaks.tolist()
+
+
+def wall_seconds(time: datetime) -> float:
+    return (time - EPOCH).total_seconds()
+
+
+def session_times(rows, first: float, last: float):
+    """Starts & ends of the sessions clipped to the range, durations of the closed.
+
+    With numpy, the times are read into arrays by `np.fromiter`, clipped and
+    subtracted at once.
+    """
+    if np is not None:
+        connected = np.fromiter(
+            (wall_seconds(row[0]) for row in rows), float, len(rows)
+        )
+        disconnected = np.fromiter(
+            (math.nan if row[1] is None else wall_seconds(row[1]) for row in rows),
+            float,
+            len(rows),
+        )
+        closed = ~np.isnan(disconnected)
+        starts = np.maximum(connected, first)
+        ends = np.where(closed, np.minimum(disconnected, last), last)
+        return starts, ends, (disconnected - connected)[closed]
+
+    starts = []
+    ends = []
+    durations = []
+    for connected_time, disconnected_time in rows:
+        connected = wall_seconds(connected_time)
+        starts.append(max(connected, first))
+        if disconnected_time is None:
+            ends.append(last)
+        else:
+            disconnected = wall_seconds(disconnected_time)
+            ends.append(min(disconnected, last))
+            durations.append(disconnected - connected)
+    return starts, ends, durations
+
+
+def bucket_edges(start: float, end: float, step: int) -> list[float]:
+    step = max(step, math.ceil((end - start) / STATS_MAX_BUCKETS))
+    edges = [start + i * step for i in range(math.ceil((end - start) / step))]
+    return edges + [end]
+
+
+async def connection_stats(
+    session, start: datetime, end: datetime, step: int, top: int
+) -> ConnectionStats:
+    """Aggregate the connections overlapping the range.
+
+    Counts are computed by the database; only the connection times of the
+    range are fetched, as plain rows, for the percentiles & the sweep-line.
+    """
+    start, end = to_local(start), to_local(end)
+    stats = ConnectionStats(start=start, end=end)
+    overlapping = (
+        col(Connection.connected_time) < end,
+        or_(
+            col(Connection.disconnected_time).is_(None),
+            col(Connection.disconnected_time) > start,
+        ),
+    )
+
+    active_statement = select(func.count(col(Connection.id))).where(
+        col(Connection.disconnected_time).is_(None)
+    )
+    stats.active = (await session.exec(active_statement)).one()
+
+    sessions = func.count(col(Connection.id)).label("sessions")
+    clients_statement = (
+        select(Client.name, sessions)
+        .join(Client, col(Client.id) == Connection.client_id)
+        .where(*overlapping)
+        .group_by(col(Client.id), col(Client.name))
+        .order_by(sessions.desc(), col(Client.name))
+        .limit(top)
+    )
+    stats.clients = [
+        ClientSessionCount(client_name=name, sessions=count)
+        for name, count in (await session.exec(clients_statement)).all()
+    ]
+
+    times_statement = select(
+        Connection.connected_time, Connection.disconnected_time
+    ).where(*overlapping)
+    rows = (await session.exec(times_statement)).all()
+    stats.sessions = len(rows)
+
+    first, last = wall_seconds(start), wall_seconds(end)
+    starts, ends, durations = session_times(rows, first, last)
+    stats.durations = duration_percentiles(durations)
+
+    edges = bucket_edges(first, last, step)
+    peaks = sweep(starts, ends, edges)
+    stats.concurrency = [
+        ConcurrencyPoint(time=EPOCH + timedelta(seconds=edge), connections=peak)
+        for edge, peak in zip(edges, peaks)
+    ]
+    stats.peak = max(peaks, default=0)
+
+    logger.info(
+        f"Aggregated {stats.sessions} connection(s) into {len(peaks)} bucket(s)."
+    )
+    return stats
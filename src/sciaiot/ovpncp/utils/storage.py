@@ -0,0 +1,249 @@
+"""Storage backends of the packaged client certs."""
+
+import abc
+import datetime
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from urllib.parse import quote, quote_plus
+
+from fastapi.concurrency import run_in_threadpool
+
+from sciaiot.ovpncp.utils.cache import VersionedCache
+
+logger = logging.getLogger(__name__)
+
+STORAGE_BACKENDS = ("azure", "s3", "local")
+AZURE_STORAGE_CONNECTION_STRING = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+STORAGE_BACKEND = os.getenv(
+    "STORAGE_BACKEND", "azure" if AZURE_STORAGE_CONNECTION_STRING else ""
+).lower()
+STORAGE_CONTAINER = os.getenv("STORAGE_CONTAINER", "ovpncp")
+# blocks of an upload sent at once, for the backends splitting them
+STORAGE_UPLOAD_CONCURRENCY = int(os.getenv("STORAGE_UPLOAD_CONCURRENCY", "4"))
+# lifetime of the signed download URLs
+STORAGE_URL_EXPIRY = int(os.getenv("STORAGE_URL_EXPIRY", "900"))
+# cached URLs are signed again this long before they expire
+STORAGE_URL_MARGIN = int(os.getenv("STORAGE_URL_MARGIN", "60"))
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+LOCAL_STORAGE_DIRECTORY = os.getenv("LOCAL_STORAGE_DIRECTORY", "/opt/ovpncp/storage")
+LOCAL_STORAGE_BASE_URL = os.getenv("LOCAL_STORAGE_BASE_URL")
+# metadata holding the SHA-256 of the content, to skip identical uploads
+DIGEST_KEY = "sha256"
+
+if STORAGE_BACKEND and STORAGE_BACKEND not in STORAGE_BACKENDS:
+    raise ValueError(
+        f"Invalid STORAGE_BACKEND '{STORAGE_BACKEND}', "
+        f"expected one of {STORAGE_BACKENDS}!"
+    )
+
+
+def file_digest(file_path: str) -> str:
+    with open(file_path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+class StorageBackend(abc.ABC):
+    """Stores the files by name, each with the digest of its content.
+
+    The blocking SDK calls run in the threadpool, so neither the hashing nor
+    the upload holds the event loop. A file is streamed from disk in blocks
+    and only uploaded when its digest differs from the stored one.
+    """
+
+    kind = ""
+
+    async def upload(self, name: str, file_path: str) -> tuple[str, bool]:
+        """Store the file, the location & whether it was uploaded."""
+        return await run_in_threadpool(self.put, name, file_path)
+
+    async def download_url(self, name: str) -> str:
+        return await run_in_threadpool(self.sign, name)
+
+    def put(self, name: str, file_path: str) -> tuple[str, bool]:
+        digest = file_digest(file_path)
+        if self.stored_digest(name) == digest:
+            logger.info(f"{name} unchanged on the {self.kind} storage, skipped.")
+            return self.location(name), False
+
+        self.write(name, file_path, digest)
+        logger.info(f"{name} uploaded to the {self.kind} storage.")
+        return self.location(name), True
+
+    @abc.abstractmethod
+    def stored_digest(self, name: str) -> str | None:
+        """The digest stored with the file, None if there is none."""
+
+    @abc.abstractmethod
+    def write(self, name: str, file_path: str, digest: str):
+        """Store the file with its digest, replacing the stored one."""
+
+    @abc.abstractmethod
+    def location(self, name: str) -> str:
+        """Where the file is stored, e.g. its URL."""
+
+    @abc.abstractmethod
+    def sign(self, name: str) -> str:
+        """A URL to download the file without credentials."""
+
+
+class AzureBlobStorage(StorageBackend):
+    kind = "Azure Blob"
+
+    def __init__(self, connection_string: str, container: str = STORAGE_CONTAINER):
+        from azure.storage.blob import BlobServiceClient
+
+        self.container = container
+        self.container_client = BlobServiceClient.from_connection_string(
+            connection_string
+        ).get_container_client(container)
+        parts = dict(x.split("=", 1) for x in connection_string.split(";") if x)
+        self.account_name = parts.get("AccountName", "")
+        self.account_key = parts.get("AccountKey", "")
+
+    def stored_digest(self, name: str) -> str | None:
+        from azure.core.exceptions import ResourceNotFoundError
+
+        try:
+            properties = self.container_client.get_blob_client(
+                name
+            ).get_blob_properties()
+        except ResourceNotFoundError:
+            return None
+        return properties.metadata.get(DIGEST_KEY)
+
+    def write(self, name: str, file_path: str, digest: str):
+        with open(file_path, "rb") as data:
+            self.container_client.get_blob_client(name).upload_blob(
+                data,
+                length=os.path.getsize(file_path),
+                overwrite=True,
+                metadata={DIGEST_KEY: digest},
+                max_concurrency=STORAGE_UPLOAD_CONCURRENCY,
+            )
+
+    def location(self, name: str) -> str:
+        return self.container_client.get_blob_client(name).url
+
+    def sign(self, name: str) -> str:
+        from azure.storage.blob import BlobSasPermissions, generate_blob_sas
+
+        sas_token = generate_blob_sas(
+            account_name=self.account_name,
+            container_name=self.container,
+            blob_name=name,
+            account_key=self.account_key,
+            permission=BlobSasPermissions(read=True),
+            expiry=datetime.datetime.now(datetime.UTC)
+            + datetime.timedelta(seconds=STORAGE_URL_EXPIRY),
+        )
+        blob_url = f"https://{self.account_name}.blob.core.windows.net/{self.container}/{quote_plus(name)}"
+        return f"{blob_url}?{sas_token}"
+
+
+class S3Storage(StorageBackend):
+    """Any S3-compatible storage, the credentials as configured for boto3."""
+
+    kind = "S3"
+
+    def __init__(
+        self, bucket: str = STORAGE_CONTAINER, endpoint_url: str | None = None
+    ):
+        import boto3  # type: ignore[import-untyped,import-not-found]
+        from boto3.s3.transfer import (  # type: ignore[import-untyped,import-not-found]
+            TransferConfig,
+        )
+
+        self.bucket = bucket
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.transfer = TransferConfig(max_concurrency=STORAGE_UPLOAD_CONCURRENCY)
+
+    def stored_digest(self, name: str) -> str | None:
+        from botocore.exceptions import (  # type: ignore[import-untyped,import-not-found]
+            ClientError,
+        )
+
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=name)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return None
+            raise
+        return head["Metadata"].get(DIGEST_KEY)
+
+    def write(self, name: str, file_path: str, digest: str):
+        # multipart above the threshold of the transfer config
+        self.client.upload_file(
+            file_path,
+            self.bucket,
+            name,
+            ExtraArgs={"Metadata": {DIGEST_KEY: digest}},
+            Config=self.transfer,
+        )
+
+    def location(self, name: str) -> str:
+        return f"{self.client.meta.endpoint_url}/{self.bucket}/{quote(name)}"
+
+    def sign(self, name: str) -> str:
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": name},
+            ExpiresIn=STORAGE_URL_EXPIRY,
+        )
+
+
+class LocalStorage(StorageBackend):
+    """A directory, e.g. served by a web server, the digests next to the files."""
+
+    kind = "local"
+
+    def __init__(self, directory: str, base_url: str | None = None):
+        self.directory = directory
+        self.base_url = base_url
+        os.makedirs(directory, exist_ok=True)
+
+    def stored_digest(self, name: str) -> str | None:
+        try:
+            with open(self.location(name) + f".{DIGEST_KEY}") as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def write(self, name: str, file_path: str, digest: str):
+        path = self.location(name)
+        # copied aside first, so a reader never sees half of the file
+        fd, temp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "wb") as target, open(file_path, "rb") as source:
+            shutil.copyfileobj(source, target)
+        os.replace(temp_path, path)
+        with open(f"{path}.{DIGEST_KEY}", "w") as f:
+            f.write(digest)
+
+    def location(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def sign(self, name: str) -> str:
+        if self.base_url:
+            return f"{self.base_url.rstrip('/')}/{quote(name)}"
+        return self.location(name)
+
+
+def create_backend() -> StorageBackend | None:
+    if STORAGE_BACKEND == "azure":
+        if not AZURE_STORAGE_CONNECTION_STRING:
+            raise ValueError("AZURE_STORAGE_CONNECTION_STRING is expected!")
+        return AzureBlobStorage(AZURE_STORAGE_CONNECTION_STRING)
+    elif STORAGE_BACKEND == "s3":
+        return S3Storage(endpoint_url=S3_ENDPOINT_URL)
+    elif STORAGE_BACKEND == "local":
+        return LocalStorage(LOCAL_STORAGE_DIRECTORY, LOCAL_STORAGE_BASE_URL)
+    return None
+
+
+storage_backend = create_backend()
+# signed download URLs by client, bumped when a cert is renewed or revoked
+download_urls = VersionedCache(
+    "download_url", ttl=max(STORAGE_URL_EXPIRY - STORAGE_URL_MARGIN, 0)
+)
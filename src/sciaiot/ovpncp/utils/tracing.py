@@ -0,0 +1,410 @@
+"""Spans of the requests, exported as OpenTelemetry traces when slow.
+
+A trace is started per request and its spans are kept in memory until the
+request ends; only the traces slower than `TRACING_SLOW_MS`, or failed, are
+exported then (tail-based sampling). Out of a trace, a span costs a context
+variable lookup, so the spans stay in place when tracing is disabled.
+"""
+
+import abc
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+from contextlib import nullcontext
+from typing import Any, Self
+from urllib.request import Request, urlopen
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+TRACING_EXPORTERS = ("file", "otlp")
+TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "").lower()
+TRACING_FILE = os.getenv("TRACING_FILE", "/tmp/ovpncp-traces.jsonl")
+OTEL_EXPORTER_OTLP_ENDPOINT = os.getenv(
+    "OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318"
+)
+OTEL_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "ovpncp")
+# traces at least this slow are exported, the others dropped
+TRACING_SLOW_MS = float(os.getenv("TRACING_SLOW_MS", "500"))
+# spans kept per trace, against the loops of many queries
+TRACING_MAX_SPANS = int(os.getenv("TRACING_MAX_SPANS", "1000"))
+# traces waiting for the exporter thread, the new ones dropped when full
+TRACING_QUEUE_SIZE = int(os.getenv("TRACING_QUEUE_SIZE", "1000"))
+# traces exported at once by the exporter thread
+TRACING_BATCH_SIZE = 100
+TRACING_TIMEOUT = float(os.getenv("TRACING_TIMEOUT", "5"))
+
+# W3C trace context, e.g. 00-<trace id>-<parent span id>-01
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+# OTLP span kinds & status codes
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+STATUS_ERROR = 2
+
+if TRACING_EXPORTER and TRACING_EXPORTER not in TRACING_EXPORTERS:
+    raise ValueError(
+        f"Invalid TRACING_EXPORTER '{TRACING_EXPORTER}', "
+        f"expected one of {TRACING_EXPORTERS}!"
+    )
+
+
+class Trace:
+    """The spans of a trace, recorded until its root span ends."""
+
+    __slots__ = ("failed", "spans", "trace_id")
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: list[Span] = []
+        self.failed = False
+
+
+class Span:
+    """A timed operation of a trace, the current span in its `with` block."""
+
+    __slots__ = (
+        "attributes",
+        "end_ns",
+        "error",
+        "kind",
+        "name",
+        "parent_id",
+        "span_id",
+        "start_ns",
+        "token",
+        "trace",
+    )
+
+    def __init__(
+        self,
+        trace: Trace,
+        name: str,
+        parent_id: str = "",
+        kind: int = SPAN_KIND_INTERNAL,
+        attributes: dict[str, Any] | None = None,
+    ):
+        self.trace = trace
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes or {}
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.error: str | None = None
+        self.token: contextvars.Token[Span | None] | None = None
+        if len(trace.spans) < TRACING_MAX_SPANS:
+            trace.spans.append(self)
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace.trace_id}-{self.span_id}-01"
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def record_error(self, error: str):
+        self.error = error
+        self.trace.failed = True
+
+    def end(self):
+        self.end_ns = time.time_ns()
+
+    def __enter__(self) -> Self:
+        self.token = current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.record_error(f"{exc_type.__name__}: {exc}")
+        if self.token is not None:
+            current_span.reset(self.token)
+            self.token = None
+        self.end()
+
+
+current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+def start_span(name: str, kind: int = SPAN_KIND_INTERNAL, attributes=None):
+    """A child of the current span, None out of a trace."""
+    parent = current_span.get()
+    if parent is None:
+        return None
+    return Span(parent.trace, name, parent.span_id, kind, attributes)
+
+
+def span(name: str, kind: int = SPAN_KIND_INTERNAL, attributes=None):
+    """Trace the `with` block as a child of the current span, if any."""
+    child = start_span(name, kind, attributes)
+    return nullcontext() if child is None else child
+
+
+def traced(name: str | None = None):
+    """Trace the calls of the function, sync or async, within a trace."""
+
+    def decorator(func):
+        span_name = name or f"{func.__module__.rsplit('.', 1)[-1]}.{func.__name__}"
+
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                child = start_span(span_name)
+                if child is None:
+                    return await func(*args, **kwargs)
+                with child:
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            child = start_span(span_name)
+            if child is None:
+                return func(*args, **kwargs)
+            with child:
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def propagated(func):
+    """Run the function in the current trace, e.g. submitted to an executor.
+
+    `run_in_threadpool` copies the context already, the executors do not.
+    """
+    if current_span.get() is None:
+        return func
+    return functools.partial(contextvars.copy_context().run, func)
+
+
+def trace_queries(engine: Engine):
+    """Trace the queries of the engine, each as a span."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_query(conn, cursor, statement, parameters, context, executemany):
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement else ""
+        child = start_span(
+            f"db {operation}",
+            SPAN_KIND_CLIENT,
+            {"db.system": engine.dialect.name, "db.statement": statement[:1000]},
+        )
+        conn.info.setdefault("spans", []).append(child)
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def end_query(conn, cursor, statement, parameters, context, executemany):
+        spans = conn.info.get("spans")
+        child = spans.pop() if spans else None
+        if child is not None:
+            child.end()
+
+    @event.listens_for(engine, "handle_error")
+    def fail_query(exception_context):
+        connection = exception_context.connection
+        spans = connection.info.get("spans") if connection is not None else None
+        child = spans.pop() if spans else None
+        if child is not None:
+            error = exception_context.original_exception
+            child.record_error(f"{type(error).__name__}: {error}")
+            child.end()
+
+
+def attribute_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [attribute_value(v) for v in value]}}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(traces: list[list[Span]]) -> dict:
+    """The traces in the OTLP/JSON encoding of an export request."""
+    spans = []
+    for trace in traces:
+        for s in trace:
+            encoded = {
+                "traceId": s.trace.trace_id,
+                "spanId": s.span_id,
+                "parentSpanId": s.parent_id,
+                "name": s.name,
+                "kind": s.kind,
+                "startTimeUnixNano": str(s.start_ns),
+                "endTimeUnixNano": str(s.end_ns or s.start_ns),
+                "attributes": [
+                    {"key": key, "value": attribute_value(value)}
+                    for key, value in s.attributes.items()
+                    if value is not None
+                ],
+            }
+            if s.error is not None:
+                encoded["status"] = {"code": STATUS_ERROR, "message": s.error}
+            spans.append(encoded)
+
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [
+                        {
+                            "key": "service.name",
+                            "value": {"stringValue": OTEL_SERVICE_NAME},
+                        }
+                    ]
+                },
+                "scopeSpans": [{"scope": {"name": "sciaiot.ovpncp"}, "spans": spans}],
+            }
+        ]
+    }
+
+
+class SpanExporter(abc.ABC):
+    """Exports the sampled traces from a thread, out of the request path.
+
+    The traces queued while the previous export ran are exported together;
+    when the queue is full, the new ones are dropped & counted.
+    """
+
+    def __init__(self, size: int = TRACING_QUEUE_SIZE):
+        self.queue: queue.Queue = queue.Queue(size)
+        self.dropped = 0
+        self.thread: threading.Thread | None = None
+
+    def submit(self, trace: list[Span]):
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self.run, name="trace-exporter", daemon=True
+            )
+            self.thread.start()
+        try:
+            self.queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while batch[-1] is not None and len(batch) < TRACING_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            traces = [trace for trace in batch if trace is not None]
+            if traces:
+                try:
+                    self.export(traces)
+                except Exception as e:  # noqa: BLE001 - e.g. a collector down, next batch
+                    logger.error(f"Failed to export {len(traces)} traces: {e}")
+            if len(traces) < len(batch):
+                return
+
+    def close(self):
+        """Export the queued traces, then stop the thread."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    @abc.abstractmethod
+    def export(self, traces: list[list[Span]]):
+        """Send a batch of traces, from the exporter's thread."""
+
+
+class FileExporter(SpanExporter):
+    """Appends the traces to a file, one OTLP/JSON export request per line."""
+
+    def __init__(self, path: str = TRACING_FILE, size: int = TRACING_QUEUE_SIZE):
+        super().__init__(size)
+        self.path = path
+
+    def export(self, traces: list[list[Span]]):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(to_otlp(traces)) + "\n")
+
+
+class OtlpExporter(SpanExporter):
+    """Posts the traces to an OTLP/HTTP endpoint, e.g. of a collector."""
+
+    def __init__(
+        self,
+        endpoint: str = OTEL_EXPORTER_OTLP_ENDPOINT,
+        size: int = TRACING_QUEUE_SIZE,
+    ):
+        super().__init__(size)
+        self.url = f"{endpoint.rstrip('/')}/v1/traces"
+
+    def export(self, traces: list[list[Span]]):
+        request = Request(
+            self.url,
+            data=json.dumps(to_otlp(traces)).encode(),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        with urlopen(request, timeout=TRACING_TIMEOUT) as response:
+            response.read()
+
+
+class Tracer:
+    """Starts the traces & exports the slow or failed ones once ended."""
+
+    def __init__(self, exporter: SpanExporter, slow_ms: float = TRACING_SLOW_MS):
+        self.exporter = exporter
+        self.slow_ms = slow_ms
+
+    def start(self, name: str, traceparent: str | None = None, attributes=None) -> Span:
+        """The root span of a new trace, or of the caller's one."""
+        match = TRACEPARENT.match(traceparent) if traceparent else None
+        if match:
+            trace_id, parent_id = match.groups()
+        else:
+            trace_id, parent_id = f"{random.getrandbits(128):032x}", ""
+        return Span(Trace(trace_id), name, parent_id, SPAN_KIND_SERVER, attributes)
+
+    def finish(self, root: Span) -> bool:
+        """End the trace of the root span, whether it was exported."""
+        if not root.end_ns:
+            root.end()
+        if not root.trace.failed and root.duration_ms < self.slow_ms:
+            return False
+
+        self.exporter.submit(list(root.trace.spans))
+        return True
+
+
+def create_tracer() -> Tracer | None:
+    if TRACING_EXPORTER == "file":
+        return Tracer(FileExporter())
+    elif TRACING_EXPORTER == "otlp":
+        return Tracer(OtlpExporter())
+    return None
+
+
+tracer = create_tracer()
+
+
+def is_enabled() -> bool:
+    return tracer is not None
@@ -0,0 +1,273 @@
+"""Per-client traffic sampled from the status file, downsampled in memory."""
+
+import asyncio
+import logging
+import os
+import time
+from array import array
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from fastapi.concurrency import run_in_threadpool
+from sqlmodel import col, select
+
+from sciaiot.ovpncp.data.traffic import TrafficPoint, TrafficSample
+from sciaiot.ovpncp.dependencies import get_async_session
+from sciaiot.ovpncp.utils import openvpn
+from sciaiot.ovpncp.utils.ingestion import resolve_client_ids, to_local
+from sciaiot.ovpncp.utils.lock import OwnerLock
+
+logger = logging.getLogger(__name__)
+
+TRAFFIC_SAMPLE_INTERVAL = float(os.getenv("TRAFFIC_SAMPLE_INTERVAL", "10"))
+# (step, slots) of each tier: 15 minutes of 10s, 3 hours of 1m, 2 days of 1h
+TRAFFIC_TIERS = ((10, 90), (60, 180), (3600, 48))
+# the tiers flushed to the DB once their buckets are complete
+PERSISTED_STEPS = (60, 3600)
+# held by the one worker of the app writing the samples
+TRAFFIC_LOCK_FILE = os.getenv("TRAFFIC_LOCK_FILE", "/tmp/ovpncp-traffic.lock")
+
+
+class RingBuffer:
+    """Byte counts of the last `slots` buckets of `step` seconds."""
+
+    def __init__(self, step: int, slots: int):
+        self.step = step
+        self.slots = slots
+        self.buckets = array("q", [-1]) * slots
+        self.received = array("q", [0]) * slots
+        self.sent = array("q", [0]) * slots
+
+    def add(self, timestamp: float, received: int, sent: int):
+        bucket = int(timestamp // self.step)
+        slot = bucket % self.slots
+        if self.buckets[slot] != bucket:
+            self.buckets[slot] = bucket
+            self.received[slot] = 0
+            self.sent[slot] = 0
+        self.received[slot] += received
+        self.sent[slot] += sent
+
+    def get(self, bucket: int) -> tuple[int, int] | None:
+        slot = bucket % self.slots
+        if self.buckets[slot] != bucket:
+            return None
+        return self.received[slot], self.sent[slot]
+
+
+class ClientTraffic:
+    def __init__(self):
+        self.tiers = [RingBuffer(step, slots) for step, slots in TRAFFIC_TIERS]
+        self.counters: tuple[str, int, int] | None = None
+        self.last_seen = 0.0
+
+
+def aggregate(points: dict[int, list[int]], key: int, received: int, sent: int):
+    point = points.setdefault(key, [0, 0])
+    point[0] += received
+    point[1] += sent
+
+
+def to_points(points: dict[int, list[int]]) -> list[TrafficPoint]:
+    return [
+        TrafficPoint(time=datetime.fromtimestamp(key), bytes_received=rx, bytes_sent=tx)
+        for key, (rx, tx) in sorted(points.items())
+    ]
+
+
+class TrafficSampler:
+    """Record the byte counters of the connected clients at a fixed interval.
+
+    The deltas go to one ring buffer per tier & client, so the memory per
+    client is fixed; complete buckets of the persisted tiers are written in
+    one batch per round. Clients idle longer than the longest tier are
+    dropped.
+
+    Every worker of the app samples into its own buffers to serve the recent
+    ranges, but only the one holding the lock file writes the buckets; the
+    others mark them as written and take the writes over once it is gone.
+    """
+
+    def __init__(
+        self,
+        session_factory,
+        interval: float = TRAFFIC_SAMPLE_INTERVAL,
+        lock_file: str = TRAFFIC_LOCK_FILE,
+    ):
+        self.session_factory = session_factory
+        self.interval = interval
+        self.lock = OwnerLock(lock_file)
+        self.clients: dict[str, ClientTraffic] = {}
+        self.flushed: dict[int, int] = {}
+        self.started_at: float | None = None
+        self.stopped: asyncio.Event | None = None
+        self.retention = max(step * slots for step, slots in TRAFFIC_TIERS)
+
+    def record(self, connections: list[dict], timestamp: float):
+        first = self.started_at is None
+        for connection in connections:
+            traffic = self.clients.get(connection["name"])
+            if traffic is None:
+                traffic = self.clients[connection["name"]] = ClientTraffic()
+
+            remote_address = connection["remote_address"]
+            received = connection["bytes_received"]
+            sent = connection["bytes_sent"]
+            last = traffic.counters
+            if first:
+                # counters accumulated before the sampler started, a baseline
+                delta = (0, 0)
+            elif (
+                last is not None
+                and last[0] == remote_address
+                and received >= last[1]
+                and sent >= last[2]
+            ):
+                delta = (received - last[1], sent - last[2])
+            else:
+                # a new connection, its counters start over
+                delta = (received, sent)
+
+            traffic.counters = (remote_address, received, sent)
+            traffic.last_seen = timestamp
+            for tier in traffic.tiers:
+                tier.add(timestamp, *delta)
+
+        for name, traffic in list(self.clients.items()):
+            if timestamp - traffic.last_seen > self.retention:
+                del self.clients[name]
+
+        if first:
+            self.started_at = timestamp
+            for step in PERSISTED_STEPS:
+                self.flushed[step] = int(timestamp // step) - 1
+
+    def complete_samples(self, timestamp: float) -> tuple[dict, list]:
+        """Collect the complete buckets of the persisted tiers not written yet."""
+        flushed = {}
+        samples = []
+        for index, (step, slots) in enumerate(TRAFFIC_TIERS):
+            if step not in PERSISTED_STEPS or step not in self.flushed:
+                continue
+
+            current = int(timestamp // step)
+            start = max(self.flushed[step] + 1, current - slots + 1)
+            for bucket in range(start, current):
+                for name, traffic in self.clients.items():
+                    counts = traffic.tiers[index].get(bucket)
+                    if counts and any(counts):
+                        samples.append((name, step, bucket * step, *counts))
+            flushed[step] = current - 1
+
+        return flushed, samples
+
+    async def flush(self, session, timestamp: float) -> int:
+        flushed, samples = self.complete_samples(timestamp)
+        client_ids = await resolve_client_ids(
+            session, {sample[0] for sample in samples}
+        )
+        rows = [
+            TrafficSample(
+                client_id=client_ids[name],
+                step=step,
+                time=datetime.fromtimestamp(start),
+                bytes_received=received,
+                bytes_sent=sent,
+            )
+            for name, step, start, received, sent in samples
+            if name in client_ids
+        ]
+        session.add_all(rows)
+        await session.commit()
+
+        # moved only once written, a failed batch is retried next round
+        self.flushed.update(flushed)
+        return len(rows)
+
+    def series(
+        self, name: str, start: float, end: float, step: int
+    ) -> list[TrafficPoint] | None:
+        """Serve the range from the buffers, or None if they don't cover it."""
+        if self.started_at is None:
+            return None
+
+        now = time.time()
+        traffic = self.clients.get(name)
+        points: dict[int, list[int]] = {}
+        # the finest tier keeping the whole range
+        for index, (tier_step, slots) in enumerate(TRAFFIC_TIERS):
+            oldest = (int(now // tier_step) - slots + 1) * tier_step
+            if step % tier_step or start < max(oldest, self.started_at):
+                continue
+
+            if traffic is not None:
+                tier = traffic.tiers[index]
+                for bucket in range(int(start // tier_step), int(end // tier_step) + 1):
+                    counts = tier.get(bucket)
+                    if counts and any(counts):
+                        aggregate(points, bucket * tier_step // step * step, *counts)
+            return to_points(points)
+
+        return None
+
+    async def run(self):
+        self.stopped = asyncio.Event()
+        logger.info(f"Sampling the client traffic every {self.interval} seconds.")
+        while not self.stopped.is_set():
+            try:
+                connections = await run_in_threadpool(openvpn.list_connections)
+                timestamp = time.time()
+                self.record(connections, timestamp)
+                if self.lock.owned or self.take_over():
+                    async with self.session_factory() as session:
+                        await self.flush(session, timestamp)
+                else:
+                    # written by the owner, as many times as workers otherwise
+                    self.flushed.update(self.complete_samples(timestamp)[0])
+            except Exception as e:  # noqa: BLE001 - sampled again next interval
+                logger.error(f"Failed to sample the client traffic: {e}")
+
+            try:
+                await asyncio.wait_for(self.stopped.wait(), self.interval)
+            except TimeoutError:
+                pass
+
+        self.lock.release()
+
+    def take_over(self) -> bool:
+        if not self.lock.acquire():
+            return False
+        logger.info("Writing the client traffic samples.")
+        return True
+
+    def stop(self):
+        if self.stopped is not None:
+            self.stopped.set()
+
+
+async def load_series(
+    session, client_id: int, start: datetime, end: datetime, step: int
+) -> list[TrafficPoint]:
+    """Read a range older than the buffers from the persisted tiers.
+
+    The samples are stored in local time, like the connection times.
+    """
+    tier_step = max(s for s in PERSISTED_STEPS if step % s == 0)
+    statement = (
+        select(TrafficSample)
+        .where(
+            TrafficSample.client_id == client_id,
+            TrafficSample.step == tier_step,
+            TrafficSample.time >= to_local(start),
+            TrafficSample.time <= to_local(end),
+        )
+        .order_by(col(TrafficSample.time))
+    )
+    points: dict[int, list[int]] = {}
+    for sample in (await session.exec(statement)).all():
+        key = int(sample.time.timestamp()) // step * step
+        aggregate(points, key, sample.bytes_received, sample.bytes_sent)
+    return to_points(points)
+
+
+traffic_sampler = TrafficSampler(asynccontextmanager(get_async_session))
@@ -1,4 +1,8 @@
+import os
+
 import pytest
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool, StaticPool
 from sqlmodel import Session, SQLModel, create_engine
 
 
@@ -20,3 +24,35 @@ def db_engine(request):
 def db_session(db_engine):
     with Session(db_engine) as session:
         yield session
+
+
+@pytest.fixture(scope="session")
+def db_async_engine(db_engine):
+    """Asyncio engine on the test database, enabled by TEST_ASYNC_ENGINE."""
+    if not os.getenv("TEST_ASYNC_ENGINE"):
+        yield None
+        return
+
+    # every TestClient runs its own event loop, so connections are not pooled
+    url = db_engine.url.set(drivername="sqlite+aiosqlite")
+    engine = create_async_engine(url, poolclass=NullPool)
+    yield engine
+    engine.sync_engine.dispose()
+
+
+@pytest.fixture(name="memory_engine")
+def memory_engine_fixture():
+    """In-memory database of a test with all tables, shared by its threads."""
+    engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    SQLModel.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture(name="session")
+def session_fixture(memory_engine):
+    """Session on the in-memory database, seeded by the modules overriding it."""
+    with Session(memory_engine, expire_on_commit=False) as session:
+        yield session
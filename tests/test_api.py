@@ -1,23 +1,35 @@
 import os
 import stat
+from contextlib import asynccontextmanager
 from datetime import datetime
 from unittest.mock import MagicMock, mock_open, patch
 
 import pytest
 from fastapi.testclient import TestClient
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from sciaiot.ovpncp.data.server import Client
-from sciaiot.ovpncp.dependencies import get_session
+from sciaiot.ovpncp.data.traffic import TrafficSample
+from sciaiot.ovpncp.dependencies import ThreadedSession, get_async_session
 from sciaiot.ovpncp.main import app
+from sciaiot.ovpncp.utils.ingestion import ConnectionEventWriter, get_event_writer
 from tests import test_iproute, test_openvpn
 
 
 @pytest.fixture(name="client")
-def client_fixture(db_session):
-    def get_session_override():
-        return db_session
+def client_fixture(db_session, db_async_engine):
+    async def get_session_override():
+        if db_async_engine is None:
+            yield ThreadedSession(db_session)
+            return
 
-    app.dependency_overrides[get_session] = get_session_override
+        async with AsyncSession(db_async_engine, expire_on_commit=False) as session:
+            yield session
+
+    writer = ConnectionEventWriter(asynccontextmanager(get_session_override))
+    app.dependency_overrides[get_async_session] = get_session_override
+    app.dependency_overrides[get_event_writer] = lambda: writer
 
     with patch(
         "sciaiot.ovpncp.middlewares.azure_security.validate_token",
@@ -203,6 +215,23 @@ def test_get_clients(client: TestClient):
     assert len(content) == 3
 
 
+def test_get_clients_paginated(client: TestClient):
+    response = client.get("/clients", params={"limit": 2})
+    assert response.status_code == 200
+
+    content = response.json()
+    assert [c["name"] for c in content] == ["test_client_1", "test_client_2"]
+    assert content[0]["cert"]["issued_by"] == "mock"
+
+    cursor = response.headers["X-Next-Cursor"]
+    response = client.get("/clients", params={"limit": 2, "after": cursor})
+    assert response.status_code == 200
+
+    content = response.json()
+    assert [c["name"] for c in content] == ["test_gateway_1"]
+    assert "X-Next-Cursor" not in response.headers
+
+
 @patch("sciaiot.ovpncp.utils.openvpn.add_iroute")
 @patch("sciaiot.ovpncp.utils.openvpn.assign_client_ip")
 def test_assign_virtual_address(
@@ -249,6 +278,22 @@ def test_assign_virtual_address(
     mock_add_iroute.assert_called_with("test_gateway_1", "192.168.1.0 255.255.255.0")
 
 
+def test_get_clients_filtered(client: TestClient):
+    response = client.get("/clients", params={"has_address": True, "revoked": False})
+    assert response.status_code == 200
+    assert len(response.json()) == 3
+
+    response = client.get("/clients", params={"has_address": False})
+    assert response.status_code == 200
+    assert response.json() == []
+
+    response = client.get(
+        "/clients", params={"cert_expires_before": datetime(2000, 1, 1).isoformat()}
+    )
+    assert response.status_code == 200
+    assert response.json() == []
+
+
 def test_start_connection(client: TestClient):
     response = client.post(
         "/clients/test_client_1/connections",
@@ -363,7 +408,7 @@ def test_create_restricted_network_with_private_network_addresses(
     ]
     mock_list_rules.assert_called_with("FORWARD")
     mock_apply_rules.assert_called_with("FORWARD", 1, rules)
-    mock_push_client_routes.assert_called_with("test_client_1", routes)
+    mock_push_client_routes.assert_called_with("test_client_1", routes, content["id"])
 
 
 def test_close_connection(client: TestClient):
@@ -440,7 +485,12 @@ def test_drop_restricted_network(
         "-i tun0 -s 10.8.0.2 -d 192.168.1.3 -j ACCEPT",
         "-i tun0 -s 192.168.1.3 -d 10.8.0.2 -j ACCEPT",
     ]
-    mock_pull_client_routes.assert_called_with("test_client_1")
+    routes = [
+        "192.168.1.1 255.255.255.255 10.8.0.11",
+        "192.168.1.2 255.255.255.255 10.8.0.11",
+        "192.168.1.3 255.255.255.255 10.8.0.11",
+    ]
+    mock_pull_client_routes.assert_called_with("test_client_1", 2, routes)
     mock_drop_rules.assert_called_with("FORWARD", rules)
 
 
@@ -461,6 +511,27 @@ def test_unassign_virtual_address(mock_unassign_client_ip, client: TestClient):
     mock_unassign_client_ip.assert_called_with("test_client_2")
 
 
+def test_rebuild_ccd(client: TestClient, tmp_path):
+    ccd_dir = tmp_path / "ccd"
+    ccd_dir.mkdir()
+    (ccd_dir / "deleted_client").write_text("ifconfig-push 10.8.0.9 255.255.255.0\n")
+
+    with patch("sciaiot.ovpncp.utils.openvpn.openvpn_dir", str(tmp_path)):
+        response = client.post("/server/rebuild-ccd")
+        assert response.status_code == 200
+        assert response.json() == {"written": 2, "unchanged": 0, "removed": 1}
+        assert sorted(os.listdir(ccd_dir)) == ["test_client_1", "test_gateway_1"]
+        assert (ccd_dir / "test_gateway_1").read_text() == (
+            "# owner: ip\n"
+            "ifconfig-push 10.8.0.11 255.255.255.0\n"
+            "# owner: iroute\n"
+            "iroute 192.168.1.0 255.255.255.0\n"
+        )
+
+        response = client.post("/server/rebuild-ccd")
+        assert response.json() == {"written": 0, "unchanged": 2, "removed": 0}
+
+
 def test_get_client(client: TestClient):
     response = client.get("/clients/test_client_1")
     assert response.status_code == 200
@@ -471,6 +542,24 @@ def test_get_client(client: TestClient):
     assert content["virtual_address"]["ip"] == "10.8.0.2"
     assert len(content["connections"]) == 1
     assert len(content["cert"]) is not None
+    assert content["connections_cursor"] is None
+
+
+def test_get_client_connections_paginated(client: TestClient):
+    response = client.get("/clients/test_client_1", params={"connections_limit": 1})
+    assert response.status_code == 200
+
+    content = response.json()
+    assert len(content["connections"]) == 1
+
+    cursor = content["connections_cursor"]
+    assert cursor is not None
+
+    response = client.get(
+        "/clients/test_client_1", params={"connections_before": cursor}
+    )
+    assert response.status_code == 200
+    assert response.json()["connections"] == []
 
 
 @patch(
@@ -539,6 +628,52 @@ def test_revoke_client(mock_generate_crl, mock_revoke_client, client: TestClient
     mock_revoke_client.assert_called_once_with("test_client_1")
 
 
+def test_ingest_connection_events(client: TestClient):
+    now = datetime.now().isoformat()
+    response = client.post(
+        "/connections/events",
+        json=[
+            {
+                "type": "connect",
+                "client_name": "test_client_2",
+                "remote_address": "172.205.176.209:60374",
+                "time": now,
+            },
+            {
+                "type": "connect",
+                "client_name": "unknown_client",
+                "remote_address": "172.205.176.210:60374",
+                "time": now,
+            },
+            {
+                "type": "disconnect",
+                "client_name": "test_client_2",
+                "remote_address": "172.205.176.209:60374",
+                "time": now,
+            },
+            {
+                "type": "disconnect",
+                "client_name": "test_client_2",
+                "remote_address": "172.205.176.209:60374",
+                "time": now,
+            },
+        ],
+    )
+    assert response.status_code == 200
+
+    content = response.json()
+    assert content["accepted"] == 2
+    assert content["rejected"] == [
+        {"index": 1, "detail": 'Client "unknown_client" not found!'},
+        {"index": 3, "detail": 'Connection with client "test_client_2" not found!'},
+    ]
+
+    response = client.get("/clients/test_client_2")
+    connections = response.json()["connections"]
+    assert connections[0]["remote_address"] == "172.205.176.209:60374"
+    assert connections[0]["disconnected_time"] is not None
+
+
 def test_close_connection_privacy(client: TestClient):
     # This should be masked now (VULN-006)
     remote_ip = "1.2.3.4"
@@ -555,31 +690,156 @@ def test_close_connection_privacy(client: TestClient):
     assert "***.***.***.***" in response.json()["detail"]
 
 
-@patch(
-    "sciaiot.ovpncp.middlewares.azure_storage.generate_blob_sas",
-    return_value="sig=SECRET_TOKEN",
-)
-@patch("sciaiot.ovpncp.middlewares.azure_storage.logger")
+@patch("azure.storage.blob.generate_blob_sas", return_value="sig=SECRET_TOKEN")
+@patch("sciaiot.ovpncp.middlewares.storage.logger")
 def test_azure_storage_logging_privacy(mock_logger, mock_sas, client: TestClient):
-    import sciaiot.ovpncp.middlewares.azure_storage as azure_storage
-    from sciaiot.ovpncp.middlewares.azure_storage import handle_download
-
-    # Manually set attributes that might not be present if env var was missing
-    azure_storage.account_name = "testaccount"
-    azure_storage.account_key = "testkey"
+    from sciaiot.ovpncp.middlewares.storage import sign_download
+    from sciaiot.ovpncp.utils.storage import AzureBlobStorage
 
-    request = MagicMock()
-    request.path_params = {"client_name": "test_client"}
-
-    async def call_next(req):
-        return MagicMock()
+    backend = AzureBlobStorage(
+        "DefaultEndpointsProtocol=https;AccountName=testaccount;AccountKey=dGVzdGtleQ=="
+    )
 
     import asyncio
 
-    asyncio.run(handle_download(request, call_next))
+    asyncio.run(sign_download(backend, "test_client"))
 
     # Verify that the logger was called with the SAS URL
     # In the fixed state, it should contain the masked token
     log_calls = [call[0][0] for call in mock_logger.info.call_args_list]
     assert any("sig=***" in msg for msg in log_calls)
     assert not any("sig=SECRET_TOKEN" in msg for msg in log_calls)
+
+
+@patch("sciaiot.ovpncp.utils.openvpn.list_connections")
+def test_reconcile_connections(mock_list_connections, client: TestClient):
+    mock_list_connections.return_value = [
+        {
+            "name": "test_client_2",
+            "ip": "10.8.0.3",
+            "remote_address": "172.205.176.209:60374",
+            "connected_time": "2025-01-14 06:04:34",
+        }
+    ]
+    response = client.post("/connections/reconcile")
+    assert response.status_code == 200
+    assert response.json() == {"closed": 0, "opened": 1, "unknown_clients": []}
+
+    response = client.post("/connections/reconcile")
+    assert response.json() == {"closed": 0, "opened": 0, "unknown_clients": []}
+
+
+def test_get_client_traffic(db_session, client: TestClient):
+    client_id = db_session.exec(
+        select(Client.id).where(Client.name == "test_client_2")
+    ).one()
+    db_session.add_all(
+        TrafficSample(
+            client_id=client_id,
+            step=60,
+            time=datetime(2025, 1, 14, 6, minute),
+            bytes_received=100,
+            bytes_sent=10,
+        )
+        for minute in range(3)
+    )
+    db_session.commit()
+
+    response = client.get(
+        "/clients/test_client_2/traffic",
+        params={"from": "2025-01-14T06:00:00", "to": "2025-01-14T07:00:00"},
+    )
+    assert response.status_code == 200
+    assert len(response.json()) == 3
+
+    response = client.get(
+        "/clients/test_client_2/traffic",
+        params={
+            "from": "2025-01-14T06:00:00",
+            "to": "2025-01-14T07:00:00",
+            "step": 120,
+        },
+    )
+    assert response.json() == [
+        {"time": "2025-01-14T06:00:00", "bytes_received": 200, "bytes_sent": 20},
+        {"time": "2025-01-14T06:02:00", "bytes_received": 100, "bytes_sent": 10},
+    ]
+
+    response = client.get(
+        "/clients/test_client_2/traffic",
+        params={"from": "2025-01-14T06:00:00", "to": "2025-01-14T07:00:00", "step": 15},
+    )
+    assert response.status_code == 400
+
+    response = client.get(
+        "/clients/unknown/traffic",
+        params={"from": "2025-01-14T06:00:00", "to": "2025-01-14T07:00:00"},
+    )
+    assert response.status_code == 404
+
+
+def test_get_connection_stats(client: TestClient):
+    response = client.get(
+        "/connections/stats",
+        params={"from": "2025-01-14T00:00:00", "to": "2025-01-15T00:00:00"},
+    )
+    assert response.status_code == 200
+    stats = response.json()
+    assert stats["active"] >= 1
+    assert stats["sessions"] >= 1
+    assert stats["peak"] >= 1
+    assert len(stats["concurrency"]) == 24
+    assert {"client_name": "test_client_2", "sessions": 1} in stats["clients"]
+
+    response = client.get(
+        "/connections/stats",
+        params={"from": "2025-01-15T00:00:00", "to": "2025-01-14T00:00:00"},
+    )
+    assert response.status_code == 400
+
+
+def test_stream_connection_events(client: TestClient):
+    with client.websocket_connect("/connections/stream") as websocket:
+        response = client.post(
+            "/connections/events",
+            json=[
+                {
+                    "type": "connect",
+                    "client_name": "test_client_2",
+                    "remote_address": "172.205.176.210:60374",
+                    "time": "2025-01-14T07:00:00",
+                },
+                {
+                    "type": "connect",
+                    "client_name": "unknown",
+                    "remote_address": "172.205.176.211:60374",
+                    "time": "2025-01-14T07:00:00",
+                },
+            ],
+        )
+        assert response.json()["accepted"] == 1
+
+        # only the accepted events are published
+        assert websocket.receive_json() == {
+            "type": "connect",
+            "client_name": "test_client_2",
+            "remote_address": "172.205.176.210:60374",
+            "time": "2025-01-14T07:00:00",
+        }
+
+
+def test_purge_connections(client: TestClient):
+    response = client.post("/connections/purge", params={"days": 0})
+    assert response.status_code == 400
+
+    # everything closed so far
+    response = client.post("/connections/purge", params={"days": 1e-6})
+    assert response.status_code == 200
+    result = response.json()
+    assert result["deleted"] >= 1
+    assert result["dropped_partitions"] == []
+
+    response = client.get("/clients/test_client_1/rollups")
+    assert response.status_code == 200
+    rollups = response.json()
+    assert rollups and all(rollup["sessions"] >= 1 for rollup in rollups)
@@ -0,0 +1,84 @@
+import asyncio
+import threading
+from datetime import datetime
+
+from sciaiot.ovpncp.data.server import ConnectionEvent
+from sciaiot.ovpncp.routes.connection import stream_events
+from sciaiot.ovpncp.utils.broadcast import EventBroadcaster
+
+
+def event(name: str, type: str = "connect"):
+    return ConnectionEvent(
+        type=type,  # type: ignore
+        client_name=name,
+        remote_address="1.1.1.1:1",
+        time=datetime(2025, 1, 14, 6, 4, 34),
+    )
+
+
+def test_fan_out():
+    async def run():
+        broadcaster = EventBroadcaster(max_size=10)
+        subscriptions = [broadcaster.subscribe() for _ in range(500)]
+        broadcaster.publish([event("device_0"), event("device_0", "disconnect")])
+
+        for subscription in subscriptions:
+            assert (await subscription.get(1))[0] == "connect"
+            assert (await subscription.get(1))[0] == "disconnect"
+        assert broadcaster.dropped == 0
+
+    asyncio.run(run())
+
+
+def test_drop_slow_subscriber():
+    async def run():
+        broadcaster = EventBroadcaster(max_size=2)
+        slow = broadcaster.subscribe()
+        fast = broadcaster.subscribe()
+        for i in range(3):
+            broadcaster.publish([event(f"device_{i}")])
+            await fast.get(1)
+
+        assert broadcaster.dropped == 1
+        assert broadcaster.subscriptions == {fast}
+        # the end of stream replaces what was left behind
+        assert await slow.get(1) is None
+
+    asyncio.run(run())
+
+
+def test_publish_from_another_thread():
+    async def run():
+        broadcaster = EventBroadcaster()
+        subscription = broadcaster.subscribe()
+        thread = threading.Thread(
+            target=broadcaster.publish, args=([event("device_0")],)
+        )
+        thread.start()
+        item = await subscription.get(1)
+        thread.join()
+        assert item == ("connect", event("device_0").model_dump_json())
+
+    asyncio.run(run())
+
+
+def test_stream_events(monkeypatch):
+    async def run():
+        broadcaster = EventBroadcaster(max_size=1)
+        monkeypatch.setattr("sciaiot.ovpncp.routes.connection.broadcaster", broadcaster)
+        monkeypatch.setattr("sciaiot.ovpncp.routes.connection.STREAM_KEEPALIVE", 0.01)
+        subscription = broadcaster.subscribe()
+        stream = stream_events(subscription)
+
+        assert await anext(stream) == ": keepalive\n\n"
+        broadcaster.publish([event("device_0")])
+        assert await anext(stream) == (
+            f"event: connect\ndata: {event('device_0').model_dump_json()}\n\n"
+        )
+
+        # dropped, the stream ends
+        broadcaster.publish([event("device_1"), event("device_2")])
+        assert [frame async for frame in stream] == []
+        assert broadcaster.subscriptions == set()
+
+    asyncio.run(run())
@@ -0,0 +1,112 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+from sqlmodel import Session, select
+
+from sciaiot.ovpncp.data.cache import CacheVersion
+from sciaiot.ovpncp.dependencies import ThreadedSession
+from sciaiot.ovpncp.utils.cache import VersionedCache, seed_versions
+
+
+@pytest.fixture(name="session")
+def session_fixture(session):
+    yield ThreadedSession(session)
+
+
+def test_get_and_set():
+    cache = VersionedCache("test", ttl=60)
+    assert cache.get("client_1") is None
+
+    cache.set("client_1", 1)
+    assert cache.get("client_1") == 1
+    assert cache.hits == 1
+    assert cache.misses == 1
+
+
+@patch("sciaiot.ovpncp.utils.cache.time.monotonic", side_effect=[0, 10, 61])
+def test_expiry(mock_monotonic):
+    cache = VersionedCache("test", ttl=60)
+    cache.set("client_1", 1)
+    assert cache.get("client_1") == 1
+    assert cache.get("client_1") is None
+
+
+def test_invalidate():
+    cache = VersionedCache("test", ttl=60)
+    cache.set("client_1", 1)
+    cache.set("client_2", 2)
+
+    cache.invalidate("client_1")
+    assert cache.get("client_1") is None
+    assert cache.get("client_2") == 2
+
+    cache.invalidate()
+    assert cache.get("client_2") is None
+
+
+def test_cross_worker_invalidation(session):
+    # two caches with the same name stand for two workers
+    worker_1 = VersionedCache("server", ttl=60, check_interval=0)
+    worker_2 = VersionedCache("server", ttl=60, check_interval=0)
+
+    async def run():
+        await worker_1.sync_version(session)
+        await worker_2.sync_version(session)
+        worker_1.set("server", "stale")
+        worker_2.set("server", "stale")
+
+        await worker_1.bump(session)
+        await session.commit()
+        assert worker_1.get("server") is None
+
+        await worker_2.sync_version(session)
+        assert worker_2.get("server") is None
+        assert worker_2.version == 1
+
+        await worker_2.bump(session)
+        await session.commit()
+        await worker_1.sync_version(session)
+        assert worker_1.version == 2
+
+    asyncio.run(run())
+
+
+def test_version_check_interval(session):
+    cache = VersionedCache("client", ttl=60, check_interval=60)
+
+    async def run():
+        await cache.sync_version(session)
+        cache.set("client_1", 1)
+
+        # another worker bumps, but the version is not read again yet
+        other = VersionedCache("client", ttl=60)
+        await other.bump(session)
+        await session.commit()
+
+        await cache.sync_version(session)
+        assert cache.get("client_1") == 1
+
+    asyncio.run(run())
+
+
+def test_seed_versions(memory_engine):
+    cache = VersionedCache("seeded", ttl=60, check_interval=0)
+    seed_versions(memory_engine)
+    # seeded once, whichever the number of workers starting
+    seed_versions(memory_engine)
+
+    with Session(memory_engine) as session:
+        versions = dict(
+            session.exec(select(CacheVersion.name, CacheVersion.version)).all()
+        )
+        assert versions["seeded"] == 0
+        assert {"server", "client"} <= set(versions)
+
+        async def run():
+            threaded = ThreadedSession(session)
+            await cache.bump(threaded)
+            await threaded.commit()
+
+        asyncio.run(run())
+        assert session.get(CacheVersion, "seeded").version == 1
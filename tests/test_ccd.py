@@ -0,0 +1,222 @@
+import asyncio
+import importlib.resources
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime
+from unittest.mock import patch
+
+import pytest
+
+from sciaiot.ovpncp.data.network import RestrictedNetwork
+from sciaiot.ovpncp.data.server import Client, Server, VirtualAddress
+from sciaiot.ovpncp.dependencies import ThreadedSession
+from sciaiot.ovpncp.utils.ccd import (
+    ClientConfigIndex,
+    rebuild_ccd,
+    render_client_config,
+)
+
+
+@pytest.fixture(name="session")
+def session_fixture(session):
+    server = Server(
+        port="1194",
+        proto="udp",
+        dev="tun",
+        ca="ca.crt",
+        cert="server.crt",
+        key="server.key",
+        dh="dh.pem",
+        data_ciphers_fallback="AES-256-CBC",
+        topology="subnet",
+        network_address="10.8.0.0",
+        subnet_mask="255.255.255.0",
+        ip="10.8.0.1",
+        ifconfig_pool_persist="ipp.txt",
+        client_config_dir="/etc/openvpn/ccd",
+        keepalive="10 120",
+        status="openvpn-status.log",
+        log="openvpn.log",
+        verb="3",
+        explicit_exit_notify="1",
+    )
+    session.add(server)
+    session.flush()
+    session.add_all(
+        [
+            Client(
+                name="client_1",
+                virtual_address=VirtualAddress(ip="10.8.0.2", server_id=server.id),
+            ),
+            Client(
+                name="gateway_1",
+                cidr="192.168.1.0/24",
+                virtual_address=VirtualAddress(ip="10.8.0.3", server_id=server.id),
+            ),
+            Client(name="client_2"),
+            RestrictedNetwork(
+                source_name="client_1",
+                source_virtual_address="10.8.0.2",
+                destination_name="gateway_1",
+                destination_virtual_address="10.8.0.3",
+                private_network_addresses="192.168.1.1,192.168.1.2",
+                start_time=datetime.now(),
+            ),
+        ]
+    )
+    session.commit()
+    yield session
+
+
+def test_render_client_config():
+    client = Client(
+        name="gateway_1",
+        cidr="192.168.1.0/24",
+        virtual_address=VirtualAddress(ip="10.8.0.3"),
+    )
+    assert render_client_config(client, "255.255.255.0", []) == (
+        "ifconfig-push 10.8.0.3 255.255.255.0\niroute 192.168.1.0 255.255.255.0\n"
+    )
+    assert render_client_config(Client(name="client_2"), "255.255.255.0", []) == ""
+
+
+def test_load_and_refresh(session):
+    index = ClientConfigIndex()
+    asyncio.run(index.load(ThreadedSession(session)))
+
+    assert set(index.configs.entries) == {"client_1", "gateway_1"}
+    assert index.get("client_1") == (
+        "ifconfig-push 10.8.0.2 255.255.255.0\n"
+        'push "route 192.168.1.1 255.255.255.255 10.8.0.3"\n'
+        'push "route 192.168.1.2 255.255.255.255 10.8.0.3"\n'
+    )
+    assert index.get("client_2") == ""
+
+    # the network is dropped & the address unassigned
+    network = session.get(RestrictedNetwork, 1)
+    network.end_time = datetime.now()
+    session.add(network)
+    session.commit()
+    asyncio.run(index.refresh(ThreadedSession(session), "client_1"))
+    assert index.get("client_1") == "ifconfig-push 10.8.0.2 255.255.255.0\n"
+
+    client = session.get(Client, 1)
+    client.virtual_address = None
+    session.add(client)
+    session.commit()
+    asyncio.run(index.refresh(ThreadedSession(session), "client_1"))
+    assert index.get("client_1") == ""
+
+
+def test_invalidate_across_workers(session):
+    async def get_session():
+        yield ThreadedSession(session)
+
+    owner = ClientConfigIndex(sessions=asynccontextmanager(get_session))
+    writer = ClientConfigIndex(sessions=asynccontextmanager(get_session))
+    owner.configs.check_interval = 0
+
+    async def run():
+        await owner.load(ThreadedSession(session))
+        assert await owner.lookup("client_1") == owner.get("client_1") != ""
+
+        # the address unassigned on the worker of the request
+        client = session.get(Client, 1)
+        client.virtual_address = None
+        session.add(client)
+        await writer.invalidate(ThreadedSession(session))
+        session.commit()
+
+        return await owner.lookup("client_1")
+
+    assert asyncio.run(run()) == ""
+
+
+def test_rebuild_ccd(session, tmp_path):
+    ccd_dir = tmp_path / "ccd"
+    ccd_dir.mkdir()
+    # an outdated file & a temp file left over by a crash
+    (ccd_dir / "client_1").write_text("ifconfig-push 10.8.0.9 255.255.255.0\n")
+    (ccd_dir / ".client_2.tmp").write_text("")
+
+    with patch("sciaiot.ovpncp.utils.openvpn.openvpn_dir", str(tmp_path)):
+        result = asyncio.run(rebuild_ccd(ThreadedSession(session), chunk_size=1))
+
+    assert (result.written, result.unchanged, result.removed) == (2, 0, 1)
+    assert sorted(os.listdir(ccd_dir)) == ["client_1", "gateway_1"]
+    assert (ccd_dir / "client_1").read_text() == (
+        "# owner: ip\n"
+        "ifconfig-push 10.8.0.2 255.255.255.0\n"
+        "# owner: network:1\n"
+        'push "route 192.168.1.1 255.255.255.255 10.8.0.3"\n'
+        'push "route 192.168.1.2 255.255.255.255 10.8.0.3"\n'
+    )
+
+
+def test_serve_client_connect_hook(session, tmp_path):
+    async def get_session():
+        yield ThreadedSession(session)
+
+    socket_path = str(tmp_path / "ccd.sock")
+    index = ClientConfigIndex(asynccontextmanager(get_session), socket_path)
+    other_worker = ClientConfigIndex(asynccontextmanager(get_session), socket_path)
+
+    scripts = importlib.resources.files("sciaiot.ovpncp").joinpath("scripts")
+    hook = str(scripts.joinpath("client-connect.sh"))
+    env = dict(
+        os.environ,
+        CCD_MODE="dynamic",
+        CCD_SOCKET=socket_path,
+        SPOOL_FILE=str(tmp_path / "events.jsonl"),
+        untrusted_ip="1.2.3.4",
+        untrusted_port="1194",
+    )
+
+    async def connect(name: str):
+        config_path = tmp_path / f"{name}.conf"
+        process = await asyncio.create_subprocess_exec(
+            "bash",
+            hook,
+            str(config_path),
+            env=dict(env, common_name=name),
+            stderr=asyncio.subprocess.PIPE,
+        )
+        await process.communicate()
+        return process.returncode, config_path
+
+    async def served(worker: ClientConfigIndex):
+        while worker.server is None:
+            await asyncio.sleep(0.01)
+
+    async def run():
+        task = asyncio.create_task(index.run(0.01))
+        await asyncio.wait_for(served(index), 1)
+        # the socket is left to its owner
+        other_task = asyncio.create_task(other_worker.run(0.01))
+        await asyncio.sleep(0.05)
+        assert other_worker.server is None
+        try:
+            results = await connect("client_1"), await connect("client_2")
+        finally:
+            index.stop()
+            await task
+
+        # then taken over by the other worker
+        try:
+            await asyncio.wait_for(served(other_worker), 1)
+            return *results, await connect("client_1")
+        finally:
+            other_worker.stop()
+            await other_task
+
+    (code, config_path), (rejected_code, _), (taken_over_code, _) = asyncio.run(run())
+    assert code == 0
+    assert taken_over_code == 0
+    assert config_path.read_text() == (
+        "ifconfig-push 10.8.0.2 255.255.255.0\n"
+        'push "route 192.168.1.1 255.255.255.255 10.8.0.3"\n'
+        'push "route 192.168.1.2 255.255.255.255 10.8.0.3"\n'
+    )
+    assert rejected_code == 1
+    assert index.server is None
+    assert other_worker.server is None
@@ -0,0 +1,79 @@
+import json
+import logging
+
+import pytest
+from fastapi import APIRouter, FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+from sqlmodel import create_engine
+
+from sciaiot.ovpncp.middlewares.request_context import RequestContextMiddleware
+from sciaiot.ovpncp.utils import command
+from sciaiot.ovpncp.utils.context import install_record_factory, time_queries
+from sciaiot.ovpncp.utils.logging import JSONFormatter
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture(name="client")
+def client_fixture():
+    install_record_factory()
+    engine = create_engine("sqlite://")
+    time_queries(engine)
+
+    app = FastAPI()
+    app.add_middleware(RequestContextMiddleware)
+    router = APIRouter(prefix="/clients")
+
+    @router.post("/{client_name}/connections")
+    def start_connection(client_name: str):
+        logger.info(f"Starting connection of {client_name}...")
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+        command.run(["true"], check=True)
+        return {}
+
+    # the route template with the prefix of its router
+    app.include_router(router)
+    yield TestClient(app)
+    engine.dispose()
+
+
+def test_request_context(client: TestClient, caplog):
+    with caplog.at_level(logging.INFO):
+        response = client.post(
+            "/clients/device/connections", headers={"X-Request-ID": "hook-1"}
+        )
+    assert response.headers["X-Request-ID"] == "hook-1"
+
+    route_record, access_record = [
+        r for r in caplog.records if getattr(r, "request_id", None) == "hook-1"
+    ]
+    assert route_record.route == "/clients/{client_name}/connections"
+    assert route_record.client_name == "device"
+    assert route_record.latency_ms <= access_record.latency_ms
+
+    assert access_record.getMessage().startswith(
+        "POST /clients/device/connections 200 in "
+    )
+    assert access_record.status == 200
+    assert set(access_record.phases) == {"db", "subprocess"}
+
+    formatted = json.loads(JSONFormatter().format(access_record))
+    assert formatted["request_id"] == "hook-1"
+    assert formatted["client_name"] == "device"
+    assert formatted["method"] == "POST"
+    assert formatted["phases"] == access_record.phases
+
+
+def test_request_id_generated(client: TestClient, caplog):
+    with caplog.at_level(logging.INFO):
+        response = client.post(
+            "/clients/device/connections", headers={"X-Request-ID": "<script>"}
+        )
+    request_id = response.headers["X-Request-ID"]
+    assert len(request_id) == 32
+
+    # nothing stamped out of the requests
+    logger.info("Out of a request.")
+    assert not hasattr(caplog.records[-1], "request_id")
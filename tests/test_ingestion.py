@@ -0,0 +1,172 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+
+import pytest
+from sqlmodel import Session, select
+
+from sciaiot.ovpncp.data.server import Client, Connection, ConnectionEvent
+from sciaiot.ovpncp.dependencies import ThreadedSession
+from sciaiot.ovpncp.utils.cache import client_cache
+from sciaiot.ovpncp.utils.ingestion import ConnectionEventWriter, chunks
+
+
+@pytest.fixture(name="engine")
+def engine_fixture(memory_engine):
+    with Session(memory_engine) as session:
+        session.add_all(Client(name=f"device_{i}") for i in range(10))
+        session.commit()
+
+    client_cache.invalidate()
+    yield memory_engine
+    client_cache.invalidate()
+
+
+def make_writer(engine, sessions: list):
+    @asynccontextmanager
+    async def session_factory():
+        with Session(engine) as session:
+            sessions.append(session)
+            yield ThreadedSession(session)
+
+    return ConnectionEventWriter(session_factory, interval=0.01)
+
+
+def event(type: str, name: str, time: datetime, port: int = 1194):
+    return ConnectionEvent(
+        type=type, client_name=name, remote_address=f"1.2.3.4:{port}", time=time
+    )
+
+
+def test_chunks():
+    assert list(chunks([1, 2, 3, 4, 5], 2)) == [[1, 2], [3, 4], [5]]
+
+
+def test_coalesce_concurrent_requests(engine):
+    sessions: list = []
+    writer = make_writer(engine, sessions)
+    now = datetime.now()
+
+    async def run():
+        return await asyncio.gather(
+            *(writer.submit([event("connect", f"device_{i}", now)]) for i in range(10))
+        )
+
+    results = asyncio.run(run())
+    assert [result.accepted for result in results] == [1] * 10
+    # all requests of the window share one session & transaction
+    assert len(sessions) == 1
+
+    with Session(engine) as session:
+        assert len(session.exec(select(Connection)).all()) == 10
+
+
+def test_disconnect_closes_latest_open_connection(engine):
+    sessions: list = []
+    writer = make_writer(engine, sessions)
+    now = datetime.now()
+
+    async def run():
+        await writer.submit(
+            [
+                event("connect", "device_1", now - timedelta(hours=2)),
+                event("connect", "device_1", now - timedelta(hours=1)),
+            ]
+        )
+        return await writer.submit([event("disconnect", "device_1", now)])
+
+    result = asyncio.run(run())
+    assert result.accepted == 1
+    assert len(sessions) == 2
+
+    with Session(engine) as session:
+        statement = select(Connection).order_by(Connection.connected_time)
+        older, latest = session.exec(statement).all()
+        assert older.disconnected_time is None
+        assert latest.disconnected_time == now
+
+
+def test_replayed_connect_written_once(engine):
+    writer = make_writer(engine, [])
+    now = datetime.now()
+    connect = event("connect", "device_1", now - timedelta(hours=1))
+
+    async def run():
+        await writer.submit([connect, connect])
+        await writer.submit([event("disconnect", "device_1", now)])
+        # the spool read again from its checkpoint, after a crash
+        return await writer.submit([connect])
+
+    result = asyncio.run(run())
+    assert result.accepted == 1
+
+    with Session(engine) as session:
+        (connection,) = session.exec(select(Connection)).all()
+        assert connection.disconnected_time == now
+
+
+def test_aware_event_times(engine):
+    writer = make_writer(engine, [])
+    now = datetime.now().replace(microsecond=0)
+    with Session(engine) as session:
+        session.add(
+            Connection(
+                client_id=1,
+                remote_address="1.2.3.4:1194",
+                connected_time=now - timedelta(hours=2),
+            )
+        )
+        session.commit()
+
+    # with the offset of the hooks, compared with the naive times stored
+    aware = now.astimezone()
+
+    async def run():
+        return await writer.submit(
+            [
+                event("connect", "device_0", aware - timedelta(hours=1)),
+                event("disconnect", "device_0", aware),
+            ]
+        )
+
+    result = asyncio.run(run())
+    assert result.accepted == 2
+
+    with Session(engine) as session:
+        connections = session.exec(
+            select(Connection).order_by(Connection.connected_time)
+        ).all()
+        assert [c.disconnected_time for c in connections] == [None, now]
+        assert connections[1].connected_time == now - timedelta(hours=1)
+
+
+def test_reject_unknown_events(engine):
+    writer = make_writer(engine, [])
+    now = datetime.now()
+
+    async def run():
+        return await writer.submit(
+            [
+                event("connect", "unknown", now),
+                event("disconnect", "device_2", now),
+            ]
+        )
+
+    result = asyncio.run(run())
+    assert result.accepted == 0
+    assert [rejected.index for rejected in result.rejected] == [0, 1]
+
+
+def test_failed_write_propagates(engine):
+    @asynccontextmanager
+    async def session_factory():
+        raise RuntimeError("database is down")
+        yield
+
+    writer = ConnectionEventWriter(session_factory, interval=0)
+
+    async def run():
+        return await writer.submit([event("connect", "device_1", datetime.now())])
+
+    with pytest.raises(RuntimeError, match="database is down"):
+        asyncio.run(run())
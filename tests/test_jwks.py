@@ -0,0 +1,219 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest.mock import MagicMock, patch
+from urllib.error import URLError
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fastapi import HTTPException, Request
+from jose import jwk, jwt
+
+from sciaiot.ovpncp.middlewares import azure_security
+from sciaiot.ovpncp.utils.jwks import JwksCache, VerifiedTokenCache
+
+TENANT_ID = "mocked_tenant_id"
+APP_CLIENT_ID = "mocked_app_client_id"
+APP_ROLE = "mocked_app_role"
+
+
+def generate_key(kid: str):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+    public = jwk.construct(pem, "RS256").public_key().to_dict()
+    public.update({"kid": kid, "use": "sig"})
+    return pem, public
+
+
+class JwksServer:
+    """Local stand-in of the JWKS endpoint, counting the requests."""
+
+    def __init__(self):
+        self.keys = []
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests += 1
+                body = json.dumps({"keys": server.keys}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = HTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/keys"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture(name="server")
+def server_fixture():
+    server = JwksServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture(name="cache")
+def cache_fixture(server):
+    cache = JwksCache(ttl=3600, refetch_interval=60, timeout=5)
+    with (
+        patch.object(azure_security, "jwks_cache", cache),
+        patch.object(azure_security, "token_cache", VerifiedTokenCache(0)),
+        patch.object(azure_security, "JWKS_URL", server.url),
+        patch.object(azure_security, "TENANT_ID", TENANT_ID),
+        patch.object(azure_security, "APP_CLIENT_ID", APP_CLIENT_ID),
+        patch.object(azure_security, "APP_ROLE", APP_ROLE),
+    ):
+        yield cache
+
+
+def sign(pem: bytes, kid: str, **claims) -> str:
+    claims = {
+        "aud": APP_CLIENT_ID,
+        "iss": f"https://login.microsoftonline.com/{TENANT_ID}/v2.0",
+        "exp": int(time.time()) + 300,
+        "roles": [APP_ROLE],
+        "sub": "device",
+        **claims,
+    }
+    return jwt.encode(claims, pem, algorithm="RS256", headers={"kid": kid})
+
+
+def validate(request):
+    return asyncio.run(azure_security.validate_token(request))
+
+
+def request_with(token: str):
+    request = MagicMock(spec=Request)
+    request.headers.get.return_value = f"Bearer {token}"
+    return request
+
+
+def test_keys_fetched_once(server, cache):
+    pem, public = generate_key("key_1")
+    server.keys = [public]
+    token = sign(pem, "key_1")
+
+    for _ in range(10):
+        payload = validate(request_with(token))
+        assert payload["sub"] == "device"
+    assert server.requests == 1
+
+
+def test_refetch_on_rotated_key(server, cache):
+    pem_1, public_1 = generate_key("key_1")
+    pem_2, public_2 = generate_key("key_2")
+    server.keys = [public_1]
+    validate(request_with(sign(pem_1, "key_1")))
+
+    # rotated in after the last fetch, one refetch finds it
+    server.keys = [public_1, public_2]
+    cache.attempted_at -= cache.refetch_interval
+    assert validate(request_with(sign(pem_2, "key_2")))
+    assert server.requests == 2
+
+    # unknown kids refetch at most once per interval
+    for _ in range(5):
+        with pytest.raises(HTTPException) as exc:
+            validate(request_with(sign(pem_2, "key_3")))
+        assert exc.value.status_code == 401
+    assert server.requests == 2
+
+
+def test_stale_keys_refreshed_in_background(server, cache):
+    pem, public = generate_key("key_1")
+    server.keys = [public]
+    token = sign(pem, "key_1")
+    validate(request_with(token))
+
+    # past the TTL, served from the cache while refreshed
+    fetched_at = cache.fetched_at - cache.ttl - 1
+    cache.fetched_at = cache.attempted_at = fetched_at
+    assert validate(request_with(token))
+    for _ in range(100):
+        if cache.fetched_at > fetched_at and not cache.refreshing:
+            break
+        time.sleep(0.01)
+    assert server.requests == 2
+    assert cache.fetched_at > fetched_at
+
+
+def test_stale_keys_kept_on_failure(cache):
+    cache.use("http://127.0.0.1:1/keys")
+    cache.keys = {"key_1": MagicMock()}
+    cache.refresh_in_background()
+    for _ in range(100):
+        if not cache.refreshing:
+            break
+        time.sleep(0.01)
+    assert "key_1" in cache.keys
+
+
+def test_failed_fetches_throttled(server, cache):
+    pem, _ = generate_key("key_1")
+    token = sign(pem, "key_1")
+
+    # an empty set of keys is not fetched again within the interval
+    for _ in range(3):
+        with pytest.raises(HTTPException):
+            validate(request_with(token))
+    assert server.requests == 1
+
+    # neither is an unreachable endpoint
+    with (
+        patch.object(azure_security, "JWKS_URL", "http://127.0.0.1:1/keys"),
+        patch.object(cache, "fetch", wraps=cache.fetch) as fetch,
+    ):
+        with pytest.raises(URLError):
+            validate(request_with(token))
+        for _ in range(3):
+            with pytest.raises(HTTPException):
+                validate(request_with(token))
+        assert fetch.call_count == 1
+
+
+def test_verified_token_cache(server, cache):
+    pem, public = generate_key("key_1")
+    server.keys = [public]
+    token = sign(pem, "key_1")
+    tokens = VerifiedTokenCache(max_size=2)
+
+    with (
+        patch.object(azure_security, "token_cache", tokens),
+        patch.object(azure_security.jwt, "decode", wraps=jwt.decode) as decode,
+    ):
+        for _ in range(5):
+            assert validate(request_with(token))["sub"] == "device"
+        assert decode.call_count == 1
+    assert (tokens.hits, tokens.misses) == (4, 1)
+
+    # least recently used first out
+    tokens.set("token_2", {"exp": time.time() + 60})
+    tokens.set("token_3", {"exp": time.time() + 60})
+    assert tokens.get(token) is None
+    assert tokens.evictions == 1
+
+    # kept until the token expires only
+    tokens.set("token_4", {"exp": time.time() - 1})
+    assert tokens.get("token_4") is None
+    assert tokens.expirations == 1
+
+    # a payload without exp is never cached
+    tokens.set("token_5", {})
+    assert tokens.get("token_5") is None
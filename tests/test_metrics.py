@@ -0,0 +1,120 @@
+import subprocess
+from unittest.mock import patch
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+from sqlalchemy.pool import StaticPool
+from sqlmodel import Session, SQLModel, create_engine
+
+from sciaiot.ovpncp.dependencies import ThreadedSession, get_async_session
+from sciaiot.ovpncp.middlewares.request_context import RequestContextMiddleware
+from sciaiot.ovpncp.routes import metrics as metrics_route
+from sciaiot.ovpncp.utils import command, metrics
+from sciaiot.ovpncp.utils.cache import VersionedCache
+
+prometheus_client = pytest.importorskip("prometheus_client")
+
+
+def sample(name: str, **labels) -> float:
+    return prometheus_client.REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+@pytest.fixture(name="client")
+def client_fixture():
+    engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    SQLModel.metadata.create_all(engine)
+
+    async def get_session():
+        with Session(engine) as session:
+            yield ThreadedSession(session)
+
+    app = FastAPI()
+    app.add_middleware(RequestContextMiddleware)
+    app.include_router(metrics_route.router)
+    app.dependency_overrides[get_async_session] = get_session
+
+    @app.get("/clients/{client_name}")
+    async def get_client(client_name: str):
+        return {"name": client_name}
+
+    yield TestClient(app)
+    engine.dispose()
+
+
+def test_get_metrics(client: TestClient):
+    labels = {"method": "GET", "route": "/clients/{client_name}", "status": "200"}
+    before = sample("ovpncp_http_request_duration_seconds_count", **labels)
+    client.get("/clients/device")
+    client.get("/clients/other")
+    client.get("/unknown")
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "ovpncp_active_connections 0.0" in response.text
+    # by route template, not by path
+    assert sample("ovpncp_http_request_duration_seconds_count", **labels) == before + 2
+    assert 'route="/clients/device"' not in response.text
+    assert sample(
+        "ovpncp_http_request_duration_seconds_count",
+        method="GET",
+        route=metrics.UNMATCHED_ROUTE,
+        status="404",
+    )
+
+
+def test_query_metrics(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'metrics.db'}")
+    metrics.instrument_engine(engine, "test")
+    before = sample("ovpncp_db_query_duration_seconds_count", operation="SELECT")
+
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+        connection.execute(text("select 2"))
+        assert (
+            sample("ovpncp_db_pool_connections", pool="test", state="checked_out") == 1
+        )
+
+    assert (
+        sample("ovpncp_db_query_duration_seconds_count", operation="SELECT")
+        == before + 2
+    )
+    assert sample("ovpncp_db_pool_connections", pool="test", state="checked_out") == 0
+    assert sample("ovpncp_db_pool_connections", pool="test", state="idle") == 1
+    engine.dispose()
+
+
+def test_command_metrics():
+    before = sample("ovpncp_command_duration_seconds_count", tool="easyrsa")
+    failures = sample("ovpncp_command_failures_total", tool="easyrsa")
+
+    with patch("subprocess.run") as mock_run:
+        command.run(["./easyrsa", "--batch", "gen-crl"], check=True)
+        mock_run.side_effect = subprocess.CalledProcessError(1, "./easyrsa")
+        with pytest.raises(subprocess.CalledProcessError):
+            command.run(["./easyrsa", "--batch", "revoke", "device"], check=True)
+
+    assert sample("ovpncp_command_duration_seconds_count", tool="easyrsa") == before + 2
+    assert sample("ovpncp_command_failures_total", tool="easyrsa") == failures + 1
+
+
+def test_cache_metrics():
+    cache = VersionedCache("metrics")
+    cache.get("device")
+    cache.set("device", {})
+    cache.get("device")
+    cache.get("device")
+
+    assert sample("ovpncp_cache_requests_total", cache="metrics", result="miss") == 1
+    assert sample("ovpncp_cache_requests_total", cache="metrics", result="hit") == 2
+
+
+def test_metrics_disabled():
+    with patch.object(metrics, "prometheus_client", None):
+        assert not metrics.is_enabled()
+        assert metrics.gauge("disabled", "Disabled.", (), "livesum").set(1) is None
+        assert metrics.generate() == (b"", "text/plain; charset=utf-8")
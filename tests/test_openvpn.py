@@ -1,3 +1,7 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
 from unittest.mock import MagicMock, mock_open, patch
 
@@ -7,6 +11,7 @@ from sciaiot.ovpncp.utils.openvpn import (
     add_iroute,
     assign_client_ip,
     build_client,
+    ccd_lock,
     generate_crl,
     get_server_config,
     get_status,
@@ -14,7 +19,9 @@ from sciaiot.ovpncp.utils.openvpn import (
     package_client_cert,
     pull_client_routes,
     push_client_routes,
+    read_ccd,
     read_client_cert,
+    remove_ccd,
     remove_iroute,
     renew_client_cert,
     revoke_client,
@@ -213,49 +220,149 @@ def test_generate_crl(mock_run):
     )
 
 
-@patch("builtins.open", new_callable=mock_open)
-def test_assign_client_ip(mock_open):
+@pytest.fixture(name="ccd_dir")
+def ccd_dir_fixture(tmp_path):
+    (tmp_path / "ccd").mkdir()
+    with (
+        patch("sciaiot.ovpncp.utils.openvpn.openvpn_dir", str(tmp_path)),
+        patch("sciaiot.ovpncp.utils.openvpn.ccd_lock_dir", str(tmp_path / "locks")),
+    ):
+        yield tmp_path / "ccd"
+
+
+def test_assign_client_ip(ccd_dir):
     assign_client_ip("client_1", "10.8.0.2", "255.255.255.0")
-    mock_open.assert_called_with("/etc/openvpn/ccd/client_1", "w")
+    assert (ccd_dir / "client_1").read_text() == (
+        "# owner: ip\nifconfig-push 10.8.0.2 255.255.255.0\n"
+    )
 
+    # reassigning replaces the address only
+    push_client_routes("client_1", ["192.168.1.5 255.255.255.255 10.8.0.11"], 1)
+    assign_client_ip("client_1", "10.8.0.3", "255.255.255.0")
+    assert read_ccd("client_1") == {
+        "ip": ["ifconfig-push 10.8.0.3 255.255.255.0"],
+        "network:1": ['push "route 192.168.1.5 255.255.255.255 10.8.0.11"'],
+    }
+    assert os.listdir(ccd_dir) == ["client_1"]
 
-@patch("os.path.exists", return_value=True)
-@patch("os.remove")
-def test_unassign_client_ip(mock_remove, mock_exists):
+
+def test_unassign_client_ip(ccd_dir):
+    assign_client_ip("client_1", "10.8.0.2", "255.255.255.0")
     unassign_client_ip("client_1")
-    mock_remove.assert_called_with("/etc/openvpn/ccd/client_1")
+    assert not (ccd_dir / "client_1").exists()
+
+    unassign_client_ip("client_2")
+    assert not (ccd_dir / "client_2").exists()
 
 
-@patch("builtins.open", new_callable=mock_open)
-def test_add_iroute(mock_open):
+def test_add_iroute(ccd_dir):
+    assign_client_ip("gateway_1", "10.8.0.11", "255.255.255.0")
     add_iroute("gateway_1", "192.168.1.0 255.255.255.0")
-    mock_open.assert_called_with("/etc/openvpn/ccd/gateway_1", "a")
+    add_iroute("gateway_1", "192.168.1.0 255.255.255.0")
+    assert read_ccd("gateway_1") == {
+        "ip": ["ifconfig-push 10.8.0.11 255.255.255.0"],
+        "iroute": ["iroute 192.168.1.0 255.255.255.0"],
+    }
 
 
-@patch(
-    "builtins.open",
-    new_callable=mock_open,
-    read_data="ifconfig-push 10.8.0.2 255.255.255.0\niroute 192.168.1.0 255.255.255.0\n",
-)
-def test_remove_iroute(mock_open):
+def test_remove_iroute(ccd_dir):
+    # a file written by an older release, without owner tags
+    (ccd_dir / "gateway_1").write_text(
+        "ifconfig-push 10.8.0.2 255.255.255.0\niroute 192.168.1.0 255.255.255.0\n"
+    )
     remove_iroute("gateway_1", "192.168.1.0 255.255.255.0")
-    mock_open.assert_called_with("/etc/openvpn/ccd/gateway_1", "w")
+    assert read_ccd("gateway_1") == {"ip": ["ifconfig-push 10.8.0.2 255.255.255.0"]}
 
 
-@patch("builtins.open", new_callable=mock_open)
-def test_push_client_routes(mock_open):
-    push_client_routes("client_1", ["192.168.1.5 255.255.255.255 10.8.0.11"])
-    mock_open.assert_called_with("/etc/openvpn/ccd/client_1", "a")
+def test_push_client_routes(ccd_dir):
+    push_client_routes("client_1", ["192.168.1.5 255.255.255.255 10.8.0.11"], 1)
+    push_client_routes("client_1", ["192.168.2.5 255.255.255.255 10.8.0.12"], 2)
+    assert (ccd_dir / "client_1").read_text() == (
+        "# owner: network:1\n"
+        'push "route 192.168.1.5 255.255.255.255 10.8.0.11"\n'
+        "# owner: network:2\n"
+        'push "route 192.168.2.5 255.255.255.255 10.8.0.12"\n'
+    )
 
 
-@patch(
-    "builtins.open",
-    new_callable=mock_open,
-    read_data='ifconfig-push 10.8.0.2 255.255.255.0\npush "route 192.168.1.5 255.255.255.255 10.8.0.11"\n',
-)
-def test_pull_client_routes(mock_open):
-    pull_client_routes("client_1")
-    mock_open.assert_called_with("/etc/openvpn/ccd/client_1", "w")
+def test_pull_client_routes(ccd_dir):
+    assign_client_ip("client_1", "10.8.0.2", "255.255.255.0")
+    push_client_routes("client_1", ["192.168.1.5 255.255.255.255 10.8.0.11"], 1)
+    push_client_routes("client_1", ["192.168.2.5 255.255.255.255 10.8.0.12"], 2)
+
+    # only the routes of the dropped network are pulled
+    pull_client_routes("client_1", 1)
+    assert read_ccd("client_1") == {
+        "ip": ["ifconfig-push 10.8.0.2 255.255.255.0"],
+        "network:2": ['push "route 192.168.2.5 255.255.255.255 10.8.0.12"'],
+    }
+
+
+def test_pull_client_routes_legacy(ccd_dir):
+    (ccd_dir / "client_1").write_text(
+        "ifconfig-push 10.8.0.2 255.255.255.0\n"
+        'push "route 192.168.1.5 255.255.255.255 10.8.0.11"\n'
+        'push "route 192.168.2.5 255.255.255.255 10.8.0.12"\n'
+    )
+    pull_client_routes("client_1", 1, ["192.168.1.5 255.255.255.255 10.8.0.11"])
+    assert read_ccd("client_1") == {
+        "ip": ["ifconfig-push 10.8.0.2 255.255.255.0"],
+        "legacy": ['push "route 192.168.2.5 255.255.255.255 10.8.0.12"'],
+    }
+
+
+def test_concurrent_ccd_updates(ccd_dir):
+    assign_client_ip("client_1", "10.8.0.2", "255.255.255.0")
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for i in range(50):
+            executor.submit(
+                push_client_routes,
+                "client_1",
+                [f"192.168.{i}.1 255.255.255.255 10.8.0.3"],
+                i,
+            )
+
+    directives = read_ccd("client_1")
+    assert len(directives) == 51
+    assert os.listdir(ccd_dir) == ["client_1"]
+    # dropped once no update holds them
+    assert os.listdir(ccd_dir.parent / "locks") == []
+
+
+def test_ccd_updates_across_processes(ccd_dir):
+    assign_client_ip("client_1", "10.8.0.2", "255.255.255.0")
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=2, mp_context=context) as executor:
+        updates = [
+            executor.submit(
+                push_client_routes,
+                "client_1",
+                [f"192.168.{i}.1 255.255.255.255 10.8.0.3"],
+                i,
+            )
+            for i in range(20)
+        ]
+        for update in updates:
+            update.result()
+
+    # none lost by the other worker's update
+    assert len(read_ccd("client_1")) == 21
+    assert os.listdir(ccd_dir.parent / "locks") == []
+
+
+def test_remove_ccd_temp_file(ccd_dir):
+    temp_file = ccd_dir / ".client_1.tmp"
+    temp_file.write_text("")
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        with ccd_lock("client_1"):
+            # being written, only removed once left over
+            removed = executor.submit(remove_ccd, ".client_1.tmp")
+            time.sleep(0.05)
+            assert temp_file.exists()
+        removed.result()
+
+    assert not temp_file.exists()
+    assert os.listdir(ccd_dir.parent / "locks") == []
 
 
 connection_lines = """
@@ -278,4 +385,12 @@ END
 def test_list_connections(mock_open):
     connections = list_connections()
     assert len(connections) == 2
+    assert connections[0] == {
+        "name": "client_1",
+        "ip": "10.8.0.2",
+        "remote_address": "172.205.176.207:60374",
+        "connected_time": "2025-01-14 06:04:34",
+        "bytes_received": 3051,
+        "bytes_sent": 3093,
+    }
     mock_open.assert_called_with("/var/log/openvpn/openvpn-status.log", "r")
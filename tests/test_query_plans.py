@@ -0,0 +1,129 @@
+import json
+import os
+from unittest.mock import patch
+
+import pytest
+from sqlalchemy import inspect, text
+from sqlmodel import SQLModel, col, create_engine, select
+
+from sciaiot.ovpncp.data.network import RestrictedNetwork
+from sciaiot.ovpncp.data.server import Cert, Client, Connection, VirtualAddress
+from sciaiot.ovpncp.dependencies import create_indexes
+
+# the queries executed on every connection hook or detail view
+hot_queries = {
+    "close_connection": select(Connection)
+    .where(
+        Connection.remote_address == "172.205.176.207:60374",
+        Connection.client_id == 1,
+        Connection.disconnected_time == None,
+    )
+    .order_by(Connection.connected_time.desc()),  # type: ignore
+    "client_connections": select(Connection).where(Connection.client_id == 1),
+    "client_connection_history": select(Connection)
+    .where(Connection.client_id == 1, Connection.id < 100)
+    .order_by(col(Connection.id).desc())
+    .limit(20),
+    "client_by_name": select(Client).where(Client.name == "client_1"),
+    "client_cert": select(Cert).where(Cert.client_id == 1),
+    "networks_by_source": select(RestrictedNetwork).where(
+        RestrictedNetwork.source_name == "client_1"
+    ),
+    "server_addresses": select(VirtualAddress).where(VirtualAddress.server_id == 1),
+    "purge_connections": select(Connection.id)
+    .where(col(Connection.disconnected_time) < "2025-01-14")
+    .order_by(col(Connection.disconnected_time))
+    .limit(1000),
+}
+
+
+def compile_query(engine, statement):
+    return str(
+        statement.compile(
+            dialect=engine.dialect, compile_kwargs={"literal_binds": True}
+        )
+    )
+
+
+@pytest.fixture(scope="module")
+def sqlite_engine():
+    engine = create_engine("sqlite://")
+    SQLModel.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture(scope="module")
+def postgres_engine():
+    uri = os.getenv("POSTGRES_TEST_URI")
+    if not uri:
+        pytest.skip("POSTGRES_TEST_URI is not set.")
+
+    pytest.importorskip("psycopg2")
+    engine = create_engine(uri)
+    SQLModel.metadata.create_all(engine)
+    yield engine
+    SQLModel.metadata.drop_all(engine)
+    engine.dispose()
+
+
+@pytest.mark.parametrize("name", hot_queries.keys())
+def test_sqlite_query_plan(name, sqlite_engine):
+    query = compile_query(sqlite_engine, hot_queries[name])
+    with sqlite_engine.connect() as conn:
+        rows = conn.execute(text(f"EXPLAIN QUERY PLAN {query}")).all()
+
+    details = [row[-1] for row in rows]
+    assert details, f"No plan returned for {name}."
+    for detail in details:
+        # "SCAN <table>" without an index is a full table scan
+        assert not (detail.startswith("SCAN") and "INDEX" not in detail), (
+            f"{name} regressed to a full scan: {details}"
+        )
+        assert "TEMP B-TREE" not in detail, f"{name} sorts in memory: {details}"
+
+
+def test_sqlite_close_connection_uses_partial_index(sqlite_engine):
+    query = compile_query(sqlite_engine, hot_queries["close_connection"])
+    with sqlite_engine.connect() as conn:
+        rows = conn.execute(text(f"EXPLAIN QUERY PLAN {query}")).all()
+
+    assert any("ix_connection_open" in row[-1] for row in rows)
+
+
+def walk_plan(node):
+    yield node
+    for child in node.get("Plans", []):
+        yield from walk_plan(child)
+
+
+@pytest.mark.parametrize("name", hot_queries.keys())
+def test_postgres_query_plan(name, postgres_engine):
+    query = compile_query(postgres_engine, hot_queries[name])
+    with postgres_engine.connect() as conn:
+        # tables are empty, so discourage the planner from the cheap seq scan
+        conn.execute(text("SET enable_seqscan = off"))
+        plan = conn.execute(text(f"EXPLAIN (FORMAT JSON) {query}")).scalar_one()
+
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    node_types = [node["Node Type"] for node in walk_plan(plan[0]["Plan"])]
+    assert "Seq Scan" not in node_types, (
+        f"{name} regressed to a full scan: {node_types}"
+    )
+
+
+def test_create_indexes_on_existing_tables():
+    engine = create_engine("sqlite://")
+    SQLModel.metadata.create_all(engine)
+    # simulate a database created before the index was declared
+    with engine.begin() as conn:
+        conn.execute(text("DROP INDEX ix_cert_client_id"))
+
+    with patch("sciaiot.ovpncp.dependencies.engine", engine):
+        create_indexes()
+
+    indexes = {index["name"] for index in inspect(engine).get_indexes("cert")}
+    assert "ix_cert_client_id" in indexes
+    engine.dispose()
@@ -0,0 +1,140 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import UTC, datetime, timedelta
+from unittest.mock import patch
+
+import pytest
+from sqlmodel import Session, select
+
+from sciaiot.ovpncp.data.server import Client, Connection
+from sciaiot.ovpncp.dependencies import ThreadedSession
+from sciaiot.ovpncp.utils import reconcile
+from sciaiot.ovpncp.utils.cache import client_cache
+from sciaiot.ovpncp.utils.reconcile import (
+    STATUS_TIME_FORMAT,
+    ConnectionReconciler,
+    reconcile_connections,
+)
+
+now = datetime.now().replace(microsecond=0)
+hour_ago = now - timedelta(hours=1)
+
+
+@pytest.fixture(name="session")
+def session_fixture(session):
+    client_cache.invalidate()
+    session.add_all(Client(name=f"device_{i}") for i in range(4))
+    session.add_all(
+        [
+            # still connected
+            Connection(
+                client_id=1, remote_address="1.1.1.1:1", connected_time=hour_ago
+            ),
+            # lost disconnect, closed with its older duplicate
+            Connection(
+                client_id=2, remote_address="2.2.2.2:1", connected_time=hour_ago
+            ),
+            Connection(
+                client_id=2,
+                remote_address="2.2.2.2:1",
+                connected_time=hour_ago - timedelta(hours=1),
+            ),
+            # opened a moment ago, the status file may not show it yet
+            Connection(client_id=3, remote_address="3.3.3.3:1", connected_time=now),
+        ]
+    )
+    session.commit()
+    yield session
+
+    client_cache.invalidate()
+
+
+def live(name: str, remote_address: str, connected_time: datetime):
+    return {
+        "name": name,
+        "ip": "10.8.0.2",
+        "remote_address": remote_address,
+        "connected_time": connected_time.strftime(STATUS_TIME_FORMAT),
+    }
+
+
+def open_connections(session: Session):
+    statement = select(Connection.client_id, Connection.remote_address).where(
+        Connection.disconnected_time == None
+    )
+    return sorted(session.exec(statement).all())
+
+
+@patch("sciaiot.ovpncp.utils.openvpn.list_connections")
+def test_reconcile_connections(mock_list_connections, session):
+    mock_list_connections.return_value = [
+        live("device_0", "1.1.1.1:1", hour_ago),
+        # lost connect
+        live("device_3", "4.4.4.4:1", hour_ago),
+        # connected a moment ago, the hook may be in flight
+        live("device_3", "5.5.5.5:1", now),
+        live("unknown", "6.6.6.6:1", hour_ago),
+    ]
+
+    result = asyncio.run(reconcile_connections(ThreadedSession(session)))
+    assert result.closed == 2
+    assert result.opened == 1
+    assert result.unknown_clients == ["unknown"]
+
+    session.expire_all()
+    assert open_connections(session) == [
+        (1, "1.1.1.1:1"),
+        (3, "3.3.3.3:1"),
+        (4, "4.4.4.4:1"),
+    ]
+
+    # nothing left to fix
+    result = asyncio.run(reconcile_connections(ThreadedSession(session)))
+    assert (result.closed, result.opened) == (0, 0)
+
+
+@patch("sciaiot.ovpncp.utils.openvpn.list_connections")
+def test_reconcile_aware_connection_times(mock_list_connections, session):
+    mock_list_connections.return_value = []
+    connection = session.get(Connection, 4)
+    connection.connected_time = datetime.now(UTC) - timedelta(hours=1)
+    session.add(connection)
+    session.commit()
+
+    result = asyncio.run(reconcile_connections(ThreadedSession(session)))
+    assert result.closed == 4
+    session.expire_all()
+    assert open_connections(session) == []
+
+
+def test_one_reconciler(tmp_path):
+    rounds = []
+
+    @asynccontextmanager
+    async def session_factory():
+        yield None
+
+    async def count_round(session):
+        rounds.append(asyncio.current_task())
+
+    reconcilers = [
+        ConnectionReconciler(
+            session_factory, interval=0.01, lock_file=str(tmp_path / "lock")
+        )
+        for _ in range(2)
+    ]
+
+    async def run():
+        tasks = [asyncio.create_task(r.run()) for r in reconcilers]
+        await asyncio.sleep(0.05)
+        assert set(rounds) == {tasks[0]}
+        # the owner stops, the other worker takes the reconciliation over
+        reconcilers[0].stop()
+        await asyncio.wait_for(tasks[0], 1)
+        await asyncio.sleep(0.05)
+        reconcilers[1].stop()
+        await asyncio.wait_for(tasks[1], 1)
+        assert tasks[1] in rounds
+
+    with patch.object(reconcile, "reconcile_connections", count_round):
+        asyncio.run(run())
@@ -0,0 +1,120 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta
+from unittest.mock import patch
+
+import pytest
+from sqlmodel import create_engine, select
+
+from sciaiot.ovpncp.data.server import Client, Connection, ConnectionRollup
+from sciaiot.ovpncp.dependencies import ThreadedSession
+from sciaiot.ovpncp.utils import retention
+
+day = datetime(2025, 1, 14, 6)
+
+
+@pytest.fixture(name="session")
+def session_fixture(session):
+    session.add_all(Client(name=f"device_{i}") for i in range(2))
+    session.add_all(
+        Connection(
+            client_id=1 + i % 2,
+            remote_address=f"1.1.1.{i}:1",
+            connected_time=day + timedelta(hours=i),
+            disconnected_time=day + timedelta(hours=i, minutes=10),
+        )
+        for i in range(5)
+    )
+    session.add_all(
+        [
+            # still open
+            Connection(client_id=1, remote_address="2.2.2.2:1", connected_time=day),
+            # closed after the cutoff
+            Connection(
+                client_id=2,
+                remote_address="3.3.3.3:1",
+                connected_time=day,
+                disconnected_time=day + timedelta(days=2),
+            ),
+            # rolled up by an earlier purge
+            ConnectionRollup(client_id=1, day=day.date(), sessions=1, seconds=60.0),
+        ]
+    )
+    session.commit()
+    yield session
+
+
+def test_purge_connections(session):
+    cutoff = day + timedelta(days=1)
+    result = asyncio.run(
+        retention.purge_connections(
+            ThreadedSession(session), cutoff, batch_size=2, pause=0
+        )
+    )
+    assert result.deleted == 5
+    # device_0 once per batch, device_1 in two of them
+    assert result.rolled_up == 5
+
+    remaining = session.exec(select(Connection.remote_address)).all()
+    assert sorted(remaining) == ["2.2.2.2:1", "3.3.3.3:1"]
+
+    rollups = session.exec(
+        select(ConnectionRollup).order_by(ConnectionRollup.client_id)
+    ).all()
+    assert [(r.client_id, r.day, r.sessions, r.seconds) for r in rollups] == [
+        (1, date(2025, 1, 14), 4, 60.0 + 3 * 600),
+        (2, date(2025, 1, 14), 2, 2 * 600),
+    ]
+
+    # nothing left to purge
+    result = asyncio.run(
+        retention.purge_connections(ThreadedSession(session), cutoff, pause=0)
+    )
+    assert result.deleted == 0
+
+
+def test_partition_months():
+    assert retention.partition_name(date(2025, 1, 14)) == "connection_p202501"
+    assert retention.next_month(date(2025, 1, 31)) == date(2025, 2, 1)
+    assert retention.next_month(date(2025, 12, 1)) == date(2026, 1, 1)
+
+
+def test_maintain_partitions_without_postgres():
+    engine = create_engine("sqlite://")
+    assert retention.maintain_partitions(engine, day) == []
+    with pytest.raises(ValueError):
+        retention.partition_connections(engine)
+    engine.dispose()
+
+
+def test_one_retention_worker(tmp_path):
+    purges = []
+
+    @asynccontextmanager
+    async def session_factory():
+        yield None
+
+    async def apply_retention(session, days):
+        purges.append(asyncio.current_task())
+
+    workers = [
+        retention.RetentionWorker(
+            session_factory, days=1, interval=0.01, lock_file=str(tmp_path / "lock")
+        )
+        for _ in range(2)
+    ]
+
+    async def run():
+        tasks = [asyncio.create_task(worker.run()) for worker in workers]
+        await asyncio.sleep(0.05)
+        assert set(purges) == {tasks[0]}
+        # the owner stops, the other worker takes the retention over
+        workers[0].stop()
+        await asyncio.wait_for(tasks[0], 1)
+        await asyncio.sleep(0.05)
+        workers[1].stop()
+        await asyncio.wait_for(tasks[1], 1)
+        assert tasks[1] in purges
+
+    with patch.object(retention, "apply_retention", apply_retention):
+        asyncio.run(run())
@@ -1,18 +1,31 @@
-import json
 from unittest.mock import MagicMock, patch
 
 import pytest
-from fastapi import HTTPException, Request
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.testclient import TestClient
 
-from sciaiot.ovpncp.main import app
+from sciaiot.ovpncp.middlewares import azure_security
 from sciaiot.ovpncp.middlewares.azure_security import (
-    azure_security_middleware,
+    AzureSecurityMiddleware,
     check_role,
     get_token,
 )
 
-client = TestClient(app)
+
+@pytest.fixture(name="client")
+def client_fixture():
+    app = FastAPI()
+    app.add_middleware(AzureSecurityMiddleware, paths=("/secured",))
+
+    @app.get("/secured")
+    async def secured(request: Request):
+        return request.state.token_payload
+
+    @app.get("/public")
+    async def public():
+        return {}
+
+    return TestClient(app)
 
 
 @patch("sciaiot.ovpncp.middlewares.azure_security.TENANT_ID", "mocked_tenant_id")
@@ -24,11 +37,10 @@ client = TestClient(app)
     "sciaiot.ovpncp.middlewares.azure_security.validate_token",
     return_value={"sub": "mocked_sub"},
 )
-def test_azure_security_middleware_success(mock_validate_token):
-    # Success case should still work
-    response = client.get("/")
-    # Middleware passes, FastAPI returns 404 because "/" doesn't exist
-    assert response.status_code == 404
+def test_azure_security_middleware_success(mock_validate_token, client: TestClient):
+    response = client.get("/secured")
+    assert response.status_code == 200
+    assert response.json() == {"sub": "mocked_sub"}
     mock_validate_token.assert_called_once()
 
 
@@ -41,54 +53,62 @@ def test_azure_security_middleware_success(mock_validate_token):
     "sciaiot.ovpncp.middlewares.azure_security.validate_token",
     side_effect=HTTPException(status_code=401, detail="Mocked Exception"),
 )
-def test_azure_security_middleware_failure(mock_validate_token):
-    response = client.get("/")
+def test_azure_security_middleware_failure(mock_validate_token, client: TestClient):
+    response = client.get("/secured")
     assert response.status_code == 401
     assert response.json() == {"detail": "Mocked Exception"}
 
 
-@patch("sciaiot.ovpncp.middlewares.azure_security.TENANT_ID", "mocked_tenant_id")
-@patch(
-    "sciaiot.ovpncp.middlewares.azure_security.APP_CLIENT_ID", "mocked_app_client_id"
-)
-@patch("sciaiot.ovpncp.middlewares.azure_security.APP_ROLE", "mocked_app_role")
 @patch("sciaiot.ovpncp.middlewares.azure_security.validate_token")
 def test_azure_security_middleware_localhost_no_bypass(mock_validate_token):
     # Verify that localhost is NO LONGER bypassed
-    request = MagicMock(spec=Request)
-    request.url = MagicMock()
-    request.url.__str__.return_value = "http://localhost:8000/"
-
-    async def call_next(req):
-        return MagicMock()
-
-    import asyncio
-
-    asyncio.run(azure_security_middleware(request, call_next))
+    app = FastAPI()
+    app.add_middleware(AzureSecurityMiddleware)
+    client = TestClient(app, base_url="http://localhost:8000")
+    client.get("/")
 
     # validate_token MUST be called now
     mock_validate_token.assert_called_once()
 
 
+@patch("sciaiot.ovpncp.middlewares.azure_security.validate_token")
+def test_azure_security_middleware_unsecured_path(
+    mock_validate_token, client: TestClient
+):
+    response = client.get("/public")
+    assert response.status_code == 200
+    mock_validate_token.assert_not_called()
+
+
 @patch("sciaiot.ovpncp.middlewares.azure_security.TENANT_ID", None)
-def test_azure_security_middleware_missing_env_error():
+@patch("sciaiot.ovpncp.middlewares.azure_security.APP_CLIENT_ID", None)
+@patch("sciaiot.ovpncp.middlewares.azure_security.APP_ROLE", None)
+def test_azure_security_middleware_missing_env_error(client: TestClient):
     # Verify that missing env vars now results in 500 error
-    request = MagicMock(spec=Request)
-    request.url = MagicMock()
-    request.url.__str__.return_value = "http://example.com/"
+    assert azure_security.is_enabled()
+    response = client.get("/secured")
 
-    async def call_next(req):
-        return MagicMock()
+    assert response.status_code == 500
+    assert "Authentication service is misconfigured" in response.json()["detail"]
 
-    import asyncio
 
-    response = asyncio.run(azure_security_middleware(request, call_next))
+@patch("sciaiot.ovpncp.middlewares.azure_security.TENANT_ID", None)
+@patch(
+    "sciaiot.ovpncp.middlewares.azure_security.APP_CLIENT_ID", "mocked_app_client_id"
+)
+@patch("sciaiot.ovpncp.middlewares.azure_security.APP_ROLE", "mocked_app_role")
+def test_azure_security_middleware_partly_missing_env_error(client: TestClient):
+    # Verify that a partly configured security still results in 500 error
+    response = client.get("/secured")
 
     assert response.status_code == 500
-    assert (
-        "Authentication service is misconfigured"
-        in json.loads(response.body.decode())["detail"]
-    )
+    assert "Authentication service is misconfigured" in response.json()["detail"]
+
+
+@patch("sciaiot.ovpncp.middlewares.azure_security.DISABLED", True)
+def test_azure_security_disabled():
+    assert not azure_security.is_enabled()
+    assert not azure_security.is_secured("/secured")
 
 
 def test_get_token_valid():
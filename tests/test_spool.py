@@ -0,0 +1,217 @@
+import asyncio
+import json
+import os
+import time
+
+import pytest
+
+from sciaiot.ovpncp.data.server import ConnectionEventsResult, RejectedConnectionEvent
+from sciaiot.ovpncp.utils.spool import SpoolReader
+
+
+class FakeWriter:
+    def __init__(self):
+        self.batches = []
+        self.failing = False
+
+    async def submit(self, events):
+        if self.failing:
+            raise RuntimeError("database is locked")
+        if any(event.client_name == "poison" for event in events):
+            raise TypeError("can't compare offset-naive and offset-aware datetimes")
+
+        self.batches.append(events)
+        rejected = [
+            RejectedConnectionEvent(index=i, detail="not found")
+            for i, event in enumerate(events)
+            if event.client_name == "unknown"
+        ]
+        return ConnectionEventsResult(
+            accepted=len(events) - len(rejected), rejected=rejected
+        )
+
+
+def line(name: str, type: str = "connect") -> str:
+    event = {
+        "type": type,
+        "client_name": name,
+        "remote_address": "1.2.3.4:1194",
+        "time": "2025-01-14T06:04:34+0000",
+    }
+    return json.dumps(event) + "\n"
+
+
+def append(path, text: str):
+    with open(path, "a") as f:
+        f.write(text)
+
+
+def names(batch) -> list[str]:
+    return [event.client_name for event in batch]
+
+
+@pytest.fixture(name="spool")
+def spool_fixture(tmp_path):
+    return tmp_path / "events.jsonl"
+
+
+def test_missing_spool(spool):
+    reader = SpoolReader(str(spool), FakeWriter())
+    assert asyncio.run(reader.poll()) == 0
+
+
+def test_ingest_complete_lines(spool):
+    writer = FakeWriter()
+    reader = SpoolReader(str(spool), writer)
+
+    # the last line is still being written by a hook
+    append(spool, line("device_1") + line("device_2") + line("device_3")[:20])
+    assert asyncio.run(reader.poll()) == 2
+    assert names(writer.batches[0]) == ["device_1", "device_2"]
+
+    append(spool, line("device_3")[20:])
+    assert asyncio.run(reader.poll()) == 1
+    assert names(writer.batches[1]) == ["device_3"]
+    assert asyncio.run(reader.poll()) == 0
+    assert len(writer.batches) == 2
+
+
+def test_resume_from_checkpoint(spool):
+    writer = FakeWriter()
+    append(spool, line("device_1"))
+    asyncio.run(SpoolReader(str(spool), writer).poll())
+
+    append(spool, line("device_2"))
+    asyncio.run(SpoolReader(str(spool), writer).poll())
+    assert [names(batch) for batch in writer.batches] == [["device_1"], ["device_2"]]
+
+
+def test_failed_batch_is_read_again(spool):
+    writer = FakeWriter()
+    reader = SpoolReader(str(spool), writer)
+    append(spool, line("device_1"))
+
+    writer.failing = True
+    with pytest.raises(RuntimeError):
+        asyncio.run(reader.poll())
+
+    writer.failing = False
+    assert asyncio.run(SpoolReader(str(spool), writer).poll()) == 1
+    assert names(writer.batches[0]) == ["device_1"]
+
+
+def test_quarantine_failing_batch(spool):
+    writer = FakeWriter()
+    reader = SpoolReader(str(spool), writer, max_attempts=2)
+    append(spool, line("device_1") + line("poison") + line("device_2"))
+
+    with pytest.raises(TypeError):
+        asyncio.run(reader.poll())
+    # retried up to the attempts, then event by event past the failing one
+    assert asyncio.run(reader.poll()) == 3
+    assert [names(batch) for batch in writer.batches] == [["device_1"], ["device_2"]]
+    assert reader.failures == 0
+
+    quarantined = (spool.parent / "events.jsonl.failed").read_text().splitlines()
+    assert [json.loads(event)["client_name"] for event in quarantined] == ["poison"]
+    assert asyncio.run(reader.poll()) == 0
+
+
+def test_skip_malformed_and_rejected_lines(spool):
+    writer = FakeWriter()
+    reader = SpoolReader(str(spool), writer)
+    append(spool, "not json\n\n" + line("unknown") + line("device_1"))
+
+    assert asyncio.run(reader.poll()) == 2
+    assert asyncio.run(reader.poll()) == 0
+    assert names(writer.batches[0]) == ["unknown", "device_1"]
+
+
+def test_max_batch(spool):
+    writer = FakeWriter()
+    reader = SpoolReader(str(spool), writer, max_batch=2)
+    append(spool, "".join(line(f"device_{i}") for i in range(5)))
+
+    while asyncio.run(reader.poll()):
+        pass
+    assert [len(batch) for batch in writer.batches] == [2, 2, 1]
+
+
+def test_rotate_consumed_spool(spool):
+    writer = FakeWriter()
+    reader = SpoolReader(str(spool), writer, rotate_size=1, rotate_grace=60)
+    append(spool, line("device_1"))
+
+    asyncio.run(reader.poll())
+    rotated = spool.with_name("events.jsonl.1")
+    assert rotated.exists()
+    assert not spool.exists()
+
+    # a hook that opened the file before the rotation, then a new one
+    append(rotated, line("device_2"))
+    append(spool, line("device_3"))
+    asyncio.run(reader.poll())
+    assert names(writer.batches[1]) == ["device_2"]
+
+    # the rotated segment is kept until it has been quiet for the grace period
+    asyncio.run(reader.poll())
+    assert rotated.exists()
+    past = time.time() - 120
+    os.utime(rotated, (past, past))
+    asyncio.run(reader.poll())
+    assert not rotated.exists()
+
+    asyncio.run(reader.poll())
+    assert names(writer.batches[2]) == ["device_3"]
+
+
+def test_truncated_spool(spool):
+    writer = FakeWriter()
+    reader = SpoolReader(str(spool), writer)
+    append(spool, line("device_1") + line("device_2"))
+    asyncio.run(reader.poll())
+
+    spool.write_text(line("device_3"))
+    asyncio.run(reader.poll())
+    assert names(writer.batches[1]) == ["device_3"]
+
+
+def test_run_until_stopped(spool):
+    writer = FakeWriter()
+    reader = SpoolReader(str(spool), writer)
+    append(spool, line("device_1"))
+
+    async def run():
+        task = asyncio.create_task(reader.run(interval=0.01))
+        await asyncio.sleep(0.05)
+        append(spool, line("device_2"))
+        await asyncio.sleep(0.05)
+        reader.stop()
+        await asyncio.wait_for(task, 1)
+
+    asyncio.run(run())
+    assert [names(batch) for batch in writer.batches] == [["device_1"], ["device_2"]]
+
+
+def test_one_reader_per_spool(spool):
+    writers = [FakeWriter(), FakeWriter()]
+    readers = [SpoolReader(str(spool), writer) for writer in writers]
+    append(spool, line("device_1"))
+
+    async def run():
+        tasks = [
+            asyncio.create_task(reader.run(interval=0.01, owner_retry_interval=0.01))
+            for reader in readers
+        ]
+        await asyncio.sleep(0.05)
+        # the owner stops, the other worker takes the spool over
+        readers[0].stop()
+        await asyncio.wait_for(tasks[0], 1)
+        append(spool, line("device_2"))
+        await asyncio.sleep(0.05)
+        readers[1].stop()
+        await asyncio.wait_for(tasks[1], 1)
+
+    asyncio.run(run())
+    assert [names(batch) for batch in writers[0].batches] == [["device_1"]]
+    assert [names(batch) for batch in writers[1].batches] == [["device_2"]]
@@ -0,0 +1,106 @@
+import asyncio
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+import pytest
+
+from sciaiot.ovpncp.data.server import Client, Connection
+from sciaiot.ovpncp.dependencies import ThreadedSession
+from sciaiot.ovpncp.utils import stats
+
+start = datetime(2025, 1, 14, 6)
+
+
+def at(minutes: int) -> datetime:
+    return start + timedelta(minutes=minutes)
+
+
+@pytest.fixture(name="session")
+def session_fixture(session):
+    session.add_all(Client(name=f"device_{i}") for i in range(3))
+    session.add_all(
+        [
+            # before the range
+            Connection(
+                client_id=1,
+                remote_address="1.1.1.1:1",
+                connected_time=at(-60),
+                disconnected_time=at(-30),
+            ),
+            # across the start of the range
+            Connection(
+                client_id=1,
+                remote_address="1.1.1.1:2",
+                connected_time=at(-10),
+                disconnected_time=at(20),
+            ),
+            # back to back, never overlapping
+            Connection(
+                client_id=2,
+                remote_address="2.2.2.2:1",
+                connected_time=at(10),
+                disconnected_time=at(30),
+            ),
+            Connection(
+                client_id=2,
+                remote_address="2.2.2.2:2",
+                connected_time=at(30),
+                disconnected_time=at(40),
+            ),
+            # still open
+            Connection(client_id=3, remote_address="3.3.3.3:1", connected_time=at(50)),
+        ]
+    )
+    session.commit()
+    yield session
+
+
+@pytest.fixture(params=["numpy", "python"])
+def sweep_mode(request):
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+        yield
+    else:
+        with patch.object(stats, "np", None):
+            yield
+
+
+def test_sweep(sweep_mode):
+    starts = [0, 5, 10, 25]
+    ends = [10, 15, 20, 30]
+    # the session ending at 10 is gone when the one at 10 starts
+    assert stats.sweep(starts, ends, [0, 10, 20, 30]) == [2, 2, 1]
+    assert stats.sweep([], [], [0, 10]) == [0]
+
+
+def test_duration_percentiles(sweep_mode):
+    assert stats.duration_percentiles([]) == {}
+    durations = stats.duration_percentiles(list(range(101)))
+    assert durations == {"p50": 50.0, "p95": 95.0, "p99": 99.0}
+    assert stats.duration_percentiles([10, 20])["p50"] == 15.0
+
+
+def test_connection_stats(sweep_mode, session):
+    result = asyncio.run(
+        stats.connection_stats(ThreadedSession(session), at(0), at(60), 900, 2)
+    )
+    assert result.active == 1
+    assert result.sessions == 4
+    assert [(c.client_name, c.sessions) for c in result.clients] == [
+        ("device_1", 2),
+        ("device_0", 1),
+    ]
+    assert result.durations["p50"] == 1200.0
+    assert [(p.time, p.connections) for p in result.concurrency] == [
+        (at(0), 2),
+        (at(15), 2),
+        (at(30), 1),
+        (at(45), 1),
+    ]
+    assert result.peak == 2
+
+
+def test_bucket_edges():
+    assert stats.bucket_edges(0, 25, 10) == [0, 10, 20, 25]
+    with patch.object(stats, "STATS_MAX_BUCKETS", 2):
+        assert stats.bucket_edges(0, 25, 10) == [0, 13, 25]
@@ -0,0 +1,219 @@
+import asyncio
+from contextlib import asynccontextmanager
+from unittest.mock import MagicMock, patch
+
+import pytest
+from azure.core.exceptions import ResourceNotFoundError
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import FileResponse
+from fastapi.testclient import TestClient
+
+from sciaiot.ovpncp.dependencies import ThreadedSession
+from sciaiot.ovpncp.main import add_middlewares
+from sciaiot.ovpncp.middlewares import azure_security, storage
+from sciaiot.ovpncp.middlewares.storage import StorageMiddleware
+from sciaiot.ovpncp.utils.cache import VersionedCache
+from sciaiot.ovpncp.utils.storage import AzureBlobStorage, LocalStorage, file_digest
+
+
+@pytest.fixture(name="archive")
+def archive_fixture(tmp_path):
+    archive = tmp_path / "device.zip"
+    archive.write_bytes(b"certs")
+    return archive
+
+
+@pytest.fixture(name="backend")
+def backend_fixture(tmp_path):
+    return LocalStorage(str(tmp_path / "storage"), "https://certs.example.com/")
+
+
+@pytest.fixture(name="downloads")
+def downloads_fixture():
+    # no wait between the version checks
+    downloads = VersionedCache("download_url", ttl=840, check_interval=0)
+    with patch.object(storage, "download_urls", downloads):
+        yield downloads
+
+
+@pytest.fixture(name="client")
+def client_fixture(archive, backend, session, downloads):
+    async def get_session():
+        app.state.sessions += 1
+        yield ThreadedSession(session)
+
+    app = FastAPI()
+    app.add_middleware(
+        StorageMiddleware,
+        backend=backend,
+        sessions=asynccontextmanager(get_session),
+    )
+    app.state.downloads = 0
+    app.state.sessions = 0
+
+    def find_client(client_name: str):
+        if client_name != "device":
+            raise HTTPException(404, "Client not found!")
+
+    @app.put("/clients/{client_name}/package-cert")
+    async def package_cert(client_name: str):
+        find_client(client_name)
+        return {"file_path": str(archive)}
+
+    @app.get("/clients/{client_name}/download-cert")
+    async def download_cert(client_name: str):
+        app.state.downloads += 1
+        find_client(client_name)
+        return FileResponse(archive)
+
+    @app.get("/clients/{client_name}/connections")
+    async def connections(client_name: str):
+        return []
+
+    return TestClient(app)
+
+
+class BlobStandIn:
+    """Blob of the Azure SDK, kept in memory with its metadata."""
+
+    def __init__(self, name: str, blobs: dict):
+        self.name = name
+        self.blobs = blobs
+        self.url = f"https://account.blob.core.windows.net/ovpncp/{name}"
+
+    def get_blob_properties(self):
+        if self.name not in self.blobs:
+            raise ResourceNotFoundError("The specified blob does not exist.")
+        return MagicMock(metadata=self.blobs[self.name][1])
+
+    def upload_blob(self, data, length, overwrite, metadata, max_concurrency):
+        self.blobs[self.name] = (data.read(), metadata)
+
+
+def test_local_upload_deduplicated(archive, backend):
+    location, uploaded = asyncio.run(backend.upload("device.zip", str(archive)))
+    assert uploaded
+    with open(location, "rb") as f:
+        assert f.read() == b"certs"
+    assert backend.stored_digest("device.zip") == file_digest(str(archive))
+
+    # identical bundle, not uploaded again
+    assert asyncio.run(backend.upload("device.zip", str(archive))) == (location, False)
+
+    # re-packaged with other certs
+    archive.write_bytes(b"renewed certs")
+    assert asyncio.run(backend.upload("device.zip", str(archive))) == (location, True)
+    with open(location, "rb") as f:
+        assert f.read() == b"renewed certs"
+
+
+def test_local_download_url(tmp_path, backend):
+    assert backend.sign("device 1.zip") == "https://certs.example.com/device%201.zip"
+    assert LocalStorage(str(tmp_path)).sign("device.zip") == str(
+        tmp_path / "device.zip"
+    )
+
+
+def test_azure_upload_deduplicated(archive):
+    backend = AzureBlobStorage(
+        "DefaultEndpointsProtocol=https;AccountName=account;AccountKey=a2V5"
+    )
+    blobs = {}
+    blob = BlobStandIn("device.zip", blobs)
+    with patch.object(backend, "container_client") as container_client:
+        container_client.get_blob_client.return_value = blob
+        with patch.object(blob, "upload_blob", wraps=blob.upload_blob) as upload:
+            for _ in range(3):
+                location, _ = asyncio.run(backend.upload("device.zip", str(archive)))
+            assert upload.call_count == 1
+
+    assert location == blob.url
+    assert blobs["device.zip"] == (b"certs", {"sha256": file_digest(str(archive))})
+
+
+def test_upload_packaged_cert(client: TestClient, backend):
+    response = client.put("/clients/device/package-cert")
+    assert response.status_code == 200
+    assert response.json() == {"file_path": backend.location("device.zip")}
+
+
+def test_route_errors_passed_on(client: TestClient, backend):
+    response = client.put("/clients/unknown/package-cert")
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Client not found!"}
+    assert backend.stored_digest("unknown.zip") is None
+
+
+def test_download_signed_url(client: TestClient):
+    response = client.get("/clients/device/download-cert")
+    assert response.status_code == 200
+    assert response.json() == {"url": "https://certs.example.com/device.zip"}
+
+
+def test_other_routes_untouched(client: TestClient):
+    assert client.get("/clients/device/connections").json() == []
+    assert client.put("/clients/device/download-cert").status_code == 405
+
+
+def test_download_url_cached(client: TestClient, archive, backend, session, downloads):
+    app = client.app
+    client.put("/clients/device/package-cert")
+    with patch.object(backend, "sign", wraps=backend.sign) as sign:
+        for _ in range(3):
+            response = client.get("/clients/device/download-cert")
+            assert response.json() == {"url": "https://certs.example.com/device.zip"}
+        # signed once, the route skipped once cached
+        assert sign.call_count == 1
+        assert app.state.downloads == 1  # type: ignore
+
+        # unknown clients are still found out by the route
+        assert client.get("/clients/unknown/download-cert").status_code == 404
+        assert sign.call_count == 1
+
+        # packaged again, the same certs keep the URL, others drop it
+        client.put("/clients/device/package-cert")
+        assert downloads.get("device") is not None
+        archive.write_bytes(b"renewed certs")
+        client.put("/clients/device/package-cert")
+        assert downloads.get("device") is None
+        client.get("/clients/device/download-cert")
+        assert sign.call_count == 2
+
+        # renewed or revoked, on this worker or another one
+        asyncio.run(downloads.bump(ThreadedSession(session)))
+        session.commit()
+        downloads.set("device", "https://stale.example.com/device.zip")
+        downloads.checked_at = float("-inf")
+        client.get("/clients/device/download-cert")
+        assert sign.call_count == 3
+
+
+def test_download_version_throttled(client: TestClient, downloads):
+    app = client.app
+    client.put("/clients/device/package-cert")
+    client.get("/clients/device/download-cert")
+    assert app.state.sessions == 1  # type: ignore
+
+    # answered from the cache, no session until the next version check
+    downloads.check_interval = 60
+    for _ in range(3):
+        client.get("/clients/device/download-cert")
+    assert app.state.sessions == 1  # type: ignore
+
+
+@patch.multiple(
+    azure_security,
+    DISABLED=False,
+    TENANT_ID="tenant",
+    APP_CLIENT_ID="app",
+    APP_ROLE="role",
+)
+def test_cached_download_secured(backend, downloads):
+    app = FastAPI()
+    add_middlewares(app, backend, None)
+    downloads.set("device", "https://certs.example.com/device.zip?sig=SECRET")
+
+    # the security middleware wraps the cache of the storage one
+    response = TestClient(app).get("/clients/device/download-cert")
+    assert response.status_code == 401
+    assert "SECRET" not in response.text
@@ -0,0 +1,166 @@
+import asyncio
+import json
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from unittest.mock import patch
+
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+from sqlalchemy.pool import StaticPool
+from sqlmodel import create_engine
+
+from sciaiot.ovpncp.middlewares.request_context import RequestContextMiddleware
+from sciaiot.ovpncp.middlewares.tracing import TracingMiddleware
+from sciaiot.ovpncp.utils import command, tracing
+from sciaiot.ovpncp.utils.tracing import FileExporter, Tracer, propagated, traced
+
+TRACEPARENT = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+
+
+@traced()
+def apply_rules():
+    command.run(["iptables", "-I", "FORWARD", "1", "-s", "10.8.0.2"], check=True)
+
+
+@pytest.fixture(name="exporter")
+def exporter_fixture(tmp_path):
+    return FileExporter(str(tmp_path / "traces.jsonl"))
+
+
+@pytest.fixture(name="tracer")
+def tracer_fixture(exporter):
+    return Tracer(exporter, slow_ms=0)
+
+
+@pytest.fixture(name="client")
+def client_fixture(tracer):
+    engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    tracing.trace_queries(engine)
+
+    app = FastAPI()
+    app.add_middleware(TracingMiddleware, tracer=tracer)
+    app.add_middleware(RequestContextMiddleware)
+
+    @app.post("/networks/{client_name}")
+    def create_network(client_name: str):
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+        apply_rules()
+        return {}
+
+    @app.post("/ccd")
+    async def rebuild_ccd():
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            await asyncio.gather(
+                *(loop.run_in_executor(executor, propagated(apply_rules)) for _ in "ab")
+            )
+        return {}
+
+    @app.get("/failed")
+    async def failed():
+        raise HTTPException(503, "Unavailable!")
+
+    with patch("subprocess.run"):
+        yield TestClient(app, raise_server_exceptions=False)
+    engine.dispose()
+
+
+def exported_spans(exporter: FileExporter) -> list[dict]:
+    exporter.close()
+    with open(exporter.path) as f:
+        requests = [json.loads(line) for line in f]
+    return [
+        span
+        for request in requests
+        for resource_spans in request["resourceSpans"]
+        for scope_spans in resource_spans["scopeSpans"]
+        for span in scope_spans["spans"]
+    ]
+
+
+def decode(value: dict):
+    if "arrayValue" in value:
+        return [decode(v) for v in value["arrayValue"]["values"]]
+    return next(iter(value.values()))
+
+
+def attributes(span: dict) -> dict:
+    return {a["key"]: decode(a["value"]) for a in span["attributes"]}
+
+
+def test_trace_request(client: TestClient, exporter):
+    response = client.post("/networks/device", headers={"X-Request-ID": "network-1"})
+    root, query, rules, cmd = exported_spans(exporter)
+
+    assert root["name"] == "POST /networks/{client_name}"
+    assert root["parentSpanId"] == ""
+    assert response.headers["traceparent"] == (
+        f"00-{root['traceId']}-{root['spanId']}-01"
+    )
+    assert attributes(root) == {
+        "http.request.method": "POST",
+        "url.path": "/networks/device",
+        "http.route": "/networks/{client_name}",
+        "http.response.status_code": "200",
+        "client_name": "device",
+        "request_id": "network-1",
+    }
+
+    # run in the threadpool, within the trace of the request
+    assert query["name"] == "db SELECT"
+    assert attributes(query)["db.statement"] == "SELECT 1"
+    assert rules["name"] == "test_tracing.apply_rules"
+    assert cmd["name"] == "command iptables"
+    # masked as in the logs
+    assert attributes(cmd)["process.command_args"] == [
+        "iptables",
+        "-I",
+        "FORWARD",
+        "1",
+        "-s",
+        "***.***.***.***",
+    ]
+    assert {s["traceId"] for s in (query, rules, cmd)} == {root["traceId"]}
+    assert query["parentSpanId"] == rules["parentSpanId"] == root["spanId"]
+    assert cmd["parentSpanId"] == rules["spanId"]
+
+
+def test_trace_propagated(client: TestClient, exporter):
+    client.post("/ccd", headers={"traceparent": TRACEPARENT})
+    spans = exported_spans(exporter)
+
+    # the trace of the caller, into the threads of the executor
+    assert {s["traceId"] for s in spans} == {"0af7651916cd43dd8448eb211c80319c"}
+    assert spans[0]["parentSpanId"] == "b7ad6b7169203331"
+    assert sorted(s["name"] for s in spans[1:]) == [
+        "command iptables",
+        "command iptables",
+        "test_tracing.apply_rules",
+        "test_tracing.apply_rules",
+    ]
+
+
+def test_tail_sampling(client: TestClient, tracer, exporter):
+    tracer.slow_ms = 60_000
+    client.post("/networks/device")
+    client.get("/failed")
+    with patch("subprocess.run", side_effect=subprocess.CalledProcessError(1, "ip")):
+        client.post("/networks/device")
+    root, *_, failed_cmd = exported_spans(exporter)
+
+    # only the failed requests, the fast ones dropped
+    assert root["name"] == "GET /failed"
+    assert root["status"] == {"code": 2, "message": "HTTP 503"}
+    assert failed_cmd["name"] == "command iptables"
+    assert failed_cmd["status"]["message"].startswith("CalledProcessError")
+
+
+def test_span_out_of_trace():
+    assert isinstance(tracing.span("command ip"), nullcontext)
+    assert propagated(apply_rules) is apply_rules
@@ -0,0 +1,156 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from unittest.mock import patch
+
+import pytest
+from sqlmodel import select
+
+from sciaiot.ovpncp.data.server import Client
+from sciaiot.ovpncp.data.traffic import TrafficSample
+from sciaiot.ovpncp.dependencies import ThreadedSession
+from sciaiot.ovpncp.utils import traffic
+from sciaiot.ovpncp.utils.cache import client_cache
+from sciaiot.ovpncp.utils.traffic import RingBuffer, TrafficSampler, load_series
+
+
+@pytest.fixture(name="session")
+def session_fixture(session):
+    client_cache.invalidate()
+    session.add_all(Client(name=f"device_{i}") for i in range(2))
+    session.commit()
+    yield session
+
+    client_cache.invalidate()
+
+
+def live(name: str, remote_address: str, received: int, sent: int):
+    return {
+        "name": name,
+        "remote_address": remote_address,
+        "bytes_received": received,
+        "bytes_sent": sent,
+    }
+
+
+def test_ring_buffer():
+    buffer = RingBuffer(10, 3)
+    buffer.add(100, 1, 2)
+    buffer.add(105, 1, 2)
+    assert buffer.get(10) == (2, 4)
+
+    # the slot of bucket 10 is reused by bucket 13
+    buffer.add(130, 5, 5)
+    assert buffer.get(10) is None
+    assert buffer.get(13) == (5, 5)
+
+
+def test_record_deltas():
+    sampler = TrafficSampler(None)
+    start = 3600 * 1000
+    # the counters before the first round are a baseline
+    sampler.record([live("device_0", "1.1.1.1:1", 1000, 2000)], start)
+    sampler.record([live("device_0", "1.1.1.1:1", 1500, 2100)], start + 10)
+    # reconnected, the counters start over
+    sampler.record([live("device_0", "1.1.1.1:2", 30, 40)], start + 20)
+
+    tiers = sampler.clients["device_0"].tiers
+    assert tiers[0].get(start // 10) == (0, 0)
+    assert tiers[0].get(start // 10 + 1) == (500, 100)
+    assert tiers[0].get(start // 10 + 2) == (30, 40)
+    assert tiers[1].get(start // 60) == (530, 140)
+
+    # dropped once idle longer than the longest tier
+    sampler.record([], start + sampler.retention + 30)
+    assert sampler.clients == {}
+
+
+def test_flush_complete_buckets(session):
+    sampler = TrafficSampler(None)
+    start = 3600 * 1000
+    sampler.record([live("device_0", "1.1.1.1:1", 0, 0)], start)
+    sampler.record(
+        [live("device_0", "1.1.1.1:1", 100, 10), live("unknown", "2.2.2.2:1", 0, 0)],
+        start + 30,
+    )
+    sampler.record([live("device_0", "1.1.1.1:1", 300, 30)], start + 70)
+
+    # only the first minute is complete
+    assert asyncio.run(sampler.flush(ThreadedSession(session), start + 70)) == 1
+    # written once
+    assert asyncio.run(sampler.flush(ThreadedSession(session), start + 75)) == 0
+
+    samples = session.exec(select(TrafficSample)).all()
+    assert [(s.client_id, s.step, s.bytes_received) for s in samples] == [(1, 60, 100)]
+
+    points = asyncio.run(
+        load_series(
+            ThreadedSession(session),
+            1,
+            datetime.fromtimestamp(start),
+            datetime.fromtimestamp(start + 3600),
+            120,
+        )
+    )
+    assert [(p.time, p.bytes_received) for p in points] == [
+        (datetime.fromtimestamp(start), 100)
+    ]
+
+
+def test_series():
+    sampler = TrafficSampler(None)
+    assert sampler.series("device_0", 0, 10, 10) is None
+
+    now = time.time() // 60 * 60
+    sampler.record([live("device_0", "1.1.1.1:1", 0, 0)], now)
+    sampler.record([live("device_0", "1.1.1.1:1", 100, 10)], now + 10)
+    sampler.record([live("device_0", "1.1.1.1:1", 300, 30)], now + 20)
+
+    points = sampler.series("device_0", now, now + 30, 10)
+    assert [(p.bytes_received, p.bytes_sent) for p in points] == [(100, 10), (200, 20)]
+    points = sampler.series("device_0", now, now + 30, 60)
+    assert [(p.bytes_received, p.bytes_sent) for p in points] == [(300, 30)]
+    assert sampler.series("device_1", now, now + 30, 60) == []
+
+    # before the sampler started, left to the persisted tiers
+    assert sampler.series("device_0", now - 60, now + 30, 60) is None
+
+
+def test_one_writer(tmp_path):
+    writes = []
+
+    @asynccontextmanager
+    async def session_factory():
+        yield None
+
+    async def flush(self, session, timestamp):
+        writes.append(self)
+
+    samplers = [
+        traffic.TrafficSampler(
+            session_factory, interval=0.01, lock_file=str(tmp_path / "lock")
+        )
+        for _ in range(2)
+    ]
+
+    async def run():
+        tasks = [asyncio.create_task(samplers[0].run())]
+        while not writes:
+            await asyncio.sleep(0.01)
+        tasks.append(asyncio.create_task(samplers[1].run()))
+        await asyncio.sleep(0.05)
+        assert set(writes) == {samplers[0]}
+        # the owner stops, the other sampler takes the writes over
+        samplers[0].stop()
+        await asyncio.wait_for(tasks[0], 1)
+        await asyncio.sleep(0.05)
+        samplers[1].stop()
+        await asyncio.wait_for(tasks[1], 1)
+        assert samplers[1] in writes
+
+    with (
+        patch.object(traffic.openvpn, "list_connections", return_value=[]),
+        patch.object(traffic.TrafficSampler, "flush", flush),
+    ):
+        asyncio.run(run())